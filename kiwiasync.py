@@ -0,0 +1,331 @@
+## -*- python -*-
+
+"""
+asyncio KiwiSDR client: many receivers in one thread and event loop.
+
+AsyncKiwiSDRStream reimplements connect(), open(), run() and close() of
+KiwiSDRStream as coroutines on asyncio streams and keeps all of its message
+processing, so recorders gain an asyncio variant by listing it first:
+
+    class AsyncKiwiSoundRecorder(AsyncKiwiSDRStream, KiwiSoundRecorder):
+        pass
+
+The _process_*_samples callbacks run in the event loop and must not block
+for long.  Requires python 3.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import struct
+import time
+
+from mod_pywebsocket import common
+from mod_pywebsocket import util
+from mod_pywebsocket._stream_hybi import create_close_frame
+from mod_pywebsocket._stream_hybi import create_pong_frame
+from mod_pywebsocket._stream_hybi import create_text_frame
+
+from mod_pywebsocket.stream import ConnectionTerminatedException
+
+from kiwiclient import KiwiSDRStream
+from kiwiclient import KiwiStallError
+from kiwiclient import KiwiTimeLimitError
+from kiwiworker import STOP, RECONNECT
+from kiwiworker import default_scheduler
+from kiwiworker import error_action
+
+_LENGTH_16 = struct.Struct('!H')
+_LENGTH_64 = struct.Struct('!Q')
+
+class WebSocketError(ConnectionTerminatedException):
+    pass
+
+async def _handshake(reader, writer, host, port, resource, deflate=False):
+    """Client opening handshake, see wsclient.ClientHandshakeProcessor;
+    True when permessage-deflate was requested and accepted."""
+    key = base64.b64encode(os.urandom(16))
+    request = ('GET %s HTTP/1.1\r\n'
+               'Host: %s:%d\r\n'
+               'Upgrade: websocket\r\n'
+               'Connection: Upgrade\r\n'
+               '%s: %s\r\n'
+               '%s: %d\r\n') % (resource, host.lower(), port,
+                                common.SEC_WEBSOCKET_KEY_HEADER, key.decode(),
+                                common.SEC_WEBSOCKET_VERSION_HEADER, common.VERSION_HYBI_LATEST)
+    if deflate:
+        request += '%s: %s; client_max_window_bits\r\n' % (common.SEC_WEBSOCKET_EXTENSIONS_HEADER,
+                                                            common.PERMESSAGE_DEFLATE_EXTENSION)
+    writer.write((request + '\r\n').encode())
+    response = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+    lines = response.split('\r\n')
+    status = lines[0].split(' ')
+    if len(status) < 2 or status[1] != '101':
+        raise WebSocketError('Expected HTTP status code 101 but found %r' % lines[0])
+    fields = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            fields[name.strip().lower()] = value.strip()
+    expected = base64.b64encode(util.sha1_hash(key + common.WEBSOCKET_ACCEPT_UUID.encode()).digest())
+    accept = fields.get(common.SEC_WEBSOCKET_ACCEPT_HEADER.lower(), '')
+    if accept.encode() != expected:
+        raise WebSocketError('Invalid %s header: %r (expected: %s)' %
+                             (common.SEC_WEBSOCKET_ACCEPT_HEADER, accept, expected))
+    header = fields.get(common.SEC_WEBSOCKET_EXTENSIONS_HEADER.lower())
+    extensions = common.parse_extensions(header) if header else []
+    for extension in extensions:
+        if not deflate or extension.name() != common.PERMESSAGE_DEFLATE_EXTENSION:
+            raise WebSocketError('Unexpected extension %r' % extension.name())
+    return bool(extensions)
+
+class AsyncWebSocket(object):
+    """Client side websocket on an asyncio StreamReader/StreamWriter pair.
+
+    Provides the part of the mod_pywebsocket Stream interface KiwiSDRStream
+    uses; send_message() is synchronous and only appends to the transport.
+    With deflate, received messages with RSV1 set are inflated
+    (permessage-deflate); sent messages are never compressed.
+    """
+
+    def __init__(self, reader, writer, deflate=False):
+        self._reader = reader
+        self._writer = writer
+        self._inflater = util._RFC1979Inflater() if deflate else None
+        self._write_queue = None
+        self._closed = False
+
+    def _write(self, frame):
+        if self._write_queue is not None:
+            self._write_queue.append(frame)
+        else:
+            self._writer.write(frame)
+
+    def hold_writes(self):
+        if self._write_queue is None:
+            self._write_queue = []
+
+    def flush_writes(self):
+        queue = self._write_queue
+        self._write_queue = None
+        if queue:
+            self._writer.write(b''.join(queue))
+
+    def send_message(self, message):
+        self._write(create_text_frame(message, mask=True))
+
+    async def receive_message(self):
+        """Returns the next text (as str) or binary (as bytes) message,
+        answering pings on the way; None when the server closed."""
+        readexactly = self._reader.readexactly
+        fragments = None
+        while True:
+            first_byte, second_byte = await readexactly(2)
+            if second_byte & 0x80:
+                raise WebSocketError('Server sent a masked frame')
+            opcode = first_byte & 0xf
+            length = second_byte & 0x7f
+            if length == 126:
+                length = _LENGTH_16.unpack(await readexactly(2))[0]
+            elif length == 127:
+                length = _LENGTH_64.unpack(await readexactly(8))[0]
+            payload = await readexactly(length) if length else b''
+
+            if opcode == common.OPCODE_PING:
+                self._write(create_pong_frame(payload, mask=True))
+                continue
+            if opcode == common.OPCODE_PONG:
+                continue
+            if opcode == common.OPCODE_CLOSE:
+                if not self._closed:
+                    self._writer.write(create_close_frame(payload[:2], mask=True))
+                    self._closed = True
+                return None
+            if opcode == common.OPCODE_CONTINUATION:
+                if fragments is None:
+                    raise WebSocketError('Unexpected continuation frame')
+                fragments.append(payload)
+            else:
+                fragments = [payload]
+                message_opcode = opcode
+                compressed = first_byte & 0x40
+                if compressed and self._inflater is None:
+                    raise WebSocketError('Server sent a compressed frame')
+            if first_byte & 0x80:
+                break
+
+        message = b''.join(fragments) if len(fragments) > 1 else fragments[0]
+        if compressed:
+            message = self._inflater.filter(message)
+        if message_opcode == common.OPCODE_TEXT:
+            return message.decode('utf-8')
+        return message
+
+    async def close_connection(self, code=common.STATUS_NORMAL_CLOSURE):
+        self.flush_writes()
+        if not self._closed:
+            self._closed = True
+            self._writer.write(create_close_frame(struct.pack('!H', code), mask=True))
+        try:
+            await self._writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        self._writer.close()
+
+class AsyncKiwiSDRStream(KiwiSDRStream):
+    """asyncio variant of KiwiSDRStream with the same callbacks."""
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncKiwiSDRStream, self).__init__(*args, **kwargs)
+        self._last_receive = 0
+        self._watchdog_task = None
+        self._stalled = False
+
+    async def connect(self, host, port):
+        self._keepalive_interval = getattr(self._options, 'keepalive_interval', self._keepalive_interval)
+        self._stall_frames = getattr(self._options, 'stall_frames', self._stall_frames)
+        self._reset_stall_watchdog()
+        self._stalled = False
+        which = 'W/F' if self._isWF else 'SND'
+        self._stream_name = which
+        timeout = self._options.socket_timeout
+        t0 = time.monotonic()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        self._socket = writer
+        t1 = time.monotonic()
+        try:
+            deflate = await asyncio.wait_for(_handshake(reader, writer, host, port, '/%d/%s' % (int(time.time()), which),
+                                                        getattr(self._options, 'permessage_deflate', False)), timeout)
+        except BaseException:
+            # the worker reconnects with a new writer: do not leak this one
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            raise
+        self._start_connect_timing(t0, t1, time.monotonic())
+        self._stream = AsyncWebSocket(reader, writer, deflate)
+        self._last_receive = time.monotonic()
+        self._watchdog_task = asyncio.ensure_future(self._watchdog(timeout))
+
+    def _set_stall_timeout(self, timeout):
+        self._watchdog_task.cancel()
+        self._watchdog_task = asyncio.ensure_future(self._watchdog(timeout))
+
+    async def _watchdog(self, timeout):
+        """Aborts the connection when nothing was received for timeout
+        seconds; cheaper than a wait_for() around every read."""
+        while True:
+            await asyncio.sleep(timeout / 2.0)
+            if time.monotonic() - self._last_receive > timeout:
+                logging.warning("%s: no data for %.1fs, closing", self._stream_name, timeout)
+                self._stalled = self.stall_timeout is not None
+                self._socket.transport.abort()
+                return
+
+    async def open(self):
+        super(AsyncKiwiSDRStream, self).open()
+        await self._socket.drain()
+
+    async def run(self):
+        """Receives and processes one message."""
+        try:
+            received = await self._stream.receive_message()
+        except Exception:
+            if not self._stalled:
+                raise
+            raise KiwiStallError('%s: no data for %.1fs' % (self._stream_name, self.stall_timeout))
+        if received is None:
+            raise EOFError('server closed the connection')
+        self._last_receive = time.monotonic()
+        self._process_received(received, time.time())
+        # only waits when the transport's write buffer is above its high-water mark
+        await self._socket.drain()
+        tlimit = self._options.tlimit
+        if tlimit != None and self._start_time != None and time.time() - self._start_time > tlimit:
+            raise KiwiTimeLimitError('time limit reached')
+
+    async def close(self):
+        if self._watchdog_task is not None:
+            self._watchdog_task.cancel()
+            self._watchdog_task = None
+        self.shutdown()
+        try:
+            await self._stream.close_connection()
+        except Exception as e:
+            print("exception: %s" % e)
+
+async def run_worker(recorder, options, stop, scheduler=None):
+    """Connect/run/reconnect loop of kiwiworker.KiwiWorker for one
+    AsyncKiwiSDRStream, admitted by a kiwiworker.ConnectScheduler; sets the
+    asyncio.Event stop when done."""
+    try:
+        await _run_worker(recorder, options, stop, scheduler or default_scheduler)
+    finally:
+        recorder.shutdown()      # processes what was received
+        recorder.close_sinks()   # finishes the recording
+        stop.set()   # tell all other workers to stop
+
+async def _run_worker(recorder, options, stop, scheduler):
+    host = options.server_host
+    attempt = 0
+    while not stop.is_set():
+        while True:
+            wait = scheduler.try_acquire(host)
+            if wait == 0:
+                break
+            await _wait(stop, wait)
+            if stop.is_set():
+                return
+        try:
+            await recorder.connect(options.server_host, options.server_port)
+        except Exception as e:
+            scheduler.release(host, ok=False)
+            action = error_action(e, options, connecting=True)
+        else:
+            try:
+                try:
+                    await recorder.open()
+                finally:
+                    scheduler.release(host)
+                while not stop.is_set():
+                    await recorder.run()
+                    if attempt and recorder.connect_timing['first_sample'] is not None:
+                        attempt = 0   # receiving again
+                action = STOP
+            except Exception as e:
+                action = error_action(e, options)
+            finally:
+                scheduler.record_timing(host, recorder.connect_timing)
+                await recorder.close()
+
+        if action == STOP:
+            break
+        if action == RECONNECT:
+            attempt = 0
+        else:
+            attempt += 1
+            await _wait(stop, scheduler.backoff(attempt))
+
+async def _wait(event, timeout):
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+async def run_all(workers, scheduler=None):
+    """Runs (recorder, options) pairs until one of them stops or the
+    returned task is cancelled."""
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(run_worker(recorder, options, stop, scheduler)) for recorder, options in workers]
+    try:
+        await stop.wait()
+    finally:
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# EOF
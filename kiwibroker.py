@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+## -*- python -*-
+
+"""
+Rebroadcast broker: holds one persistent connection per KiwiSDR channel and
+re-serves the decoded audio, IQ or waterfall blocks to any number of local
+clients over TCP or a Unix socket, without a websocket handshake or auth.
+
+Protocol: the client sends the channel name followed by a newline; the
+broker answers with frames of
+
+    <I length of the rest> <B type> payload
+
+type 'H': hello, JSON with the channel parameters, again on every change
+type 'B': block, <4sIfBII dtype seq rssi last_gps_solution gpssec gpsnsec
+          followed by the samples as numpy array data of that dtype
+
+BrokerClient implements the client side.
+"""
+
+import json, logging, os, socket, stat, struct, threading, time
+from optparse import OptionParser
+import numpy as np
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import kiwiclient
+from kiwiworker import KiwiWorker
+
+_FRAME = struct.Struct('<IB')
+_BLOCK = struct.Struct('<4sIfBII')
+
+HELLO = ord('H')
+BLOCK = ord('B')
+
+def encode_hello(info):
+    payload = json.dumps(info, sort_keys=True).encode()
+    return _FRAME.pack(len(payload) + 1, HELLO) + payload
+
+def encode_block(seq, samples, rssi=0, gps=None):
+    if gps is None:
+        header = _BLOCK.pack(samples.dtype.str.encode(), seq, rssi, 0, 0, 0)
+    else:
+        header = _BLOCK.pack(samples.dtype.str.encode(), seq, rssi,
+                             gps['last_gps_solution'], gps['gpssec'], gps['gpsnsec'])
+    data = samples.tobytes()
+    return b''.join((_FRAME.pack(len(header) + len(data) + 1, BLOCK), header, data))
+
+class Channel(object):
+    """Broadcasts the frames of one Kiwi connection to the attached clients,
+    each through its own bounded queue; frames for full queues are dropped."""
+
+    def __init__(self, name, queue_depth):
+        self.name = name
+        self.info = {'channel': name}
+        self._queue_depth = queue_depth
+        self._clients = []
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.dropped = 0
+
+    def attach(self):
+        q = queue.Queue(self._queue_depth)
+        with self._lock:
+            q.put(encode_hello(self.info))
+            self._clients.append(q)
+        return q
+
+    def detach(self, q):
+        with self._lock:
+            self._clients.remove(q)
+
+    def broadcast(self, frame):
+        self.frames += 1
+        with self._lock:
+            for q in self._clients:
+                try:
+                    q.put_nowait(frame)
+                except queue.Full:
+                    self.dropped += 1
+
+    def update(self, **info):
+        self.info.update(info)
+        self.broadcast(encode_hello(self.info))
+
+    def clients(self):
+        return len(self._clients)
+
+class _ChannelSink(kiwiclient.KiwiSink):
+    def __init__(self, channel):
+        self.name = 'broker-%s' % channel.name
+        self._channel = channel
+
+    def process_audio_samples(self, seq, samples, rssi):
+        self._channel.broadcast(encode_block(seq, samples, rssi))
+
+    def process_iq_samples(self, seq, samples, rssi, gps):
+        self._channel.broadcast(encode_block(seq, samples, rssi, gps))
+
+    def process_waterfall_samples(self, seq, samples):
+        self._channel.broadcast(encode_block(seq, samples))
+
+class BrokerStream(kiwiclient.KiwiSDRStream):
+    """Kiwi connection feeding a Channel."""
+
+    def __init__(self, options, channel, waterfall=False):
+        super(BrokerStream, self).__init__()
+        self._options = options
+        self._isWF = waterfall
+        self._freq = options.frequency
+        self._start_time = None
+        self._channel = channel
+        self.add_sink(_ChannelSink(channel))
+        channel.update(server='%s:%s' % (options.server_host, options.server_port),
+                       kind='waterfall' if waterfall else ('iq' if options.modulation == 'iq' else 'audio'),
+                       frequency=self._freq, modulation=options.modulation, sample_rate=None)
+
+    def _setup_rx_params(self):
+        self.set_name(self._options.user)
+        if self._isWF:
+            self._set_zoom_start(self._options.zoom, 0)
+            self._set_maxdb_mindb(-10, -110)
+            self._set_wf_comp(self._options.wf_comp)
+            self._set_wf_speed(1)
+        else:
+            mod = self._options.modulation
+            lp_cut = -self._options.hp_cut if mod == 'am' else self._options.lp_cut
+            self.set_mod(mod, lp_cut, self._options.hp_cut, self._freq)
+            if self._options.agc_gain != None:
+                self.set_agc(on=False, gain=self._options.agc_gain)
+            else:
+                self.set_agc(on=True)
+            if self._options.compression is False:
+                self._set_snd_comp(False)
+        self.set_inactivity_timeout(0)
+
+    def _on_sample_rate_change(self):
+        self._channel.update(sample_rate=self._sample_rate)
+
+class _ClientHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        self.request.settimeout(10)
+        name = self.rfile.readline().strip().decode('utf-8', 'replace')
+        channel = broker.channels.get(name or broker.default_channel)
+        if channel is None:
+            logging.warning("unknown channel %r", name)
+            return
+        self.request.settimeout(None)
+        q = channel.attach()
+        logging.info("client attached to channel %s (%d clients)", channel.name, channel.clients())
+        try:
+            while broker.running:
+                try:
+                    frame = q.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.request.sendall(frame)
+        except (socket.error, IOError):
+            pass
+        finally:
+            channel.detach(q)
+            logging.info("client detached from channel %s (%d clients)", channel.name, channel.clients())
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+class Broker(object):
+    """Channels plus the server the clients attach to."""
+
+    def __init__(self, address):
+        self.channels = {}
+        self.default_channel = None
+        self.running = True
+        self._address = address
+        if isinstance(address, tuple):
+            self._server = _TCPServer(address, _ClientHandler)
+        else:
+            if os.path.exists(address):
+                if not stat.S_ISSOCK(os.stat(address).st_mode):
+                    raise ValueError('%s exists and is not a socket' % address)
+                os.unlink(address)   # left over from an earlier run
+            self._server = _UnixServer(address, _ClientHandler)
+        self._server.broker = self
+
+    def add_channel(self, name, queue_depth=256):
+        channel = Channel(name, queue_depth)
+        self.channels[name] = channel
+        if self.default_channel is None:
+            self.default_channel = name
+        return channel
+
+    def serve_forever(self):
+        self._server.serve_forever(poll_interval=0.5)
+
+    def shutdown(self):
+        self.running = False
+        self._server.shutdown()
+        self._server.server_close()
+        if not isinstance(self._address, tuple) and os.path.exists(self._address):
+            os.unlink(self._address)
+
+def parse_address(address):
+    """'host:port' or ':port' for TCP, anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+class BrokerBlock(object):
+    __slots__ = ('seq', 'rssi', 'gps', 'samples')
+
+    def __init__(self, seq, rssi, gps, samples):
+        self.seq = seq
+        self.rssi = rssi
+        self.gps = gps
+        self.samples = samples
+
+class BrokerClient(object):
+    """Client side of the broker protocol; read() returns the next hello
+    (a dict, also kept in self.info) or BrokerBlock, None when the broker
+    closed the connection."""
+
+    def __init__(self, address, channel=''):
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self._socket = socket.create_connection(address)
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(address)
+        self._socket.sendall(channel.encode() + b'\n')
+        self._file = self._socket.makefile('rb')
+        self.info = None
+
+    def _read_exact(self, n):
+        data = self._file.read(n)
+        if len(data) != n:
+            return None
+        return data
+
+    def read(self):
+        header = self._read_exact(_FRAME.size)
+        if header is None:
+            return None
+        length, frame_type = _FRAME.unpack(header)
+        payload = self._read_exact(length - 1)
+        if payload is None:
+            return None
+        if frame_type == HELLO:
+            self.info = json.loads(payload.decode())
+            return self.info
+        dtype, seq, rssi, last_gps_solution, gpssec, gpsnsec = _BLOCK.unpack_from(payload)
+        samples = np.frombuffer(payload, dtype=dtype.rstrip(b'\0').decode(), offset=_BLOCK.size)
+        gps = dict(last_gps_solution=last_gps_solution, gpssec=gpssec, gpsnsec=gpsnsec)
+        return BrokerBlock(seq, rssi, gps, samples)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+def main():
+    from kiwirecorder import options_cross_product, get_comma_separated_args
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--log-level', '--log_level', type='choice',
+                      dest='log_level', default='info',
+                      choices=['debug', 'info', 'warn', 'error', 'critical'],
+                      help='Log level: debug|info|warn|error|critical')
+    parser.add_option('--listen',
+                      dest='listen', type='string', default='127.0.0.1:8074',
+                      help='host:port or Unix socket path the clients connect to')
+    parser.add_option('--queue-depth',
+                      dest='queue_depth', type='int', default=256,
+                      help='Frames queued per client before frames are dropped')
+    parser.add_option('-k', '--socket-timeout', '--socket_timeout',
+                      dest='socket_timeout', type='int', default=10,
+                      help='Timeout(sec) for sockets')
+    parser.add_option('--deflate',
+                      dest='permessage_deflate', default=False, action='store_true',
+                      help='Ask the server for permessage-deflate compression (saves bandwidth on '
+                      'waterfall data without --wf-comp and on MSG data, costs CPU)')
+    parser.add_option('-s', '--server-host',
+                      dest='server_host', type='string',
+                      default='localhost', help='Server host (can be a comma-delimited list)',
+                      action='callback',
+                      callback_args=(str,),
+                      callback=get_comma_separated_args)
+    parser.add_option('-p', '--server-port',
+                      dest='server_port', type='string',
+                      default=8073, help='Server port, default 8073 (can be a comma delimited list)',
+                      action='callback',
+                      callback_args=(int,),
+                      callback=get_comma_separated_args)
+    parser.add_option('--pw', '--password',
+                      dest='password', type='string', default='',
+                      help='Kiwi login password (if required, can be a comma delimited list)',
+                      action='callback',
+                      callback_args=(str,),
+                      callback=get_comma_separated_args)
+    parser.add_option('-u', '--user',
+                      dest='user', type='string', default='kiwibroker.py',
+                      help='Kiwi connection user name',
+                      action='callback',
+                      callback_args=(str,),
+                      callback=get_comma_separated_args)
+    parser.add_option('-f', '--freq',
+                      dest='frequency',
+                      type='string', default=1000,
+                      help='Frequency to tune to, in kHz (can be a comma-separated list)',
+                      action='callback',
+                      callback_args=(float,),
+                      callback=get_comma_separated_args)
+    parser.add_option('-m', '--modulation',
+                      dest='modulation',
+                      type='string', default='am',
+                      help='Modulation; one of am, lsb, usb, cw, nbfm, iq')
+    parser.add_option('--ncomp', '--no_compression',
+                      dest='compression',
+                      default=True,
+                      action='store_false',
+                      help='Don\'t use audio compression')
+    parser.add_option('-L', '--lp-cutoff',
+                      dest='lp_cut',
+                      type='float', default=100,
+                      help='Low-pass cutoff frequency, in Hz')
+    parser.add_option('-H', '--hp-cutoff',
+                      dest='hp_cut',
+                      type='float', default=2600,
+                      help='High-pass cutoff frequency, in Hz')
+    parser.add_option('-g', '--agc-gain',
+                      dest='agc_gain',
+                      type='string',
+                      default=None,
+                      help='AGC gain; if set, AGC is turned off (can be a comma-separated list)',
+                      action='callback',
+                      callback_args=(float,),
+                      callback=get_comma_separated_args)
+    parser.add_option('--station',
+                      dest='station',
+                      type='string', default=None,
+                      help='Channel names (can be a comma-separated list), default 0, 1, ...',
+                      action='callback',
+                      callback_args=(str,),
+                      callback=get_comma_separated_args)
+    parser.add_option('--wf',
+                      dest='waterfall',
+                      default=False,
+                      action='store_true',
+                      help='Serve waterfall data instead of audio')
+    parser.add_option('-z', '--zoom',
+                      dest='zoom', type='int', default=0,
+                      help='Zoom level 0-14')
+    parser.add_option('--wf-comp', '--wf_comp',
+                      dest='wf_comp',
+                      default=False,
+                      action='store_true',
+                      help='Use waterfall compression')
+
+    (options, unused_args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.getLevelName(options.log_level.upper()))
+
+    # defaults expected by options_cross_product and KiwiWorker
+    options.filename = ''
+    options.tlimit = None
+    options.is_kiwi_tdoa = False
+    options = options_cross_product(options)
+
+    broker = Broker(parse_address(options[0].listen))
+    # one run event per channel: a Kiwi going away only affects its own
+    # channel, whose worker keeps reconnecting
+    run_events = []
+    workers = []
+    for i,opt in enumerate(options):
+        opt.idx = i
+        channel = broker.add_channel(opt.station if opt.station else str(i), opt.queue_depth)
+        stream = BrokerStream(opt, channel, waterfall=opt.waterfall)
+        run_event = threading.Event()
+        run_event.set()
+        run_events.append(run_event)
+        workers.append(KiwiWorker(args=(stream, opt, run_event), kwargs={'persistent': True}))
+
+    server = threading.Thread(target=broker.serve_forever, name='kiwibroker-server')
+    server.daemon = True
+    server.start()
+    for w in workers:
+        w.daemon = True
+        w.start()
+    logging.info("serving channels %s on %s", ', '.join(sorted(broker.channels)), options[0].listen)
+
+    try:
+        while any(run_event.is_set() for run_event in run_events):
+            time.sleep(.5)
+    except KeyboardInterrupt:
+        print("KeyboardInterrupt: shutting down")
+    for run_event in run_events:
+        run_event.clear()
+    broker.shutdown()
+
+if __name__ == '__main__':
+    main()
+
+# EOF
@@ -3,20 +3,30 @@
 import array
 import logging
 import socket
-import struct
+import threading
 import time
 import numpy as np
 try:
     import urllib.parse as urllib
 except ImportError:
     import urllib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import sys
 if sys.version_info > (3,):
     buffer = memoryview
 
 import json
+import kiwicodec
 import wsclient
+from mod_pywebsocket.stream import ConnectionTerminatedException
+
+# monotonic clock for timers; time.time() on python2
+_monotonic = getattr(time, 'monotonic', time.time)
+_perf_counter = getattr(time, 'perf_counter', time.time)
 
 #
 # IMAADPCM decoder
@@ -78,6 +88,230 @@ class ImaAdpcmDecoder(object):
             samples.append(sample1)
         return samples
 
+#
+# Table-driven IMAADPCM decoder
+#
+
+def _build_adpcm_tables():
+    """Precompute the decoder transitions.
+
+    Returns the (step index, nibble) -> (next index, delta) transitions
+    indexed by (step index << 4 | nibble), and the same transitions folded
+    into per-byte tables indexed by (step index << 8 | byte), holding the
+    deltas of the low and high nibbles and the step index after both,
+    pre-shifted by 8 so it can be or-ed with the next byte.
+    """
+    num_steps = len(stepSizeTable)
+    next_index = []
+    delta = []
+    for index, step in enumerate(stepSizeTable):
+        for code in range(16):
+            difference = step >> 3
+            if ( code & 1 ):
+                difference += step >> 2
+            if ( code & 2 ):
+                difference += step >> 1
+            if ( code & 4 ):
+                difference += step
+            if ( code & 8 ):
+                difference = -difference
+            delta.append(difference)
+            next_index.append(clamp(index + indexAdjustTable[code], 0, num_steps - 1))
+    delta0 = []
+    delta1 = []
+    next_state = []
+    for index in range(num_steps):
+        for b in range(256):
+            t0 = (index << 4) | (b & 0x0F)
+            t1 = (next_index[t0] << 4) | (b >> 4)
+            delta0.append(delta[t0])
+            delta1.append(delta[t1])
+            next_state.append(next_index[t1] << 8)
+    return delta, next_index, delta0, delta1, next_state
+
+_adpcmDelta, _adpcmNextIndex, _adpcmDelta0, _adpcmDelta1, _adpcmNextState = _build_adpcm_tables()
+
+class ImaAdpcmFastDecoder(object):
+    """Bit-exact replacement for ImaAdpcmDecoder.
+
+    Decodes a whole frame in one pass over the precomputed per-byte tables
+    and returns the samples as a NumPy int16 array. Accepts bytes,
+    bytearray or memoryview input; the decoder state carries over between
+    calls exactly as with ImaAdpcmDecoder.
+    """
+
+    def __init__(self):
+        self.index = 0
+        self.prev = 0
+
+    def decode(self, data):
+        samples = np.empty(2*len(data), dtype=np.int16)
+        self.decode_into(data, samples, 0)
+        return samples
+
+    def decode_into(self, data, out, offset=0):
+        """Decode data into out[offset:offset+2*len(data)].
+
+        out can be an int16 NumPy array, an array.array('h') or a writable
+        memoryview of format 'h'. Nothing is allocated per sample.
+        Returns the offset following the last decoded sample.
+        """
+        if isinstance(data, str):
+            data = bytearray(data)
+        if isinstance(out, np.ndarray):
+            out = memoryview(out)
+        if offset + 2*len(data) > len(out):
+            raise ValueError('output buffer too small: %d samples at offset %d, size %d'
+                             % (2*len(data), offset, len(out)))
+        delta0 = _adpcmDelta0
+        delta1 = _adpcmDelta1
+        next_state = _adpcmNextState
+        state = self.index << 8
+        prev = self.prev
+        j = offset
+        for b in data:
+            t = state | b
+            prev += delta0[t]
+            if prev > 32767:
+                prev = 32767
+            elif prev < -32768:
+                prev = -32768
+            out[j] = prev
+            prev += delta1[t]
+            if prev > 32767:
+                prev = 32767
+            elif prev < -32768:
+                prev = -32768
+            out[j+1] = prev
+            j += 2
+            state = next_state[t]
+        self.index = state >> 8
+        self.prev = prev
+        return j
+
+    def advance(self, data, start=0, end=None):
+        """Advance the decoder state over the nibbles start..end-1 of data
+        (low nibble first), as decoding them would, without output."""
+        if isinstance(data, str):
+            data = bytearray(data)
+        if end is None:
+            end = 2*len(data)
+        index = self.index
+        prev = self.prev
+        if start & 1 and start < end:
+            # high nibble of a byte
+            t = (index << 4) | (data[start >> 1] >> 4)
+            prev = clamp(prev + _adpcmDelta[t], -32768, 32767)
+            index = _adpcmNextIndex[t]
+            start += 1
+        # the step indexes only depend on the nibbles: one table lookup per
+        # byte, then the deltas are summed at once unless they clip
+        next_state = _adpcmNextState
+        state = index << 8
+        states = []
+        for b in data[start >> 1:end >> 1]:
+            t = state | b
+            states.append(t)
+            state = next_state[t]
+        if states:
+            levels = _adpcmDeltaPairs.take(states, axis=0).cumsum()
+            if -32768 - prev <= levels.min() and levels.max() <= 32767 - prev:
+                prev += int(levels[-1])
+            else:
+                prev = self._clip_levels(states, prev)
+        index = state >> 8
+        if end & 1 and start < end:
+            # low nibble of the last byte
+            t = (index << 4) | (data[end >> 1] & 0x0F)
+            prev = clamp(prev + _adpcmDelta[t], -32768, 32767)
+            index = _adpcmNextIndex[t]
+        self.index = index
+        self.prev = prev
+
+    @staticmethod
+    def _clip_levels(states, prev):
+        """The predictor after the (state | byte) table indexes states."""
+        delta0 = _adpcmDelta0
+        delta1 = _adpcmDelta1
+        for t in states:
+            prev += delta0[t]
+            if prev > 32767:
+                prev = 32767
+            elif prev < -32768:
+                prev = -32768
+            prev += delta1[t]
+            if prev > 32767:
+                prev = 32767
+            elif prev < -32768:
+                prev = -32768
+        return prev
+
+_adpcmDeltaArray = np.array(_adpcmDelta, dtype=np.int32)
+_adpcmNextArray = np.array(_adpcmNextIndex, dtype=np.intp) << 4
+_adpcmDeltaPairs = np.array([_adpcmDelta0, _adpcmDelta1], dtype=np.int32).T.copy()   # per (state | byte)
+
+def decode_waterfall_lines(lines, tail=10):
+    """Decode a batch of compressed waterfall lines.
+
+    The decoder is reset for every waterfall line, so the lines are
+    independent and are decoded in lockstep, one vector operation per
+    nibble position. All lines must have the same length.
+
+    Args:
+        lines: sequence of N compressed W/F payloads (the data following
+            the 12 byte W/F header), as bytes, bytearray or memoryview.
+        tail: number of decompression tail samples removed from each line.
+
+    Returns:
+        (N, bins) int16 array with bins = 2*len(line) - tail.
+    """
+    nlines = len(lines)
+    nbytes = len(lines[0]) if nlines else 0
+    for line in lines:
+        if len(line) != nbytes:
+            raise ValueError('waterfall lines of different length: %d != %d' % (len(line), nbytes))
+    bins = max(2*nbytes - tail, 0)
+    data = np.frombuffer(b''.join(lines), dtype=np.uint8).reshape(nlines, nbytes)
+    return decode_adpcm_blocks(data, nsamples=bins)
+
+def decode_adpcm_blocks(data, index=None, prev=None, nsamples=None):
+    """Decode independent blocks of IMA ADPCM data in lockstep.
+
+    Args:
+        data: (N, nbytes) uint8 array, one block per row.
+        index, prev: the decoder states the blocks start with, arrays of N
+            step indexes and predictors; 0 by default.
+        nsamples: number of samples decoded per block, 2*nbytes by default.
+
+    Returns:
+        (N, nsamples) int16 array.
+    """
+    nlines, nbytes = data.shape
+    bins = 2*nbytes if nsamples is None else nsamples
+    # one row per nibble position, one column per line
+    codes = np.empty((2*nbytes, nlines), dtype=np.intp)
+    codes[0::2] = (data & 0x0F).T
+    codes[1::2] = (data >> 4).T
+    out = np.empty((bins, nlines), dtype=np.int32)
+    state = np.zeros(nlines, dtype=np.intp)
+    if index is not None:
+        state[:] = np.asarray(index, dtype=np.intp) << 4
+    if prev is None:
+        prev = np.zeros(nlines, dtype=np.int32)
+    else:
+        prev = np.array(prev, dtype=np.int32)
+    t = np.empty(nlines, dtype=np.intp)
+    difference = np.empty(nlines, dtype=np.int32)
+    for j in range(bins):
+        np.bitwise_or(state, codes[j], out=t)
+        np.take(_adpcmDeltaArray, t, out=difference)
+        np.add(prev, difference, out=difference)
+        np.minimum(difference, 32767, out=difference)
+        prev = out[j]
+        np.maximum(difference, -32768, out=prev)
+        np.take(_adpcmNextArray, t, out=state)
+    return out.T.astype(np.int16)
+
 #
 # KiwiSDR WebSocket client
 #
@@ -92,6 +326,175 @@ class KiwiBadPasswordError(KiwiError):
     pass
 class KiwiTimeLimitError(KiwiError):
     pass
+class KiwiStallError(KiwiError):
+    """No data for a few frame periods: reconnect at once."""
+    pass
+
+def _is_timeout(e):
+    # mod_pywebsocket wraps socket errors in ConnectionTerminatedException
+    return isinstance(e, socket.timeout) or isinstance(getattr(e, '__context__', None), socket.timeout)
+
+class ReceivePipeline(object):
+    """Bounded queue between the receive stage, which only reads, copies and
+    timestamps messages, and a decode thread calling process(message, t).
+
+    policy maps 3 character message tags to 'drop' (drop the message when
+    the queue is full) or 'block' (wait for room); the default is 'block'.
+    An exception in process() is raised by the next put().
+    """
+
+    def __init__(self, process, depth, policy):
+        self._process = process
+        self._queue = queue.Queue(depth)
+        self._drop = set(tag.encode() for tag, action in policy.items() if action == 'drop')
+        self.received = 0
+        self.dropped = {}
+        self.max_depth = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='kiwi-decode')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        get = self._queue.get
+        while True:
+            item = get()
+            if item is None:
+                return
+            try:
+                self._process(*item)
+            except Exception as e:
+                self.error = e
+                return
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, message):
+        self._check()
+        if isinstance(message, memoryview):
+            message = message.tobytes()   # the receive buffer is reused
+        item = (message, time.time())
+        self.received += 1
+        if message[0:3] in self._drop:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                tag = message[0:3].decode()
+                self.dropped[tag] = self.dropped.get(tag, 0) + 1
+        else:
+            while True:
+                try:
+                    self._queue.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    self._check()
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def stop(self, timeout=5):
+        """Lets the decode thread process the queued messages and stop."""
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+        logging.info("pipeline: %d received, max depth %d, dropped %s",
+                     self.received, self.max_depth, self.dropped or 0)
+        if self.error is not None:
+            logging.error("pipeline: decode thread stopped by %r, %d queued messages not processed",
+                          self.error, self._queue.qsize())
+
+class KiwiSink(object):
+    """Base class for sinks registered with KiwiSDRStream.add_sink().
+
+    Sinks need not derive from this class, only implement the methods for
+    the data they want.  The samples are read-only numpy views, valid until
+    the method returns, or copies for sinks added with threaded=True.
+    """
+
+    def process_audio_samples(self, seq, samples, rssi):
+        pass
+
+    def process_iq_samples(self, seq, samples, rssi, gps):
+        pass
+
+    def process_waterfall_samples(self, seq, samples):
+        pass
+
+    def close(self):
+        pass
+
+class SinkHandle(object):
+    """A registered sink with its timing and error counters.
+
+    Exceptions raised by the sink are logged and counted, not propagated.
+    A threaded sink runs in its own thread behind a queue of queue_depth
+    blocks; blocks arriving when the queue is full are dropped and counted.
+    """
+
+    _KINDS = ('audio', 'iq', 'waterfall')
+
+    def __init__(self, sink, threaded=False, queue_depth=64):
+        self.sink = sink
+        self.name = getattr(sink, 'name', type(sink).__name__)
+        self.methods = dict((kind, getattr(sink, 'process_%s_samples' % kind, None)) for kind in self._KINDS)
+        self.threaded = threaded
+        self.calls = 0
+        self.errors = 0
+        self.dropped = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self._queue = None
+        if threaded:
+            self._queue = queue.Queue(queue_depth)
+            self._thread = threading.Thread(target=self._run, name='kiwi-sink-%s' % self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def call(self, method, args):
+        t0 = _perf_counter()
+        try:
+            method(*args)
+        except Exception:
+            self.errors += 1
+            if self.errors <= 3:
+                logging.exception("sink %s failed (%d)", self.name, self.errors)
+        dt = _perf_counter() - t0
+        self.calls += 1
+        self.time += dt
+        if dt > self.max_time:
+            self.max_time = dt
+
+    def put(self, method, args):
+        try:
+            self._queue.put_nowait((method, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self.call(*item)
+
+    def close(self, timeout=5):
+        if self._queue is not None:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+        close = getattr(self.sink, 'close', None)
+        if close is not None:
+            close()
+        logging.info("sink %s: %d calls, %.3f ms mean, %.3f ms max, %d errors, %d dropped",
+                     self.name, self.calls, 1e3 * self.time / max(self.calls, 1), 1e3 * self.max_time,
+                     self.errors, self.dropped)
 
 class KiwiSDRStreamBase(object):
     """KiwiSDR WebSocket stream base client."""
@@ -119,20 +522,44 @@ class KiwiSDRStreamBase(object):
         from mod_pywebsocket.stream import StreamOptions
 
         self._stream_name = which;
+        t0 = _monotonic()
         self._socket = socket.create_connection(address=(host, port), timeout=self._options.socket_timeout)
+        t1 = _monotonic()
         uri = '/%d/%s' % (int(time.time()), which)
-        handshake = wsclient.ClientHandshakeProcessor(self._socket, host, port)
+        deflate = getattr(self._options, 'permessage_deflate', False)
+        handshake = wsclient.ClientHandshakeProcessor(self._socket, host, port, use_permessage_deflate=deflate)
         handshake.handshake(uri)
+        self._start_connect_timing(t0, t1, _monotonic())
 
-        request = wsclient.ClientRequest(self._socket)
+        request = wsclient.ClientRequest(self._socket, buffered=True)
         request.ws_version = mod_pywebsocket.common.VERSION_HYBI13
 
         stream_option = StreamOptions()
         stream_option.mask_send = True
         stream_option.unmask_receive = False
+        framer = handshake.permessage_deflate_framer
+        if framer is not None:
+            # our few short SET commands are not worth compressing
+            framer.setup_receive_options(stream_option)
+        logging.debug("%s: permessage-deflate %s", which, 'on' if framer is not None else 'off')
 
         self._stream = Stream(request, stream_option)
 
+    def _start_connect_timing(self, t_start, t_connected, t_handshake):
+        """connect_timing: TCP connect, websocket handshake and first sample
+        latencies in seconds, the latter set when the first block arrives."""
+        self._connect_start = t_start
+        self.connect_timing = {'connect': t_connected - t_start,
+                               'handshake': t_handshake - t_connected,
+                               'first_sample': None}
+        self._first_sample_pending = True
+
+    def _on_first_sample(self):
+        self._first_sample_pending = False
+        self.connect_timing['first_sample'] = _monotonic() - self._connect_start
+        logging.info("%s: connect %.3fs, handshake %.3fs, first sample after %.3fs", self._stream_name,
+                     self.connect_timing['connect'], self.connect_timing['handshake'], self.connect_timing['first_sample'])
+
     def _send_message(self, msg):
         if msg != 'SET keepalive':
             logging.debug("send SET (%s) %s", self._stream_name, msg)
@@ -154,8 +581,7 @@ class KiwiSDRStreamBase(object):
         self._send_message('SET keepalive')
 
     def _process_ws_message(self, message):
-        tag = message[0:3].decode()
-        body = message[4:]
+        tag, body = kiwicodec.split_message(message)
         self._process_message(tag, body)
 
 
@@ -163,17 +589,103 @@ class KiwiSDRStream(KiwiSDRStreamBase):
     """KiwiSDR WebSocket stream client."""
 
     def __init__(self, *args, **kwargs):
-        self._decoder = ImaAdpcmDecoder()
+        self._decoder = ImaAdpcmFastDecoder()
         self._sample_rate = None
         self._version_major = None
         self._version_minor = None
         self._modulation = None
         self._compression = True
         self._gps_pos = [0,0]
+        self._wf_batch_size = 1   # >1: decode compressed W/F lines in batches
+        self._wf_samples_db = False   # True: W/F samples as int16 dB values
+        self._wf_batch = []
+        self._decode_buffer = None   # see _set_decode_buffer()
+        self._decode_view = None
+        self._decode_offset = 0
+        self._adpcm_passthrough = False   # True: compressed audio to _process_audio_adpcm()
+        self._keepalive_interval = 1.0   # seconds, see _keepalive_tick()
+        self._keepalive_due = 0
+        self._keepalive_sent = 0
+        self._keepalive_skipped = 0
+        self._pipeline_depth = 0   # >0: decode in a ReceivePipeline thread
+        self._pipeline_policy = {'W/F': 'drop'}
+        self._pipeline = None
+        self._receive_time = None   # time.time() the message being processed was received
+        self._sinks = []   # SinkHandles, see add_sink()
+        self._iq_converted = None   # (samples, complex64) of the IQ frame being processed
+        self.connect_timing = None   # see _start_connect_timing()
+        self._first_sample_pending = False
+        self._stall_frames = 8   # >0: declare a stall after this many frame periods without data
+        self._stall_min = 1.0   # seconds, lower bound of the stall timeout
+        self.stall_timeout = None   # seconds, set from the cadence of the first frames
+        self._gap_start = None   # time.time() of the last message before a reconnect
+
+    def add_sink(self, sink, threaded=False, queue_depth=64):
+        """Registers a sink (see KiwiSink) which receives every decoded block
+        of this connection in addition to the _process_*_samples methods.
+        Returns its SinkHandle."""
+        handle = SinkHandle(sink, threaded, queue_depth)
+        self._sinks.append(handle)
+        return handle
+
+    def remove_sink(self, sink):
+        for handle in self._sinks:
+            if handle.sink is sink:
+                self._sinks.remove(handle)
+                handle.close()
+                return
+
+    def shutdown(self):
+        """Finishes the processing of the received data, before
+        close_sinks(): the ReceivePipeline works through its queue and stops,
+        then the partial W/F batch is decoded.  Logs the keepalive stats."""
+        if self._pipeline is not None:
+            self._pipeline.stop()
+            self._pipeline = None
+        self._flush_wf_batch()
+        logging.info("keepalive: %d sent, %d skipped (upstream frames and sendall calls saved)",
+                     self._keepalive_sent, self._keepalive_skipped)
+
+    def close_sinks(self):
+        """Closes and removes all sinks; close() keeps them for reconnecting."""
+        sinks, self._sinks = self._sinks, []
+        for handle in sinks:
+            handle.close()
+
+    def _fan_out(self, kind, seq, samples, *args):
+        view = None
+        copy = None
+        for handle in self._sinks:
+            method = handle.methods[kind]
+            if method is None:
+                continue
+            if handle.threaded:
+                # the samples may be views of buffers which are reused
+                if copy is None:
+                    copy = samples.copy()
+                    copy.flags.writeable = False
+                handle.put(method, (seq, copy) + args)
+            else:
+                if view is None:
+                    view = samples.view()
+                    view.flags.writeable = False
+                handle.call(method, (seq, view) + args)
 
     def connect(self, host, port):
+        self._pipeline_depth = getattr(self._options, 'pipeline_depth', self._pipeline_depth)
+        drop = getattr(self._options, 'pipeline_drop', None)
+        if drop is not None:
+            self._pipeline_policy = dict((tag, 'drop') for tag in drop.split(',') if tag)
+        self._keepalive_interval = getattr(self._options, 'keepalive_interval', self._keepalive_interval)
+        self._stall_frames = getattr(self._options, 'stall_frames', self._stall_frames)
+        self._reset_stall_watchdog()
         self._prepare_stream(host, port, 'W/F' if self._isWF else 'SND')
 
+    def _reset_stall_watchdog(self):
+        self.stall_timeout = None
+        # blocks received before a reconnect: the recording continues with a gap
+        self._gap_start = self._receive_time
+
     def set_mod(self, mod, lc, hc, freq):
         mod = mod.lower()
         self._modulation = mod
@@ -209,119 +721,242 @@ class KiwiSDRStream(KiwiSDRStreamBase):
         self._compression = comp;
         self._send_message('SET wf_comp=%d' % (1 if comp else 0))
 
+    def _set_decode_buffer(self, size):
+        """Decode compressed audio into a reusable ring buffer of size samples.
+
+        The samples passed to _process_audio_samples are then int16 views into
+        the ring buffer which are only valid until the callback returns, so
+        steady-state streaming allocates no sample buffers. size=0 turns this
+        off again.
+        """
+        if size:
+            self._decode_buffer = np.zeros(size, dtype=np.int16)
+            self._decode_view = memoryview(self._decode_buffer)
+        else:
+            self._decode_buffer = self._decode_view = None
+        self._decode_offset = 0
+
     def _set_wf_speed(self, wf_speed):
         self._send_message('SET wf_speed=%d' % wf_speed)
 
+    # MSG parameter handlers, called with the parameter value
+    _msg_handlers = {
+        'load_cfg':    '_on_msg_load_cfg',
+        'too_busy':    '_on_msg_too_busy',
+        'badp':        '_on_msg_badp',
+        'down':        '_on_msg_down',
+        'audio_rate':  '_on_msg_audio_rate',
+        'sample_rate': '_on_msg_sample_rate',
+        'wf_setup':    '_on_msg_wf_setup',
+        'version_maj': '_on_msg_version_maj',
+        'version_min': '_on_msg_version_min',
+    }
+
     def _process_msg_param(self, name, value):
-        if name == 'load_cfg':
-            logging.info("load_cfg: (cfg info not printed)")
-            d = json.loads(urllib.unquote(value.decode()))
-            self._gps_pos = [float(x) for x in urllib.unquote(d['rx_gps'])[1:-1].split(",")[0:2]]
-            print("GNSS position: lat,lon=[%+6.2f, %+7.2f]" % (self._gps_pos[0], self._gps_pos[1]))
-            self._on_gnss_position(self._gps_pos)
-        else:
+        if name != 'load_cfg':
             logging.debug("recv MSG (%s) %s: %s", self._stream_name, name, value)
-        # Handle error conditions
-        if name == 'too_busy':
-            raise KiwiTooBusyError('%s: all %s client slots taken' % (self._options.server_host, value))
-        if name == 'badp' and value == '1':
+        handler = self._msg_handlers.get(name)
+        if handler is not None:
+            getattr(self, handler)(value)
+
+    def _on_msg_load_cfg(self, value):
+        logging.info("load_cfg: (cfg info not printed)")
+        d = json.loads(urllib.unquote(value))
+        self._gps_pos = [float(x) for x in urllib.unquote(d['rx_gps'])[1:-1].split(",")[0:2]]
+        print("GNSS position: lat,lon=[%+6.2f, %+7.2f]" % (self._gps_pos[0], self._gps_pos[1]))
+        self._on_gnss_position(self._gps_pos)
+
+    # Handle error conditions
+    def _on_msg_too_busy(self, value):
+        raise KiwiTooBusyError('%s: all %s client slots taken' % (self._options.server_host, value))
+
+    def _on_msg_badp(self, value):
+        if value == '1':
             raise KiwiBadPasswordError('%s: bad password' % self._options.server_host)
-        if name == 'down':
-            raise KiwiDownError('%s: server is down atm' % self._options.server_host)
-        # Handle data items
-        if name == 'audio_rate':
-            self._set_ar_ok(int(value), 44100)
-        elif name == 'sample_rate':
-            self._sample_rate = float(value)
-            self._on_sample_rate_change()
-            # Optional, but is it?..
-            self.set_squelch(0, 0)
-            self.set_autonotch(0)
-            self._set_gen(0, 0)
-            # Required to get rolling
-            self._setup_rx_params()
-            # Also send a keepalive
-            self._set_keepalive()
-        elif name == 'wf_setup':
-            # Required to get rolling
-            self._setup_rx_params()
-            # Also send a keepalive
+
+    def _on_msg_down(self, value):
+        raise KiwiDownError('%s: server is down atm' % self._options.server_host)
+
+    # Handle data items
+    def _on_msg_audio_rate(self, value):
+        self._set_ar_ok(int(value), 44100)
+
+    def _on_msg_sample_rate(self, value):
+        self._sample_rate = float(value)
+        self._on_sample_rate_change()
+        # Optional, but is it?..
+        self.set_squelch(0, 0)
+        self.set_autonotch(0)
+        self._set_gen(0, 0)
+        # Required to get rolling
+        self._setup_rx_params()
+        # Also send a keepalive
+        self._set_keepalive()
+
+    def _on_msg_wf_setup(self, value):
+        # Required to get rolling
+        self._setup_rx_params()
+        # Also send a keepalive
+        self._set_keepalive()
+
+    def _on_msg_version_maj(self, value):
+        self._version_major = value
+        if self._version_major is not None and self._version_minor is not None:
+            logging.info("Server version: %s.%s", self._version_major, self._version_minor)
+
+    def _on_msg_version_min(self, value):
+        self._version_minor = value
+        if self._version_major is not None and self._version_minor is not None:
+            logging.info("Server version: %s.%s", self._version_major, self._version_minor)
+
+    def _set_keepalive(self):
+        self._send_message('SET keepalive')
+        self._keepalive_due = _monotonic() + self._keepalive_interval
+        self._keepalive_sent += 1
+
+    def _keepalive_tick(self):
+        """Sends a keepalive if the last one is more than _keepalive_interval
+        seconds ago; each skipped one saves an upstream frame and a syscall."""
+        if _monotonic() >= self._keepalive_due:
             self._set_keepalive()
-        elif name == 'version_maj':
-            self._version_major = value
-            if self._version_major is not None and self._version_minor is not None:
-                logging.info("Server version: %s.%s", self._version_major, self._version_minor)
-        elif name == 'version_min':
-            self._version_minor = value
-            if self._version_major is not None and self._version_minor is not None:
-                logging.info("Server version: %s.%s", self._version_major, self._version_minor)
+        else:
+            self._keepalive_skipped += 1
 
     def _process_message(self, tag, body):
         if tag == 'MSG':
             self._process_msg(body)
         elif tag == 'SND':
+            if self._first_sample_pending:
+                self._on_first_frame(tag, body)
             try:
                 self._process_aud(body)
             except Exception as e:
                 print(e)
             # Ensure we don't get kicked due to timeouts
-            self._set_keepalive()
+            self._keepalive_tick()
         elif tag == 'W/F':
+            if self._first_sample_pending:
+                self._on_first_frame(tag, body)
             self._process_wf(body)
             # Ensure we don't get kicked due to timeouts
-            self._set_keepalive()
+            self._keepalive_tick()
         else:
             print("unknown tag %s" % tag)
             pass
 
+    def _on_first_frame(self, tag, body):
+        self._on_first_sample()
+        if tag == 'SND':
+            self._decoder.__init__()   # the Kiwi starts each connection from the initial state
+        period = self._frame_period(tag, body)
+        if self._stall_frames > 0 and period:
+            self.stall_timeout = max(self._stall_min, self._stall_frames * period)
+            self._set_stall_timeout(self.stall_timeout)
+        if self._gap_start is not None:
+            self._on_stream_gap(self._gap_start, self._receive_time)
+            self._gap_start = None
+
+    def _frame_period(self, tag, body):
+        """Expected seconds between frames, from the block size of the
+        first frame and the sample rate."""
+        if tag == 'W/F':
+            return 1.0   # wf_speed=1
+        if not self._sample_rate:
+            return None
+        if self._modulation == 'iq':
+            nsamples = len(kiwicodec.parse_iq(body).samples) // 2
+        else:
+            data = kiwicodec.parse_snd(body).data
+            nsamples = 2*len(data) if self._compression else len(data)//2
+        return nsamples / float(self._sample_rate)
+
+    def _set_stall_timeout(self, timeout):
+        self._socket.settimeout(timeout)
+
+    def _on_stream_gap(self, t_from, t_to):
+        """Called with the time.time() of the last message before a
+        reconnect and of the first block after it."""
+        logging.warning("%s: gap of %.3fs in the stream", self._stream_name, t_to - t_from)
+
     def _process_msg(self, body):
-        for pair in body.split(b' '):
-            if b'=' in pair:
-                name, value = pair.split(b'=', 1)
-                self._process_msg_param(name.decode(), value)
-            else:
-                name = pair
-                self._process_msg_param(name.decode(), None)
+        for name, value in kiwicodec.parse_msg(body):
+            self._process_msg_param(name, value)
 
     def _process_aud(self, body):
-        seq = struct.unpack('<I', buffer(body[0:4]))[0]
-        smeter = struct.unpack('>H', buffer(body[4:6]))[0]
-        data = body[6:]
-        rssi = (smeter & 0x0FFF) // 10 - 127
         if self._modulation == 'iq':
-            gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], struct.unpack('<BBII', buffer(data[0:10]))))
-            data = data[10:]
-            count = len(data) // 2
-            samples = np.ndarray(count, dtype='>h', buffer=data).astype(np.float32)
-            cs      = np.ndarray(count//2, dtype=np.complex64)
-            cs.real = samples[0:count:2]
-            cs.imag = samples[1:count:2]
-            self._process_iq_samples(seq, cs, rssi, gps)
+            frame = kiwicodec.parse_iq(body)
+            if self._sinks:
+                # converted once, for the sinks and _process_iq_raw()
+                iq = frame.samples.astype(np.float32).view(np.complex64)
+                self._fan_out('iq', frame.seq, iq, frame.rssi, frame.gps)
+                self._iq_converted = (frame.samples, iq)
+            try:
+                self._process_iq_raw(frame.seq, frame.samples, frame.rssi, frame.gps)
+            finally:
+                self._iq_converted = None
+            return
+        frame = kiwicodec.parse_snd(body)
+        data = frame.data
+        if self._compression and self._adpcm_passthrough:
+            self._process_audio_adpcm(frame.seq, data, frame.rssi)
+            return
+        if self._compression and self._decode_buffer is not None:
+            start = self._decode_offset
+            if start + 2*len(data) > len(self._decode_buffer):
+                start = 0
+            end = self._decoder.decode_into(data, self._decode_view, start)
+            self._decode_offset = end
+            samples = self._decode_buffer[start:end]
+        elif self._compression:
+            samples = self._decoder.decode(data)
         else:
-            if self._compression:
-                samples = self._decoder.decode(data)
-            else:
-                count = len(data) // 2
-                samples = np.ndarray(count, dtype='>h', buffer=data).astype(np.int16)
-            self._process_audio_samples(seq, samples, rssi)
+            samples = np.frombuffer(data, dtype='>h', count=len(data)//2).astype(np.int16)
+        if self._sinks:
+            self._fan_out('audio', frame.seq, samples, frame.rssi)
+        self._process_audio_samples(frame.seq, samples, frame.rssi)
 
     def _process_wf(self, body):
-        x_bin_server = struct.unpack('<I', buffer(body[0:4]))[0]
-        flags_x_zoom_server = struct.unpack('<I', buffer(body[4:8]))[0]
-        seq = struct.unpack('<I', buffer(body[8:12]))[0]
-        data = body[12:]
+        frame = kiwicodec.parse_wf(body)
+        seq = frame.seq
+        data = frame.data
         #print "W/F seq %d len %d" % (seq, len(data))
         if self._compression:
+            if self._wf_batch_size > 1:
+                self._queue_wf_line(seq, data)
+                return
             self._decoder.__init__()   # reset decoder each sample
             samples = self._decoder.decode(data)
             samples = samples[:len(samples)-10]   # remove decompression tail
+            if self._wf_samples_db:
+                samples -= 255
+        elif self._wf_samples_db:
+            samples = kiwicodec.wf_db(data)
         else:
-            fcn = ord if isinstance(data, str) else lambda x : x
-            samples = array.array('h')
-            for b in map(fcn, data):
-                samples.append(b)
+            samples = np.frombuffer(data, dtype=np.uint8)
+        if self._sinks:
+            self._fan_out('waterfall', seq, samples)
         self._process_waterfall_samples(seq, samples)
 
+    def _queue_wf_line(self, seq, data):
+        if self._wf_batch and len(data) != len(self._wf_batch[0][1]):
+            self._flush_wf_batch()   # e.g. zoom change
+        self._wf_batch.append((seq, bytes(data)))
+        if len(self._wf_batch) >= self._wf_batch_size:
+            self._flush_wf_batch()
+
+    def _flush_wf_batch(self):
+        if not self._wf_batch:
+            return
+        batch, self._wf_batch = self._wf_batch, []
+        samples = decode_waterfall_lines([data for seq,data in batch])
+        if self._wf_samples_db:
+            samples -= 255
+        seqs = [seq for seq,data in batch]
+        if self._sinks:
+            for seq, row in zip(seqs, samples):
+                self._fan_out('waterfall', seq, row)
+        self._process_waterfall_batch(seqs, samples)
+
     def _on_gnss_position(self, position):
         pass
 
@@ -331,12 +966,35 @@ class KiwiSDRStream(KiwiSDRStreamBase):
     def _process_audio_samples(self, seq, samples, rssi):
         pass
 
+    def _process_audio_adpcm(self, seq, data, rssi):
+        """Compressed audio as received, instead of _process_audio_samples
+        when _adpcm_passthrough is set: IMA ADPCM data, only valid until
+        this method returns.  The decoder state carries over from frame to
+        frame and starts from 0 with each connection."""
+        pass
+
     def _process_iq_samples(self, seq, samples, rssi, gps):
         pass
 
+    def _process_iq_raw(self, seq, samples, rssi, gps):
+        """IQ samples as received: a zero-copy big-endian int16 view of
+        interleaved I,Q values, only valid until this method returns.
+        Converts them to complex64 for _process_iq_samples by default."""
+        converted = self._iq_converted
+        if converted is not None and converted[0] is samples:
+            iq = converted[1]   # already converted for the sinks
+        else:
+            iq = samples.astype(np.float32).view(np.complex64)
+        self._process_iq_samples(seq, iq, rssi, gps)
+
     def _process_waterfall_samples(self, seq, samples):
         pass
 
+    def _process_waterfall_batch(self, seqs, samples):
+        """Called with a (N, bins) int16 array when _wf_batch_size > 1."""
+        for seq, row in zip(seqs, samples):
+            self._process_waterfall_samples(seq, row)
+
     def _setup_rx_params(self):
         if self._isWF:
             self._set_zoom_start(0, 0)
@@ -347,19 +1005,65 @@ class KiwiSDRStream(KiwiSDRStreamBase):
             self._set_agc(True)
 
     def open(self):
-        self._set_auth('kiwi', self._options.password)
+        self._stream.hold_writes()
+        try:
+            self._set_auth('kiwi', self._options.password)
+        finally:
+            self._stream.flush_writes()
 
     def close(self):
+        self.shutdown()   # queued messages may still send keepalives
         try:
             self._stream.close_connection()
             self._socket.close()
         except Exception as e:
             print("exception: %s" % e)
 
+    def abort(self):
+        """Closes the socket of a broken connection, without the closing
+        handshake of close(), before reconnecting."""
+        if self._socket is not None:
+            self._socket.close()
+
+    def _process_received(self, received, receive_time):
+        self._receive_time = receive_time
+        # send the commands issued while processing a message in one write
+        self._stream.hold_writes()
+        try:
+            self._process_ws_message(received)
+        finally:
+            self._stream.flush_writes()
+
     def run(self):
         """Run the client."""
-        received = self._stream.receive_message()
-        self._process_ws_message(received)
+        try:
+            received = self._stream.receive_message()
+        except Exception as e:
+            if self.stall_timeout is None or not _is_timeout(e):
+                raise
+            self._socket.close()
+            raise KiwiStallError('%s: no data for %.1fs' % (self._stream_name, self.stall_timeout))
+        if received is None:
+            if self._pipeline is not None:
+                # the reason may still be in the decode thread, e.g. a
+                # KiwiBadPasswordError: it takes precedence
+                pipeline, self._pipeline = self._pipeline, None
+                pipeline.stop()
+                if pipeline.error is not None:
+                    raise pipeline.error
+            raise ConnectionTerminatedException('server closed the connection')
+        if self._pipeline_depth > 0:
+            if self._pipeline is None:
+                self._pipeline = ReceivePipeline(self._process_received, self._pipeline_depth, self._pipeline_policy)
+            try:
+                self._pipeline.put(received)
+            except Exception:
+                # the decode thread has stopped, start a new one next time
+                self._pipeline.stop()   # logs the error and the lost messages
+                self._pipeline = None
+                raise
+        else:
+            self._process_received(received, time.time())
         tlimit = self._options.tlimit
         if tlimit != None and self._start_time != None and time.time() - self._start_time > tlimit:
             raise KiwiTimeLimitError('time limit reached')
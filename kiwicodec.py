@@ -0,0 +1,139 @@
+## -*- python -*-
+
+"""
+KiwiSDR protocol codec: parsing of SND, W/F and MSG websocket messages.
+
+The parsers work on any buffer (bytes, bytearray, memoryview) and need no
+socket, so replay tools, simulators and benchmarks can drive them directly.
+Payloads are returned as memoryviews or NumPy views of the message, which
+are only valid as long as the underlying buffer is.
+"""
+
+import struct
+import numpy as np
+
+# precompiled frame header parsers, applied with unpack_from at fixed offsets
+_SND_SEQ = struct.Struct('<I')     # SND seq
+_SMETER = struct.Struct('>H')      # SND S-meter
+_GPS = struct.Struct('<BBII')      # IQ GNSS timestamp
+_WF_HEADER = struct.Struct('<III') # W/F x_bin_server, flags_x_zoom_server, seq
+
+SND_HEADER_SIZE = 6
+IQ_HEADER_SIZE = SND_HEADER_SIZE + _GPS.size
+WF_HEADER_SIZE = _WF_HEADER.size
+
+class KiwiCodecError(Exception):
+    pass
+
+class GpsTime(object):
+    """GNSS timestamp of an IQ frame.
+
+    Also supports gps['gpssec'] style access, so it can be used wherever the
+    former gps dict was expected.
+    """
+    __slots__ = ('last_gps_solution', 'dummy', 'gpssec', 'gpsnsec')
+
+    def __init__(self, last_gps_solution=0, dummy=0, gpssec=0, gpsnsec=0):
+        self.last_gps_solution = last_gps_solution
+        self.dummy = dummy
+        self.gpssec = gpssec
+        self.gpsnsec = gpsnsec
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return 'GpsTime(last_gps_solution=%d, gpssec=%d, gpsnsec=%d)' % (self.last_gps_solution, self.gpssec, self.gpsnsec)
+
+class SndFrame(object):
+    """Audio frame: data is the (compressed or big-endian int16) payload."""
+    __slots__ = ('seq', 'smeter', 'rssi', 'data')
+
+    def __init__(self, seq, smeter, data):
+        self.seq = seq
+        self.smeter = smeter
+        self.rssi = (smeter & 0x0FFF) // 10 - 127
+        self.data = data
+
+class IqFrame(object):
+    """IQ frame: samples is a big-endian int16 view of interleaved I,Q values."""
+    __slots__ = ('seq', 'smeter', 'rssi', 'gps', 'samples')
+
+    def __init__(self, seq, smeter, gps, samples):
+        self.seq = seq
+        self.smeter = smeter
+        self.rssi = (smeter & 0x0FFF) // 10 - 127
+        self.gps = gps
+        self.samples = samples
+
+class WfFrame(object):
+    """Waterfall frame: data is the (compressed or uint8) payload."""
+    __slots__ = ('x_bin_server', 'flags_x_zoom_server', 'seq', 'data')
+
+    def __init__(self, x_bin_server, flags_x_zoom_server, seq, data):
+        self.x_bin_server = x_bin_server
+        self.flags_x_zoom_server = flags_x_zoom_server
+        self.seq = seq
+        self.data = data
+
+class MsgParams(object):
+    """name=value pairs of a MSG message; value is None for a bare name."""
+    __slots__ = ('params',)
+
+    def __init__(self, params):
+        self.params = params
+
+    def __iter__(self):
+        return iter(self.params)
+
+    def __len__(self):
+        return len(self.params)
+
+def split_message(message):
+    """Splits a websocket message into its 3 character tag and a memoryview of the body."""
+    message = memoryview(message)
+    return message[0:3].tobytes().decode(), message[4:]
+
+def parse_snd(body):
+    """Parses the body of an audio SND message."""
+    seq = _SND_SEQ.unpack_from(body, 0)[0]
+    smeter = _SMETER.unpack_from(body, 4)[0]
+    return SndFrame(seq, smeter, memoryview(body)[SND_HEADER_SIZE:])
+
+def parse_iq(body):
+    """Parses the body of a SND message in IQ mode."""
+    if len(body) < IQ_HEADER_SIZE:
+        raise KiwiCodecError('IQ frame too short: %d bytes' % len(body))
+    seq = _SND_SEQ.unpack_from(body, 0)[0]
+    smeter = _SMETER.unpack_from(body, 4)[0]
+    gps = GpsTime(*_GPS.unpack_from(body, SND_HEADER_SIZE))
+    count = (len(body) - IQ_HEADER_SIZE) // 4
+    samples = np.frombuffer(body, dtype='>h', count=2*count, offset=IQ_HEADER_SIZE)
+    return IqFrame(seq, smeter, gps, samples)
+
+def parse_wf(body):
+    """Parses the body of a W/F message."""
+    x_bin_server, flags_x_zoom_server, seq = _WF_HEADER.unpack_from(body, 0)
+    return WfFrame(x_bin_server, flags_x_zoom_server, seq, memoryview(body)[WF_HEADER_SIZE:])
+
+def wf_db(data):
+    """Uncompressed waterfall bytes as dBm (int16, byte - 255); byte 0 is -255 dBm."""
+    return np.subtract(np.frombuffer(data, dtype=np.uint8), 255, dtype=np.int16)
+
+def parse_msg(body):
+    """Parses the body of a MSG message into MsgParams with str names and values."""
+    if not isinstance(body, bytes):
+        body = memoryview(body).tobytes()
+    params = []
+    for pair in body.split(b' '):
+        if b'=' in pair:
+            name, value = pair.split(b'=', 1)
+            params.append((name.decode(), value.decode('utf-8', 'replace')))
+        else:
+            params.append((pair.decode(), None))
+    return MsgParams(params)
+
+# EOF
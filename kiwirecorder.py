@@ -1,31 +1,29 @@
 #!/usr/bin/env python
 ## -*- python -*-
 
-import array, codecs, logging, os, struct, sys, time, traceback, copy, threading, os
+import array, codecs, logging, os, sys, time, traceback, copy, threading, os
 from optparse import OptionParser
+import numpy as np
 
 import kiwiclient
-from kiwiworker import KiwiWorker
-
-def _write_wav_header(fp, filesize, samplerate, num_channels, is_kiwi_wav):
-    fp.write(struct.pack('<4sI4s', b'RIFF', filesize - 8, b'WAVE'))
-    bits_per_sample = 16
-    byte_rate       = samplerate * num_channels * bits_per_sample // 8
-    block_align     = num_channels * bits_per_sample // 8
-    fp.write(struct.pack('<4sIHHIIHH', b'fmt ', 16, 1, num_channels, int(samplerate+0.5), byte_rate, block_align, bits_per_sample))
-    if not is_kiwi_wav:
-        fp.write(struct.pack('<4sI', b'data', filesize - 12 - 8 - 16 - 8))
+import kiwicodec
+import kiwiwav
+from kiwiworker import ConnectScheduler, KiwiWorker
 
 class KiwiSoundRecorder(kiwiclient.KiwiSDRStream):
-    def __init__(self, options):
+    def __init__(self, options, writer=None):
         super(KiwiSoundRecorder, self).__init__()
         self._options = options
+        self._writer = writer   # kiwiwav.WriterThread, None: write in the receive thread
         self._isWF = False
         freq = options.frequency
         #print "%s:%s freq=%d" % (options.server_host, options.server_port, freq)
         self._freq = freq
         self._start_ts = None
         self._start_time = None
+        self._wav = None   # kiwiwav.WavWriter of the current file
+        self._sinks_closed = False
+        self._rotate_at = None   # time.time() when to start the next file
         self._squelch_on_seq = None
         self._nf_array = array.array('i')
         for x in range(65):
@@ -33,7 +31,14 @@ class KiwiSoundRecorder(kiwiclient.KiwiSDRStream):
         self._nf_samples = 0
         self._nf_index = 0
         self._num_channels = 2 if options.modulation == 'iq' else 1
-        self._last_gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], [0,0,0,0]))
+        self._last_gps = kiwicodec.GpsTime()
+        # samples are written out before the next block is decoded
+        self._set_decode_buffer(1 << 16)
+        # --adpcm: write the compressed audio as received
+        self._adpcm_passthrough = (getattr(options, 'adpcm', False) and options.compression
+                                   and options.modulation != 'iq')
+        self._adpcm_state = kiwiclient.ImaAdpcmFastDecoder()   # of the stream, kept across files
+        self._adpcm_reset = False
 
     def _setup_rx_params(self):
         self.set_name(self._options.user)
@@ -53,6 +58,27 @@ class KiwiSoundRecorder(kiwiclient.KiwiSDRStream):
         self.set_inactivity_timeout(0)
 
     def _process_audio_samples(self, seq, samples, rssi):
+        if self._squelch(seq, rssi):
+            self._write_samples(samples, {})
+
+    def _process_audio_adpcm(self, seq, data, rssi):
+        # the stream's state, kept here for every frame: the writer gets the
+        # state before each block and sees gaps (squelch, dropped blocks) from it
+        state = self._adpcm_state
+        if self._adpcm_reset:
+            self._adpcm_reset = False
+            state.__init__()
+        start = (state.prev, state.index)
+        state.advance(data)
+        if self._squelch(seq, rssi):
+            self._write_samples(np.frombuffer(data, dtype=np.uint8), start)
+
+    def _on_first_frame(self, tag, body):
+        super(KiwiSoundRecorder, self)._on_first_frame(tag, body)
+        self._adpcm_reset = True
+
+    def _squelch(self, seq, rssi):
+        """Shows the block status; False when the block is not recorded."""
         if self._options.quiet is False:
           sys.stdout.write('\rBlock: %08x, RSSI: %-04d' % (seq, rssi))
           sys.stdout.flush()
@@ -64,7 +90,7 @@ class KiwiSoundRecorder(kiwiclient.KiwiSDRStream):
                     self._nf_index = 0
             if self._nf_samples < len(self._nf_array):
                 self._nf_samples += 1
-                return
+                return False
 
             median_nf = sorted(self._nf_array)[len(self._nf_array) // 3]
             rssi_thresh = median_nf + self._options.thresh
@@ -78,29 +104,29 @@ class KiwiSoundRecorder(kiwiclient.KiwiSDRStream):
             if self._options.quiet is False:
                 sys.stdout.write(' Median: %-04d Thr: %-04d %s' % (median_nf, rssi_thresh, ("s", "S")[is_open]))
             if not is_open:
-                return
+                return False
             if seq > self._squelch_on_seq + 45:
                 print("\nSquelch closed")
                 self._squelch_on_seq = None
-                self._start_ts = None
-                self._start_time = None
-                return
-        self._write_samples(samples, {})
+                self._close_file()
+                return False
+        return True
 
-    def _process_iq_samples(self, seq, samples, rssi, gps):
-        ##print gps['gpsnsec']-self._last_gps['gpsnsec']
+    def _process_iq_raw(self, seq, samples, rssi, gps):
         self._last_gps = gps
-        ## convert list of complex numbers into an array
-        s = array.array('h')
-        for x in [[y.real, y.imag] for y in samples]:
-            s.extend(map(int, x))
-        self._write_samples(s, gps)
-        
+        ## byteswap the big-endian I,Q pairs once and write them out
+        self._write_samples(samples.astype('<i2'), gps)
+
         # no GPS or no recent GPS solution
         last = gps['last_gps_solution']
         if last == 255 or last == 254:
             self._options.status = 3
 
+    def _on_stream_gap(self, t_from, t_to):
+        super(KiwiSoundRecorder, self)._on_stream_gap(t_from, t_to)
+        if self._wav is not None:
+            self._wav.write_gap(t_from, t_to)
+
     def _get_output_filename(self):
         station = '' if self._options.station is None else '_'+ self._options.station
         if self._options.filename != '':
@@ -112,39 +138,65 @@ class KiwiSoundRecorder(kiwiclient.KiwiSDRStream):
             filename = '%s/%s' % (self._options.dir, filename)
         return filename
 
-    def _update_wav_header(self):
-        with open(self._get_output_filename(), 'r+b') as fp:
-            fp.seek(0, os.SEEK_END)
-            filesize = fp.tell()
-            fp.seek(0, os.SEEK_SET)
-            _write_wav_header(fp, filesize, int(self._sample_rate), self._num_channels, self._options.is_kiwi_wav)
+    def _next_rotation(self, now):
+        """time.time() of the next multiple of --dt-sec seconds since 00:00 UTC."""
+        dt = self._options.dt
+        if self._options.filename != '' or dt == 0:
+            return float('inf')
+        day = now - now % 86400
+        return day + min((int(now - day) // dt + 1) * dt, 86400)
+
+    def _open_file(self):
+        if self._wav is not None:
+            self._wav.close()
+        now = time.time()
+        self._start_ts = time.gmtime(now)
+        if self._start_time is None:
+            self._start_time = now   # --tlimit counts across file rotations
+        self._rotate_at = self._next_rotation(now)
+        filename = self._get_output_filename()
+        kwargs = {'header_interval': self._options.header_interval}
+        wav_class = kiwiwav.WavWriter
+        if self._adpcm_passthrough:
+            wav_class = kiwiwav.AdpcmWavWriter
+        if self._writer is not None:
+            self._wav = kiwiwav.QueuedWavWriter(self._writer, filename, self._sample_rate, self._num_channels,
+                                                self._options.is_kiwi_wav, wav_class=wav_class, **kwargs)
+        else:
+            self._wav = wav_class(filename, self._sample_rate, self._num_channels,
+                                  self._options.is_kiwi_wav, **kwargs)
+        if self._options.is_kiwi_tdoa:
+            print("file=%d %s" % (self._options.idx, self._wav.filename))
+        else:
+            print("\nStarted a new file: %s" % self._wav.filename)
+
+    def _close_file(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+        self._start_ts = None
+        self._start_time = None
+
+    def close_sinks(self):
+        super(KiwiSoundRecorder, self).close_sinks()
+        self._close_file()
+        self._sinks_closed = True
 
     def _write_samples(self, samples, *args):
         """Output to a file on the disk."""
-        now = time.gmtime()
-        sec_of_day = lambda x: 3600*x.tm_hour + 60*x.tm_min + x.tm_sec
-        if self._start_ts is None or (self._options.filename == '' and
-                                      self._options.dt != 0 and
-                                      sec_of_day(now)/self._options.dt != sec_of_day(self._start_ts)/self._options.dt):
-            self._start_ts = now
-            self._start_time = time.time()
-            # Write a static WAV header
-            with open(self._get_output_filename(), 'wb') as fp:
-                _write_wav_header(fp, 100, int(self._sample_rate), self._num_channels, self._options.is_kiwi_wav)
-            if self._options.is_kiwi_tdoa:
-                print("file=%d %s" % (self._options.idx, self._get_output_filename()))
-            else:
-                print("\nStarted a new file: %s" % self._get_output_filename())
-        with open(self._get_output_filename(), 'ab') as fp:
-            if self._options.is_kiwi_wav:
-                gps = args[0]
-                logging.info('%s: last_gps_solution=%d gpssec=(%d,%d)' % (self._get_output_filename(), gps['last_gps_solution'], gps['gpssec'], gps['gpsnsec']));
-                fp.write(struct.pack('<4sIBBII', b'kiwi', 10, gps['last_gps_solution'], 0, gps['gpssec'], gps['gpsnsec']))
-                sample_size = samples.itemsize * len(samples)
-                fp.write(struct.pack('<4sI', b'data', sample_size))
-            # TODO: something better than that
-            samples.tofile(fp)
-        self._update_wav_header()
+        if self._sinks_closed:
+            return   # the recording is finished, don't start another file
+        if self._wav is None or time.time() >= self._rotate_at:
+            self._open_file()
+        if self._options.is_kiwi_wav:
+            gps = args[0]
+            logging.info('%s: last_gps_solution=%d gpssec=(%d,%d)', self._wav.filename,
+                          gps['last_gps_solution'], gps['gpssec'], gps['gpsnsec'])
+            self._wav.write(samples, gps)
+        elif self._adpcm_passthrough:
+            self._wav.write(samples, args[0])   # ADPCM state before the samples
+        else:
+            self._wav.write(samples)
 
     def _on_gnss_position(self, pos):
         pos_record = False
@@ -170,10 +222,12 @@ class KiwiWaterfallRecorder(kiwiclient.KiwiSDRStream):
         super(KiwiWaterfallRecorder, self).__init__()
         self._options = options
         self._isWF = True
+        self._wf_batch_size = options.wf_batch
         freq = options.frequency
         #print "%s:%s freq=%d" % (options.server_host, options.server_port, freq)
         self._freq = freq
         self._start_ts = None
+        self._start_time = None
 
         # xxx
         self._squelch_on_seq = None
@@ -183,32 +237,25 @@ class KiwiWaterfallRecorder(kiwiclient.KiwiSDRStream):
         self._nf_samples = 0
         self._nf_index = 0
         self._num_channels = 2 if options.modulation == 'iq' else 1
-        self._last_gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], [0,0,0,0]))
+        self._last_gps = kiwicodec.GpsTime()
 
     def _setup_rx_params(self):
         self._set_zoom_start(0, 0)
         self._set_maxdb_mindb(-10, -110)    # needed, but values don't matter
-        #self._set_wf_comp(True)
-        self._set_wf_comp(False)
+        self._set_wf_comp(self._options.wf_comp)
         self._set_wf_speed(1)   # 1 Hz update
         self.set_inactivity_timeout(0)
         self.set_name(self._options.user)
 
     def _process_waterfall_samples(self, seq, samples):
+        if self._start_time is None:
+            self._start_time = time.time()   # for --tlimit
         nbins = len(samples)
         bins = nbins-1
-        max = -1
-        min = 256
-        bmax = bmin = 0
-        i = 0
-        for s in samples:
-            if s > max:
-                max = s
-                bmax = i
-            if s < min:
-                min = s
-                bmin = i
-            i += 1
+        bmax = int(np.argmax(samples))
+        bmin = int(np.argmin(samples))
+        max = int(samples[bmax])
+        min = int(samples[bmin])
         span = 30000
         print("wf samples %d bins %d..%d dB %.1f..%.1f kHz rbw %d kHz"
               % (nbins, min-255, max-255, span*bmin/bins, span*bmax/bins, span/bins))
@@ -237,7 +284,175 @@ def get_comma_separated_args(option, opt, value, parser, fn):
 def join_threads(snd, wf):
     [r._event.set() for r in snd]
     [r._event.set() for r in wf]
-    [t.join() for t in threading.enumerate() if t is not threading.currentThread()]
+    [t.join() for t in snd + wf]
+
+def writer_thread(gopt, options):
+    """A kiwiwav.WriterThread for the sound recorders, None for --writer-blocks=0."""
+    if gopt.writer_blocks <= 0 or (gopt.waterfall and not gopt.sound):
+        return None
+    return kiwiwav.WriterThread(nblocks=gopt.writer_blocks * len(options), policy=gopt.writer_policy)
+
+def stop_writer(writer):
+    if writer is not None:
+        writer.stop()
+        writer.report()
+
+def connect_scheduler(gopt):
+    return ConnectScheduler(max_concurrent=gopt.connect_concurrency,
+                            min_interval=gopt.launch_delay,
+                            backoff_max=gopt.backoff_max)
+
+def run_threads(gopt, options):
+    """Runs every recorder in its own KiwiWorker thread."""
+    run_event = threading.Event()
+    run_event.set()
+    scheduler = connect_scheduler(gopt)
+    writer = writer_thread(gopt, options)
+
+    snd_recorders = []
+    if not gopt.waterfall or (gopt.waterfall and gopt.sound):
+        for i,opt in enumerate(options):
+            snd_recorders.append(KiwiWorker(args=(KiwiSoundRecorder(opt, writer),opt,run_event), kwargs={'scheduler': scheduler}))
+
+    wf_recorders = []
+    if gopt.waterfall:
+        for i,opt in enumerate(options):
+            wf_recorders.append(KiwiWorker(args=(KiwiWaterfallRecorder(opt),opt,run_event), kwargs={'scheduler': scheduler}))
+
+    try:
+        # the scheduler spaces the connects to the same host
+        for i,r in enumerate(snd_recorders):
+            r.start()
+            logging.info("started sound recorder %d" % i)
+
+        for i,r in enumerate(wf_recorders):
+            r.start()
+            logging.info("started waterfall recorder %d" % i)
+
+        while run_event.is_set():
+            time.sleep(.1)
+        join_threads(snd_recorders, wf_recorders)
+    except KeyboardInterrupt:
+        run_event.clear()
+        join_threads(snd_recorders, wf_recorders)
+        print("KeyboardInterrupt: threads successfully closed")
+    except Exception as e:
+        traceback.print_exc()
+        run_event.clear()
+        join_threads(snd_recorders, wf_recorders)
+        print("Exception: threads successfully closed")
+    stop_writer(writer)
+    scheduler.report()
+
+def run_async(gopt, options):
+    """Runs all recorders as asyncio tasks in one thread and event loop."""
+    import asyncio
+    import kiwiasync
+
+    class AsyncKiwiSoundRecorder(kiwiasync.AsyncKiwiSDRStream, KiwiSoundRecorder):
+        pass
+
+    class AsyncKiwiWaterfallRecorder(kiwiasync.AsyncKiwiSDRStream, KiwiWaterfallRecorder):
+        pass
+
+    writer = writer_thread(gopt, options)
+    workers = []
+    if not gopt.waterfall or (gopt.waterfall and gopt.sound):
+        for i,opt in enumerate(options):
+            workers.append((AsyncKiwiSoundRecorder(opt, writer), opt))
+    if gopt.waterfall:
+        for i,opt in enumerate(options):
+            workers.append((AsyncKiwiWaterfallRecorder(opt), opt))
+
+    scheduler = connect_scheduler(gopt)
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(kiwiasync.run_all(workers, scheduler))
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        print("KeyboardInterrupt: tasks successfully closed")
+    finally:
+        loop.close()
+    stop_writer(writer)
+    scheduler.report()
+
+def _run_shard(shard, gopt, options, status_queue):
+    """Worker process of run_procs: runs its part of the recorders and
+    reports their status."""
+    if gopt.use_async:
+        run_async(gopt, options)
+    else:
+        run_threads(gopt, options)
+    status_queue.put((shard, [(opt.idx, opt.status) for opt in options]))
+
+def run_procs(gopt, options):
+    """Splits the recorders across gopt.procs worker processes; restarts
+    shards which crash and collects the status of all recorders."""
+    import multiprocessing
+    try:
+        from queue import Empty
+    except ImportError:
+        from Queue import Empty
+    nprocs = min(gopt.procs, len(options))
+    # contiguous shards keep recorders of the same host together, see launch_delay
+    bounds = [len(options) * i // nprocs for i in range(nprocs + 1)]
+    shards = [options[bounds[i]:bounds[i+1]] for i in range(nprocs)]
+    status_queue = multiprocessing.Queue()
+
+    def start(shard):
+        p = multiprocessing.Process(target=_run_shard, args=(shard, gopt, shards[shard], status_queue),
+                                    name='kiwirecorder-shard-%d' % shard)
+        p.start()
+        logging.info("started shard %d (pid %d): recorders %d..%d" % (shard, p.pid, bounds[shard], bounds[shard+1]-1))
+        return p
+
+    procs = [start(i) for i in range(nprocs)]
+    restarts = [0] * nprocs
+    status = {}
+    try:
+        while any(p is not None for p in procs):
+            try:
+                shard, results = status_queue.get(timeout=0.5)
+                status[shard] = results
+                logging.info("shard %d done: %s" % (shard, ' '.join('%d:%d' % r for r in results)))
+            except Empty:
+                pass
+            for i,p in enumerate(procs):
+                if p is None or p.is_alive():
+                    continue
+                p.join()
+                procs[i] = None
+                if p.exitcode != 0 and restarts[i] < gopt.procs_restarts:
+                    restarts[i] += 1
+                    logging.warning("shard %d exited with code %d, restart %d of %d"
+                                    % (i, p.exitcode, restarts[i], gopt.procs_restarts))
+                    time.sleep(1)
+                    procs[i] = start(i)
+                elif p.exitcode != 0:
+                    logging.error("shard %d exited with code %d, giving up" % (i, p.exitcode))
+    except KeyboardInterrupt:
+        # the shards get the SIGINT too and close their recorders
+        for p in procs:
+            if p is not None:
+                p.join()
+        # the statuses the shards reported while closing
+        while True:
+            try:
+                shard, results = status_queue.get(timeout=1)
+            except Empty:
+                break
+            status[shard] = results
+        print("KeyboardInterrupt: processes successfully closed")
+
+    # a shard which never reported failed
+    by_idx = dict((opt.idx, opt) for opt in options)
+    for i in range(nprocs):
+        for opt in shards[i]:
+            opt.status = 1
+        for idx, st in status.get(i, []):
+            by_idx[idx].status = st
 
 def main():
 ##    sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
@@ -255,6 +470,17 @@ def main():
     parser.add_option('-k', '--socket-timeout', '--socket_timeout',
                       dest='socket_timeout', type='int', default=10,
                       help='Timeout(sec) for sockets')
+    parser.add_option('--keepalive-interval',
+                      dest='keepalive_interval', type='float', default=1.0,
+                      help='Interval(sec) between keepalive messages sent to the server')
+    parser.add_option('--deflate',
+                      dest='permessage_deflate', default=False, action='store_true',
+                      help='Ask the server for permessage-deflate compression (saves bandwidth on '
+                      'waterfall data without --wf-comp and on MSG data, costs CPU)')
+    parser.add_option('--stall-frames',
+                      dest='stall_frames', type='int', default=8,
+                      help='Reconnect when no data arrived for this many frame periods (at least 1 sec), '
+                      'continuing the current file and noting the gap in FILE.gaps; 0 waits for the socket timeout')
     parser.add_option('-s', '--server-host',
                       dest='server_host', type='string',
                       default='localhost', help='Server host (can be a comma-delimited list)',
@@ -282,7 +508,15 @@ def main():
     parser.add_option('--launch-delay', '--launch_delay',
                       dest='launch_delay',
                       type='int', default=1,
-                      help='Delay (secs) in launching multiple connections')
+                      help='Minimum delay (secs) between connects to the same host')
+    parser.add_option('--connect-concurrency',
+                      dest='connect_concurrency',
+                      type='int', default=1,
+                      help='Connects to the same host in progress at the same time')
+    parser.add_option('--backoff-max',
+                      dest='backoff_max',
+                      type='float', default=120,
+                      help='Maximum delay (secs) before reconnecting after failures, which doubles from 2s with jitter')
     parser.add_option('-f', '--freq',
                       dest='frequency',
                       type='string', default=1000,
@@ -299,10 +533,31 @@ def main():
                       default=True,
                       action='store_false',
                       help='Don\'t use audio compression')
+    parser.add_option('--adpcm',
+                      dest='adpcm',
+                      default=False,
+                      action='store_true',
+                      help='Write the compressed audio as received, as IMA ADPCM .wav (not with --ncomp or IQ mode); '
+                      'python kiwiwav.py FILE.wav converts to 16 bit PCM')
     parser.add_option('--dt-sec',
                       dest='dt',
                       type='int', default=0,
                       help='Start a new file when mod(sec_of_day,dt) == 0')
+    parser.add_option('--writer-blocks',
+                      dest='writer_blocks',
+                      type='int', default=64,
+                      help='Buffers per recorder queued to the background file writer thread; '
+                      '0 writes files in the receiving threads')
+    parser.add_option('--writer-policy',
+                      dest='writer_policy', type='choice', default='block',
+                      choices=['block', 'drop'],
+                      help='When the disk cannot keep up: block receiving (default) or drop blocks, '
+                      'noting the gaps in FILE.wav.gaps')
+    parser.add_option('--header-interval',
+                      dest='header_interval',
+                      type='float', default=10.0,
+                      help='Interval(sec) between updates of the .wav header; '
+                      'data is written in large chunks in between')
     parser.add_option('-L', '--lp-cutoff',
                       dest='lp_cut',
                       type='float', default=100,
@@ -363,61 +618,63 @@ def main():
                       default=False,
                       action='store_true',
                       help='Process waterfall data instead of audio')
+    parser.add_option('--wf-comp', '--wf_comp',
+                      dest='wf_comp',
+                      default=False,
+                      action='store_true',
+                      help='Use waterfall compression')
+    parser.add_option('--wf-batch', '--wf_batch',
+                      dest='wf_batch',
+                      type='int', default=1,
+                      help='Decode compressed waterfall lines in batches of this many lines')
     parser.add_option('--snd',
                       dest='sound',
                       default=False,
                       action='store_true',
                       help='Also process sound data when in waterfall mode')
+    parser.add_option('--pipeline-depth',
+                      dest='pipeline_depth',
+                      type='int', default=0,
+                      help='Decode in a separate thread, fed by a queue of this many received messages (0: off)')
+    parser.add_option('--pipeline-drop',
+                      dest='pipeline_drop',
+                      type='string', default='W/F',
+                      help='Comma-separated message tags (SND, W/F) dropped instead of waited for when the pipeline queue is full')
+    parser.add_option('--procs',
+                      dest='procs',
+                      type='int', default=1,
+                      help='Split the receivers across this many worker processes')
+    parser.add_option('--procs-restarts',
+                      dest='procs_restarts',
+                      type='int', default=10,
+                      help='How often a crashed worker process is restarted (with --procs)')
+    parser.add_option('--async',
+                      dest='use_async',
+                      default=False,
+                      action='store_true',
+                      help='Run all receivers in one asyncio event loop instead of one thread each (python 3)')
 
     (options, unused_args) = parser.parse_args()
+    if options.use_async and options.pipeline_depth > 0:
+        parser.error('--pipeline-depth does not work with --async')
     
     logging.basicConfig(level=logging.getLevelName(options.log_level.upper()))
 
-    run_event = threading.Event()
-    run_event.set()
-
     gopt = options
     options = options_cross_product(options)
+    for i,opt in enumerate(options):
+        opt.idx = i
 
-    snd_recorders = []
-    if not gopt.waterfall or (gopt.waterfall and gopt.sound):
-        for i,opt in enumerate(options):
-            opt.idx = i
-            snd_recorders.append(KiwiWorker(args=(KiwiSoundRecorder(opt),opt,run_event)))
-
-    wf_recorders = []
-    if gopt.waterfall:
-        for i,opt in enumerate(options):
-            wf_recorders.append(KiwiWorker(args=(KiwiWaterfallRecorder(opt),opt,run_event)))
-
-    try:
-        for i,r in enumerate(snd_recorders):
-            if i!=0 and options[i-1].server_host == options[i].server_host:
-                time.sleep(opt.launch_delay)
-            r.start()
-            logging.info("started sound recorder %d" % i)
-
-        for i,r in enumerate(wf_recorders):
-            if i!=0 and options[i-1].server_host == options[i].server_host:
-                time.sleep(opt.launch_delay)
-            r.start()
-            logging.info("started waterfall recorder %d" % i)
-
-        while run_event.is_set():
-            time.sleep(.1)
-    except KeyboardInterrupt:
-        run_event.clear()
-        join_threads(snd_recorders, wf_recorders)
-        print("KeyboardInterrupt: threads successfully closed")
-    except Exception as e:
-        traceback.print_exc()
-        run_event.clear()
-        join_threads(snd_recorders, wf_recorders)
-        print("Exception: threads successfully closed")
+    if gopt.procs > 1:
+        run_procs(gopt, options)
+    elif gopt.use_async:
+        run_async(gopt, options)
+    else:
+        run_threads(gopt, options)
 
     if gopt.is_kiwi_tdoa:
-      for i,opt in enumerate(options):
-          print("status=%d,%d" % (i, opt.status))
+      for opt in options:
+          print("status=%d,%d" % (opt.idx, opt.status))
 
 if __name__ == '__main__':
     main()
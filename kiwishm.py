@@ -0,0 +1,196 @@
+## -*- python -*-
+
+"""
+Shared-memory ring buffer of audio or IQ blocks, for consumers in other
+processes (python 3.8+).
+
+The receiving process adds a RingWriter as a sink of its KiwiSDRStream,
+
+    writer = RingWriter('kiwi-7', dtype=np.complex64)
+    stream.add_sink(writer)
+
+which copies every block once into the ring, together with its Kiwi seq,
+RSSI and GNSS timestamp.  Any number of RingReaders attach by name and get
+the blocks as numpy views of the shared memory, without further copies:
+
+    reader = RingReader('kiwi-7')
+    while True:
+        block = reader.read(timeout=1)
+        ...use block.samples...
+        if not block.valid():
+            ...the writer has overwritten the block meanwhile...
+
+A reader falling more than nblocks behind skips ahead to the oldest block
+still in the ring and counts the blocks lost in reader.overruns.
+"""
+
+import multiprocessing
+import time
+import numpy as np
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+_MAGIC = 0x5257494b   # 'KIWR'
+
+_CTRL = np.dtype([('magic', '<u4'), ('version', '<u4'), ('dtype', 'S8'),
+                  ('nblocks', '<u4'), ('capacity', '<u4'), ('written', '<i8'),
+                  ('closed', '<u4'), ('pad', 'V28')])
+
+# block is the running block number, -1 while the slot is being written
+_SLOT = np.dtype([('block', '<i8'), ('seq', '<u4'), ('nsamples', '<u4'), ('rssi', '<f4'),
+                  ('last_gps_solution', '<u4'), ('gpssec', '<u4'), ('gpsnsec', '<u4')])
+
+class _Ring(object):
+    def _map(self, shm, dtype, nblocks, capacity):
+        self._shm = shm
+        buf = shm.buf
+        self._ctrl = np.ndarray((), dtype=_CTRL, buffer=buf)
+        self._slots = np.ndarray((nblocks,), dtype=_SLOT, buffer=buf, offset=_CTRL.itemsize)
+        self._data = np.ndarray((nblocks, capacity), dtype=dtype, buffer=buf,
+                                offset=_CTRL.itemsize + nblocks * _SLOT.itemsize)
+        self.dtype = np.dtype(dtype)
+        self.nblocks = nblocks
+        self.capacity = capacity
+
+    @staticmethod
+    def _size(dtype, nblocks, capacity):
+        return _CTRL.itemsize + nblocks * (_SLOT.itemsize + capacity * np.dtype(dtype).itemsize)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+class RingWriter(_Ring):
+    """Creates the ring; a KiwiSink for _process_audio_samples (dtype
+    int16) or _process_iq_samples (dtype complex64) blocks of up to capacity
+    samples."""
+
+    def __init__(self, name=None, dtype=np.int16, nblocks=256, capacity=2048):
+        shm = shared_memory.SharedMemory(name=name, create=True, size=self._size(dtype, nblocks, capacity))
+        self._map(shm, dtype, nblocks, capacity)
+        self._ctrl['magic'] = _MAGIC
+        self._ctrl['version'] = 1
+        self._ctrl['dtype'] = self.dtype.str.encode()
+        self._ctrl['nblocks'] = nblocks
+        self._ctrl['capacity'] = capacity
+        self._ctrl['written'] = 0
+        self._ctrl['closed'] = 0
+        self._slots['block'] = -1
+        self._written = 0
+
+    def write(self, seq, samples, rssi=0, gps=None):
+        n = len(samples)
+        if n > self.capacity:
+            raise ValueError('block of %d samples exceeds the ring capacity of %d' % (n, self.capacity))
+        block = self._written
+        i = block % self.nblocks
+        slot = self._slots[i:i+1]
+        slot['block'] = -1
+        self._data[i, :n] = samples
+        slot['seq'] = seq
+        slot['nsamples'] = n
+        slot['rssi'] = rssi
+        if gps is not None:
+            slot['last_gps_solution'] = gps['last_gps_solution']
+            slot['gpssec'] = gps['gpssec']
+            slot['gpsnsec'] = gps['gpsnsec']
+        slot['block'] = block
+        self._written = block + 1
+        self._ctrl['written'] = block + 1
+
+    def process_audio_samples(self, seq, samples, rssi):
+        if self.dtype == np.int16:
+            self.write(seq, samples, rssi)
+
+    def process_iq_samples(self, seq, samples, rssi, gps):
+        if self.dtype == np.complex64:
+            self.write(seq, samples, rssi, gps)
+
+    def close(self):
+        """Marks the ring closed for the readers and removes it."""
+        self._ctrl['closed'] = 1
+        del self._ctrl, self._slots, self._data
+        self._shm.close()
+        self._shm.unlink()
+
+class RingBlock(object):
+    """A block read from the ring; samples is a view of the shared memory."""
+    __slots__ = ('block', 'seq', 'rssi', 'gps', 'samples', '_slots', '_index')
+
+    def __init__(self, block, seq, rssi, gps, samples, slots, index):
+        self.block = block
+        self.seq = seq
+        self.rssi = rssi
+        self.gps = gps
+        self.samples = samples
+        self._slots = slots
+        self._index = index
+
+    def valid(self):
+        """False when the writer has started overwriting the block."""
+        return int(self._slots[self._index]['block']) == self.block
+
+class RingReader(_Ring):
+    """Attaches to a ring by name and reads its blocks in order, starting
+    with the next block written."""
+
+    poll_interval = 0.002
+
+    def __init__(self, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)   # python 3.13+
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            if multiprocessing.parent_process() is None:
+                # the writer owns the segment; processes not started by
+                # multiprocessing have their own resource tracker which
+                # would remove it at exit, see https://bugs.python.org/issue39959
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        ctrl = np.ndarray((), dtype=_CTRL, buffer=shm.buf)
+        if int(ctrl['magic']) != _MAGIC:
+            shm.close()
+            raise ValueError('%s is not a kiwi ring buffer' % name)
+        self._map(shm, np.dtype(ctrl['dtype'].item().decode()), int(ctrl['nblocks']), int(ctrl['capacity']))
+        self.next_block = int(self._ctrl['written'])
+        self.overruns = 0
+
+    def available(self):
+        return int(self._ctrl['written']) - self.next_block
+
+    def read(self, timeout=None):
+        """Returns the next RingBlock, waiting up to timeout seconds for it
+        (forever if None); None on timeout or when the writer has closed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            written = int(self._ctrl['written'])
+            if written <= self.next_block:
+                if self._ctrl['closed'] or (deadline is not None and time.monotonic() >= deadline):
+                    return None
+                time.sleep(self.poll_interval)
+                continue
+            if written - self.next_block > self.nblocks:
+                # skip to the oldest block which can still be complete
+                skip = written - self.nblocks + 1
+                self.overruns += skip - self.next_block
+                self.next_block = skip
+            block = self.next_block
+            i = block % self.nblocks
+            slot = self._slots[i]
+            self.next_block = block + 1
+            if int(slot['block']) == block:
+                break
+            # overwritten after reading written: try the next block
+            self.overruns += 1
+
+        gps = None
+        if self.dtype == np.complex64:
+            gps = dict(last_gps_solution=int(slot['last_gps_solution']),
+                       gpssec=int(slot['gpssec']), gpsnsec=int(slot['gpsnsec']))
+        return RingBlock(block, int(slot['seq']), float(slot['rssi']), gps,
+                         self._data[i, :int(slot['nsamples'])], self._slots, i)
+
+    def close(self):
+        del self._ctrl, self._slots, self._data
+        self._shm.close()
+
+# EOF
@@ -0,0 +1,463 @@
+## -*- python -*-
+
+"""
+.wav file writer for kiwirecorder.
+
+WavWriter keeps the file open and writes the sample blocks through a large
+buffer, instead of opening, appending to and closing the file and then
+rewriting its header for every block.  The RIFF and data chunk sizes are
+rewritten every header_interval seconds and on close(), so the header of a
+file cut short by a crash or power loss lags behind its data by at most
+that long.
+
+A kiwi .wav file also gets an index of its blocks: appended to FILE.idx
+with every header update, and written as a trailing 'kidx' chunk on
+close(), which then removes FILE.idx.  read_kiwi_iq_wav.KiwiIQWavReader
+uses it to seek to a GNSS time.
+
+With a WriterThread, QueuedWavWriter moves the file I/O of any number of
+files off the receive threads: they copy each block into a preallocated
+buffer and return.
+
+AdpcmWavWriter records compressed audio as received, as IMA ADPCM .wav;
+python kiwiwav.py FILE.wav ... converts such files to 16 bit PCM.
+"""
+
+import logging
+import optparse
+import os
+import struct
+import threading
+import time
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from kiwiclient import ImaAdpcmFastDecoder
+from kiwiclient import _monotonic
+from kiwiclient import _perf_counter
+from kiwiclient import decode_adpcm_blocks
+
+# per block of a kiwi .wav file: GNSS timestamp and the data chunk header
+_KIWI_CHUNK = struct.Struct('<4sIBBII4sI')
+
+# kiwi .wav block index entry: file offset of the 'kiwi' chunk, number of
+# samples before the block, GNSS timestamp; the 'kidx' chunk ends with
+# the number of entries and b'kidx' so it can be found from the file end
+_KIWI_INDEX_ENTRY = struct.Struct('<QQIIB3x')
+_KIWI_INDEX_FOOTER = struct.Struct('<I4s')
+
+# IMA ADPCM .wav: RIFF header, 'fmt ' with wSamplesPerBlock, 'fact', 'data'
+_ADPCM_HEADER = struct.Struct('<4sI4s4sIHHIIHHHH4sII4sI')
+_ADPCM_BLOCK_HEADER = struct.Struct('<hBB')
+WAVE_FORMAT_IMA_ADPCM = 0x11
+
+def write_wav_header(fp, filesize, samplerate, num_channels, is_kiwi_wav):
+    fp.write(struct.pack('<4sI4s', b'RIFF', filesize - 8, b'WAVE'))
+    bits_per_sample = 16
+    byte_rate       = samplerate * num_channels * bits_per_sample // 8
+    block_align     = num_channels * bits_per_sample // 8
+    fp.write(struct.pack('<4sIHHIIHH', b'fmt ', 16, 1, num_channels, int(samplerate+0.5), byte_rate, block_align, bits_per_sample))
+    if not is_kiwi_wav:
+        fp.write(struct.pack('<4sI', b'data', filesize - 12 - 8 - 16 - 8))
+
+def write_adpcm_wav_header(fp, filesize, samplerate, nsamples, block_align):
+    samples_per_block = 2*(block_align - 4) + 1
+    fp.write(_ADPCM_HEADER.pack(b'RIFF', filesize - 8, b'WAVE',
+                                b'fmt ', 20, WAVE_FORMAT_IMA_ADPCM, 1, int(samplerate+0.5),
+                                int(samplerate) * block_align // samples_per_block, block_align, 4, 2, samples_per_block,
+                                b'fact', 4, nsamples,
+                                b'data', filesize - _ADPCM_HEADER.size))
+
+def _utc(t):
+    return '%s.%03dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)), int(t % 1 * 1000))
+
+class WavWriter(object):
+    """16 bit PCM .wav file; with is_kiwi_wav every block gets a 'kiwi'
+    chunk with its GNSS timestamp and its own 'data' chunk, and the file
+    gets an index of the blocks."""
+
+    def __init__(self, filename, samplerate, num_channels, is_kiwi_wav=False,
+                 buffer_size=1 << 18, header_interval=10.0):
+        self.filename = filename
+        self._samplerate = int(samplerate)
+        self._num_channels = num_channels
+        self._is_kiwi_wav = is_kiwi_wav
+        self._header_interval = header_interval
+        self._fp = open(filename, 'wb', buffer_size)
+        self.size = 36 if is_kiwi_wav else 44   # bytes written, including the buffered ones
+        self._index = bytearray()   # _KIWI_INDEX_ENTRY per block
+        self._index_flushed = 0     # bytes of _index in FILE.idx
+        self._nsamples = 0
+        self.update_header()
+
+    def write(self, samples, gps=None):
+        """Appends an int16 array of samples, interleaved I,Q for IQ data."""
+        self.write_data(samples.data, samples.nbytes, gps)
+
+    def write_data(self, data, nbytes, gps=None):
+        if self._is_kiwi_wav:
+            self._index += _KIWI_INDEX_ENTRY.pack(self.size, self._nsamples, gps['gpssec'],
+                                                  gps['gpsnsec'], gps['last_gps_solution'])
+            self._nsamples += nbytes // (2 * self._num_channels)
+            self._fp.write(_KIWI_CHUNK.pack(b'kiwi', 10, gps['last_gps_solution'], 0,
+                                            gps['gpssec'], gps['gpsnsec'], b'data', nbytes))
+            self.size += _KIWI_CHUNK.size
+        self._fp.write(data)
+        self.size += nbytes
+        if _monotonic() >= self._header_due:
+            self.update_header()
+
+    def write_gap(self, t_from, t_to):
+        """Notes a gap in the recording in FILE.gaps: one line with the UTC
+        of the last block before and the first after it, its duration and
+        the file size where recording resumes."""
+        with open(self.filename + '.gaps', 'a') as fp:
+            fp.write('%s %s %.3f %d\n' % (_utc(t_from), _utc(t_to), t_to - t_from, self.size))
+
+    def update_header(self):
+        """Writes out the buffer and updates the chunk sizes."""
+        fp = self._fp
+        fp.flush()
+        fp.seek(0)
+        self._write_header(fp)
+        fp.seek(self.size)
+        self._header_due = _monotonic() + self._header_interval
+        if len(self._index) > self._index_flushed:
+            # the blocks are on disk: a crash leaves an index for them
+            with open(self.filename + '.idx', 'ab' if self._index_flushed else 'wb') as idx:
+                idx.write(self._index[self._index_flushed:])
+            self._index_flushed = len(self._index)
+
+    def _write_header(self, fp):
+        write_wav_header(fp, self.size, self._samplerate, self._num_channels, self._is_kiwi_wav)
+
+    def close(self):
+        if self._fp is None:
+            return
+        if self._index:
+            self._write_index()
+        self.update_header()
+        self._fp.close()
+        self._fp = None
+        if self._index_flushed:
+            os.remove(self.filename + '.idx')
+
+    def _write_index(self):
+        index = self._index
+        nentries = len(index) // _KIWI_INDEX_ENTRY.size
+        self._fp.write(struct.pack('<4sI', b'kidx', len(index) + _KIWI_INDEX_FOOTER.size))
+        self._fp.write(index)
+        self._fp.write(_KIWI_INDEX_FOOTER.pack(nentries, b'kidx'))
+        self.size += 8 + len(index) + _KIWI_INDEX_FOOTER.size
+        self._index = bytearray()   # in the file now, FILE.idx is not updated any more
+
+class AdpcmWavWriter(WavWriter):
+    """IMA ADPCM .wav file (format 0x11, mono) written from the compressed
+    audio as received, without decoding it.
+
+    The Kiwi sends one continuous ADPCM stream while every .wav block starts
+    with a header holding the decoder state, so the state is advanced over
+    the written data without decoding it.  The header also holds the
+    block's first sample: the nibbles are regrouped into blocks of
+    2*(block_align-4)+1 samples, so standard decoders play every sample
+    exactly once.  The 'fact' chunk has the number of samples.
+
+    Data not written (squelch, dropped blocks, a reconnect) is not passed
+    in: the caller keeps the stream's state and passes it with the data.
+    """
+
+    def __init__(self, filename, samplerate, num_channels=1, is_kiwi_wav=False,
+                 block_align=1024, buffer_size=1 << 18, header_interval=10.0):
+        if num_channels != 1 or is_kiwi_wav:
+            raise ValueError('IMA ADPCM .wav files are mono and not kiwi .wav')
+        self.filename = filename
+        self._samplerate = int(samplerate)
+        self._header_interval = header_interval
+        self._state = ImaAdpcmFastDecoder()
+        self._block_align = block_align
+        self._block = np.empty(2*(block_align - 4), dtype=np.uint8)   # nibbles of the next block
+        self._fill = 0
+        self._block_header = None
+        self.nsamples = 0   # in the written blocks
+        self._index = bytearray()   # no block index
+        self._index_flushed = 0
+        self._fp = open(filename, 'wb', buffer_size)
+        self.size = _ADPCM_HEADER.size
+        self.update_header()
+
+    def write(self, data, start=None):
+        """Appends a uint8 array of ADPCM data.  start is the (prev, index)
+        decoder state of the stream before data, None to continue from the
+        data written before."""
+        self.write_data(data.data, data.nbytes, start)
+
+    def write_data(self, data, nbytes, start=None):
+        state = self._state
+        if start is not None and start != (state.prev, state.index):
+            self._end_block(True)   # the stream went on without us: a gap
+            state.prev, state.index = start
+        packed = np.frombuffer(data, dtype=np.uint8, count=nbytes)
+        nibbles = np.empty(2*nbytes, dtype=np.uint8)
+        nibbles[0::2] = packed & 0x0F
+        nibbles[1::2] = packed >> 4
+        block = self._block
+        pos = 0
+        done = 0   # state is at this nibble
+        while pos < len(nibbles):
+            if self._block_header is None:
+                state.advance(data, done, pos + 1)
+                done = pos + 1
+                self._block_header = _ADPCM_BLOCK_HEADER.pack(state.prev, state.index, 0)
+                pos += 1
+                continue
+            n = min(len(nibbles) - pos, len(block) - self._fill)
+            block[self._fill:self._fill+n] = nibbles[pos:pos+n]
+            self._fill += n
+            pos += n
+            if self._fill == len(block):
+                self._write_block()
+        state.advance(data, done, len(nibbles))
+        if _monotonic() >= self._header_due:
+            self.update_header()
+
+    def _end_block(self, count_padding):
+        """Pads the partial block to its end; in a gap, the padding plays as
+        part of the gap."""
+        if self._block_header is None:
+            return
+        # pad with alternating +/- steps, which leave the level alone
+        self._block[self._fill::2] = 0
+        self._block[self._fill+1::2] = 8
+        n, self._fill = self._fill, len(self._block)
+        self._write_block()
+        if not count_padding:   # the last block: 'fact' cuts it short
+            self.nsamples -= len(self._block) - n
+
+    def _write_block(self):
+        block = self._block
+        self._fp.write(self._block_header)
+        self._fp.write((block[0::2] | (block[1::2] << 4)).tobytes())
+        self.size += self._block_align
+        self.nsamples += 1 + self._fill
+        self._fill = 0
+        self._block_header = None
+
+    def _write_header(self, fp):
+        write_adpcm_wav_header(fp, self.size, self._samplerate, self.nsamples, self._block_align)
+
+    def close(self):
+        if self._fp is None:
+            return
+        self._end_block(False)
+        super(AdpcmWavWriter, self).close()
+
+def read_adpcm_wav(filename, blocks_per_chunk=1024):
+    """Reads an IMA ADPCM .wav file as written by AdpcmWavWriter (or any
+    mono one); returns the sample rate and an int16 array of samples."""
+    with open(filename, 'rb') as fp:
+        riff, size, wave = struct.unpack('<4sI4s', fp.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError('%s: not a .wav file' % filename)
+        fmt = None
+        nsamples = None
+        while True:
+            header = fp.read(8)
+            if len(header) < 8:
+                raise ValueError('%s: no data chunk' % filename)
+            name, size = struct.unpack('<4sI', header)
+            if name == b'data':
+                data = np.frombuffer(fp.read(size), dtype=np.uint8)
+                break
+            chunk = fp.read(size + (size & 1))
+            if name == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', chunk[:16])
+            elif name == b'fact':
+                nsamples = struct.unpack('<I', chunk[:4])[0]
+    if fmt is None or fmt[0] != WAVE_FORMAT_IMA_ADPCM or fmt[1] != 1 or fmt[5] != 4:
+        raise ValueError('%s: not a mono IMA ADPCM .wav file' % filename)
+    samplerate, block_align = fmt[2], fmt[4]
+    samples_per_block = 2*(block_align - 4) + 1
+    nblocks = -(-len(data) // block_align)
+    if nsamples is None:
+        nsamples = len(data) // block_align * samples_per_block
+        if len(data) % block_align > 4:
+            nsamples += 2*(len(data) % block_align - 4) + 1
+    blocks = np.zeros((nblocks, block_align), dtype=np.uint8)
+    blocks.reshape(-1)[:len(data)] = data
+    out = np.empty((nblocks, samples_per_block), dtype=np.int16)
+    for i in range(0, nblocks, blocks_per_chunk):
+        chunk = blocks[i:i+blocks_per_chunk]
+        prev = chunk[:, 0:2].copy().view('<i2').reshape(-1)
+        index = np.minimum(chunk[:, 2], 88)
+        out[i:i+len(chunk), 0] = prev
+        out[i:i+len(chunk), 1:] = decode_adpcm_blocks(chunk[:, 4:], index, prev)
+    return samplerate, out.reshape(-1)[:nsamples]
+
+def convert_adpcm_wav(src, dst):
+    """Converts an IMA ADPCM .wav file to 16 bit PCM."""
+    samplerate, samples = read_adpcm_wav(src)
+    with open(dst, 'wb') as fp:
+        write_wav_header(fp, 44 + samples.nbytes, samplerate, 1, False)
+        fp.write(samples.astype('<i2').tobytes())
+
+class WriterThread(threading.Thread):
+    """Background thread doing the file I/O of QueuedWavWriters.
+
+    Blocks are copied into one of nblocks preallocated buffers of
+    block_size bytes.  When the disk cannot keep up and all buffers are in
+    use, policy 'block' makes the receive thread wait for a free buffer
+    (lossless, but the socket stalls) and 'drop' drops the block, which
+    shows up as a gap in FILE.gaps.
+    """
+
+    def __init__(self, nblocks=256, block_size=1 << 13, policy='block'):
+        super(WriterThread, self).__init__(name='kiwiwav-writer')
+        self.daemon = True
+        self.nblocks = nblocks
+        self.policy = policy
+        self._pool = np.empty((nblocks, block_size), dtype=np.uint8)
+        self._free = queue.Queue()
+        for i in range(nblocks):
+            self._free.put(i)
+        self._queue = queue.Queue()
+        self._large_lock = threading.Lock()
+        self.high_water = 0   # most buffers in use
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._last_error = None
+        self._latency_total = 0
+        self.latency_max = 0   # seconds from put_block() to written
+        self.start()
+
+    def put_block(self, fcn, samples, *args):
+        """Copies samples into a free buffer and queues fcn(data, nbytes,
+        *args); False when the block was dropped."""
+        nbytes = samples.nbytes
+        if nbytes > self._pool.shape[1]:
+            return self._put_large(fcn, samples, nbytes, args)
+        try:
+            i = self._free.get(self.policy == 'block')
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        block = self._pool[i, :nbytes]
+        block[:] = samples.view(np.uint8).reshape(-1)
+        self.high_water = max(self.high_water, self.nblocks - self._free.qsize())
+        self._queue.put((fcn, (block.data, nbytes) + args, i, _perf_counter()))
+        return True
+
+    def _put_large(self, fcn, samples, nbytes, args):
+        """A block larger than the buffers is copied to the heap but holds
+        as many buffers as it would fill until it is written, so that it
+        counts against the pool and the policy applies to it."""
+        nslots = min(-(-nbytes // self._pool.shape[1]), self.nblocks)
+        slots = []
+        # one at a time: two half-acquired blocks would wait for each other
+        with self._large_lock:
+            try:
+                while len(slots) < nslots:
+                    slots.append(self._free.get(self.policy == 'block'))
+            except queue.Empty:
+                for i in slots:
+                    self._free.put(i)
+                self.dropped += 1
+                return False
+        self.high_water = max(self.high_water, self.nblocks - self._free.qsize())
+        self._queue.put((fcn, (samples.tobytes(), nbytes) + args, slots, _perf_counter()))
+        return True
+
+    def call(self, fcn, *args):
+        """Queues fcn(*args) behind the queued blocks."""
+        self._queue.put((fcn, args, None, None))
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fcn, args, i, t0 = item
+            try:
+                fcn(*args)
+            except Exception as e:
+                self.errors += 1
+                if str(e) != self._last_error:   # not once per block
+                    self._last_error = str(e)
+                    logging.error('writer: %s' % e)
+            if t0 is not None:
+                latency = _perf_counter() - t0
+                self.written += 1
+                self._latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            if isinstance(i, list):
+                for j in i:
+                    self._free.put(j)
+            elif i is not None:
+                self._free.put(i)
+
+    def stop(self):
+        """Finishes the queued I/O."""
+        self._queue.put(None)
+        self.join()
+
+    def report(self):
+        logging.info('writer: %d blocks written, latency %.1f/%.1f ms (mean/max), high-water %d of %d buffers, '
+                     '%d dropped, %d errors', self.written, 1e3 * self._latency_total / max(1, self.written),
+                     1e3 * self.latency_max, self.high_water, self.nblocks, self.dropped, self.errors)
+
+class QueuedWavWriter(object):
+    """WavWriter interface to a WavWriter (or wav_class) run by a
+    WriterThread."""
+
+    def __init__(self, thread, filename, samplerate, num_channels, is_kiwi_wav=False,
+                 wav_class=None, **kwargs):
+        wav_class = wav_class or WavWriter
+        self._thread = thread
+        self._wav = None
+        self._drop_start = None
+        self.filename = filename
+        thread.call(self._open, wav_class, filename, samplerate, num_channels, is_kiwi_wav, kwargs)
+
+    def _open(self, wav_class, filename, samplerate, num_channels, is_kiwi_wav, kwargs):
+        self._wav = wav_class(filename, samplerate, num_channels, is_kiwi_wav, **kwargs)
+
+    def _write_data(self, data, nbytes, arg, gap):
+        if gap is not None:
+            self._wav.write_gap(*gap)   # at the file size before the block
+        self._wav.write_data(data, nbytes, arg)
+
+    def write(self, samples, arg=None):
+        """WavWriter.write(samples, gps), AdpcmWavWriter.write(data, start)"""
+        gap = None if self._drop_start is None else (self._drop_start, time.time())
+        if not self._thread.put_block(self._write_data, samples, arg, gap):
+            if self._drop_start is None:
+                self._drop_start = time.time()
+            return
+        self._drop_start = None
+
+    def write_gap(self, t_from, t_to):
+        self._thread.call(lambda: self._wav.write_gap(t_from, t_to))
+
+    def close(self):
+        self._thread.call(lambda: self._wav.close())
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] FILE.wav ...',
+                                   description='Converts IMA ADPCM .wav files (kiwirecorder.py --adpcm) to 16 bit PCM.')
+    parser.add_option('-o', '--output', dest='output', type='string', default=None,
+                      help='Output file, with one input file (default: FILE_pcm.wav)')
+    (options, args) = parser.parse_args()
+    if not args or (options.output is not None and len(args) > 1):
+        parser.error('expected one input file with --output, else one or more')
+    for src in args:
+        dst = options.output or (src[:-4] if src.endswith('.wav') else src) + '_pcm.wav'
+        convert_adpcm_wav(src, dst)
+        print('%s -> %s' % (src, dst))
+
+if __name__ == '__main__':
+    main()
+
+# EOF
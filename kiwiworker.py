@@ -1,16 +1,146 @@
 ## -*- python -*-
 
+import logging
+import random
+import socket
+import threading
 import time
 import traceback
-import threading
 
+from mod_pywebsocket.stream import ConnectionTerminatedException
+
+from kiwiclient import KiwiStallError
 from kiwiclient import KiwiTooBusyError
 from kiwiclient import KiwiTimeLimitError
+from kiwiclient import _monotonic
+
+class ConnectScheduler(object):
+    """Admission control for connecting to KiwiSDRs.
+
+    Connects to different hosts proceed in parallel; per host at most
+    max_concurrent connects (TCP, handshake and auth) are in progress and
+    they start at least min_interval seconds apart.  Failed connects are
+    retried after an exponential backoff with jitter, so that receivers do
+    not reconnect in lockstep after a Kiwi reboots.
+    """
+
+    def __init__(self, max_concurrent=1, min_interval=1.0, backoff_base=2.0, backoff_max=120.0):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.stats = {}
+
+    def try_acquire(self, host):
+        """Returns 0 when a connect to host may start now, which must be
+        followed by release(host), else the seconds to wait before asking again."""
+        with self._lock:
+            now = _monotonic()
+            in_progress, next_start = self._hosts.get(host, (0, now))
+            if in_progress >= self.max_concurrent:
+                return max(0.05, next_start - now)
+            if now < next_start:
+                return next_start - now
+            self._hosts[host] = (in_progress + 1, now + self.min_interval)
+            return 0
+
+    def acquire(self, host, event=None):
+        """Waits until a connect to host may start; False if event was set meanwhile."""
+        t0 = _monotonic()
+        while True:
+            wait = self.try_acquire(host)
+            if wait == 0:
+                self._count(host, 'admission_wait', _monotonic() - t0)
+                return True
+            if event is None:
+                time.sleep(wait)
+            elif event.wait(timeout=wait):
+                return False
+
+    def release(self, host, ok=True):
+        with self._lock:
+            in_progress, next_start = self._hosts[host]
+            self._hosts[host] = (in_progress - 1, next_start)
+        self._count(host, 'connects' if ok else 'failures', 1)
+
+    def backoff(self, attempt):
+        """Delay before retry number attempt (1, 2, ...): exponential with
+        the upper half jittered."""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record_timing(self, host, timing):
+        for name, value in timing.items():
+            if value is not None:
+                self._count(host, name, value)
+
+    def _count(self, host, name, value):
+        with self._lock:
+            stats = self.stats.setdefault(host, {})
+            total, n, worst = stats.get(name, (0, 0, 0))
+            stats[name] = (total + value, n + 1, max(worst, value))
+
+    def report(self):
+        for host in sorted(self.stats):
+            stats = self.stats[host]
+            counts = ' '.join('%s=%d' % (name, stats[name][0]) for name in ('connects', 'failures') if name in stats)
+            times = ' '.join('%s=%.3f/%.3fs' % (name, total / n, worst)
+                             for name, (total, n, worst) in sorted(stats.items()) if name not in ('connects', 'failures'))
+            logging.info("connect stats %s: %s %s (mean/max)", host, counts, times)
+
+# shared by all KiwiWorkers not given a scheduler
+default_scheduler = ConnectScheduler()
+
+# what a worker does after an error, see error_action()
+STOP = 'stop'
+RECONNECT = 'reconnect'   # at once
+BACKOFF = 'backoff'       # after ConnectScheduler.backoff()
+
+def error_action(e, options, persistent=False, connecting=False):
+    """Retry policy of KiwiWorker and kiwiasync.run_worker, called in the
+    except clause for exception e of a connect (connecting=True) or of a
+    connection: reports e, sets options.status for --kiwi-tdoa and returns
+    STOP, RECONNECT or BACKOFF.  With persistent, unexpected errors do not
+    stop the worker either."""
+    if connecting:
+        print("Failed to connect, sleeping and reconnecting error='%s'" % e)
+        if options.is_kiwi_tdoa:
+            options.status = 1
+            return STOP
+        return BACKOFF
+    if isinstance(e, KiwiStallError):
+        # the Kiwi is most likely fine: reconnect without backoff
+        print("Stalled, reconnecting: %s" % e)
+        return RECONNECT
+    if isinstance(e, KiwiTooBusyError):
+        print("Server %s:%d too busy now" % (options.server_host, options.server_port))
+        if options.is_kiwi_tdoa:
+            options.status = 2
+            return STOP
+        return BACKOFF
+    if isinstance(e, KiwiTimeLimitError):
+        return STOP
+    if isinstance(e, (ConnectionTerminatedException, socket.error, EOFError)):
+        # Kiwi restarted or network trouble: reconnect after a backoff
+        print("Connection lost, reconnecting: %s" % e)
+        if options.is_kiwi_tdoa:
+            options.status = 1
+            return STOP
+        return BACKOFF
+    if options.is_kiwi_tdoa:
+        options.status = 1
+    traceback.print_exc()
+    return BACKOFF if persistent else STOP
 
 class KiwiWorker(threading.Thread):
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
         super(KiwiWorker, self).__init__(group=group, target=target, name=name)
         self._recorder, self._options, self._run_event = args
+        self._scheduler = (kwargs or {}).get('scheduler') or default_scheduler
+        # reconnect with backoff after any error instead of stopping (kiwibroker channels)
+        self._persistent = (kwargs or {}).get('persistent', False)
         self._event = threading.Event()
 
     def _do_run(self):
@@ -22,37 +152,50 @@ class KiwiWorker(threading.Thread):
                 break;
             self._event.wait(timeout=1)
 
+    def _backoff(self, attempt):
+        delay = self._scheduler.backoff(attempt)
+        logging.info("%s:%d: retry %d in %.1fs" % (self._options.server_host, self._options.server_port, attempt, delay))
+        self._event.wait(timeout=delay)
+
     def run(self):
+        host = self._options.server_host
+        attempt = 0
         while self._do_run():
+            if not self._scheduler.acquire(host, self._event):
+                break
             try:
                 self._recorder.connect(self._options.server_host, self._options.server_port)
             except Exception as e:
-                print("Failed to connect, sleeping and reconnecting error='%s'" %e)
-                if self._options.is_kiwi_tdoa:
-                    self._options.status = 1
-                    break
-                self._event.wait(timeout=15)
-                continue
+                self._scheduler.release(host, ok=False)
+                action = error_action(e, self._options, connecting=True)
+            else:
+                try:
+                    try:
+                        self._recorder.open()
+                    finally:
+                        self._scheduler.release(host)
+                    while self._do_run():
+                        self._recorder.run()
+                        if attempt and self._recorder.connect_timing['first_sample'] is not None:
+                            attempt = 0   # receiving again
+                    action = STOP
+                except Exception as e:
+                    action = error_action(e, self._options, self._persistent)
+                    self._recorder.abort()
+                finally:
+                    if self._recorder.connect_timing is not None:
+                        self._scheduler.record_timing(host, self._recorder.connect_timing)
 
-            try:
-                self._recorder.open()
-                while self._do_run():
-                    self._recorder.run()
-            except KiwiTooBusyError:
-                print("Server %s:%d too busy now" % (self._options.server_host, self._options.server_port))
-                if self._options.is_kiwi_tdoa:
-                    self._options.status = 2
-                    break
-                self._event.wait(timeout=15)
-                continue
-            except KiwiTimeLimitError:
-                break
-            except Exception as e:
-                if self._options.is_kiwi_tdoa:
-                    self._options.status = 1
-                traceback.print_exc()
+            if action == STOP:
                 break
+            if action == RECONNECT:
+                attempt = 0
+            else:
+                attempt += 1
+                self._backoff(attempt)
 
+        self._recorder.shutdown()      # processes what was received
+        self._recorder.close_sinks()   # finishes the recording
         self._run_event.clear()   # tell all other threads to stop
         # hangs for some reason
         #self._recorder.close()
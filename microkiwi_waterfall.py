@@ -9,6 +9,7 @@ import time
 from datetime import datetime
 
 import wsclient
+from kiwicodec import wf_db
 
 import mod_pywebsocket.common
 from mod_pywebsocket.stream import Stream
@@ -118,10 +119,9 @@ while time<length:
         tmp = tmp[16:] # remove some header from each msg
         if options['verbosity']:
             print time,
-        spectrum = np.array(struct.unpack('%dB'%len(tmp), tmp) ) # convert from binary data to uint8
         if filename:
             binary_wf_list.append(tmp) # append binary data to be saved to file
-        wf_data[time, :] = spectrum-255 # mirror dBs
+        wf_data[time, :] = wf_db(tmp) # mirror dBs, int16 so uint8 does not wrap
         time += 1
     else: # this is chatter between client and server
         #print tmp
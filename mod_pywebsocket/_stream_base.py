@@ -40,6 +40,7 @@
 
 
 import socket
+import threading
 
 from mod_pywebsocket import util
 
@@ -102,6 +103,28 @@ class StreamBase(object):
         self._logger = util.get_class_logger(self)
 
         self._request = request
+        # Frames are held per thread: frames written by other threads, e.g.
+        # pongs sent by a receiving thread, are not held and not lost.
+        self._held_writes = threading.local()
+        self._write_lock = threading.Lock()
+
+    def hold_writes(self):
+        """Queues the frames the calling thread writes from now on until it
+        calls flush_writes, so that they go out in a single write.
+        """
+
+        if getattr(self._held_writes, 'queue', None) is None:
+            self._held_writes.queue = []
+
+    def flush_writes(self):
+        """Writes the frames queued since hold_writes was called, if any,
+        and stops queueing.
+        """
+
+        queue = getattr(self._held_writes, 'queue', None)
+        self._held_writes.queue = None
+        if queue:
+            self._write(b''.join(queue))
 
     def _read(self, length):
         """Reads length bytes from connection. In case we catch any exception,
@@ -137,8 +160,15 @@ class StreamBase(object):
         prepends remote address to the exception message and raise again.
         """
 
+        queue = getattr(self._held_writes, 'queue', None)
+        if queue is not None:
+            queue.append(bytes_to_write)
+            return
+
         try:
-            self._request.connection.write(bytes_to_write)
+            # one frame at a time: writes of several threads would interleave
+            with self._write_lock:
+                self._request.connection.write(bytes_to_write)
         except Exception as e:
             util.prepend_message_to_exception(
                     'Failed to send message to %r: ' %
@@ -146,14 +176,38 @@ class StreamBase(object):
                     e)
             raise
 
+    def _read_exact(self, length):
+        """Reads exactly length bytes from a connection providing read_exact.
+
+        Raises:
+            ConnectionTerminatedException: when the connection is closed.
+        """
+
+        try:
+            return self._request.connection.read_exact(length)
+        except socket.error as e:
+            raise ConnectionTerminatedException(
+                'Receiving %d byte failed. socket.error (%s) occurred' %
+                (length, e))
+        except IOError as e:
+            raise ConnectionTerminatedException(
+                'Receiving %d byte failed. IOError (%s) occurred' %
+                (length, e))
+
     def receive_bytes(self, length):
         """Receives multiple bytes. Retries read when we couldn't receive the
         specified amount.
 
+        If the connection provides read_exact, the bytes are returned as a
+        memoryview which is only valid until the next read.
+
         Raises:
             ConnectionTerminatedException: when read returns empty string.
         """
 
+        if hasattr(self._request.connection, 'read_exact'):
+            return self._read_exact(length)
+
         read_bytes = []
         while length > 0:
             new_read_bytes = self._read(length)
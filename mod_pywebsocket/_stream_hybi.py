@@ -40,6 +40,7 @@ from collections import deque
 import logging
 import os
 import struct
+import threading
 import time
 
 import sys
@@ -58,6 +59,9 @@ from mod_pywebsocket._stream_base import UnsupportedFrameException
 
 _NOOP_MASKER = util.NoopMasker()
 
+_UNPACK_LENGTH_16 = struct.Struct('!H').unpack_from
+_UNPACK_LENGTH_64 = struct.Struct('!Q').unpack_from
+
 
 class Frame(object):
 
@@ -130,11 +134,36 @@ def create_header(opcode, payload_length, fin, rsv1, rsv2, rsv3, mask):
     return header
 
 
+class _MaskingKeyPool(object):
+    """Hands out 4 octet masking keys taken from one os.urandom call per
+    _POOL_SIZE keys.
+    """
+
+    _POOL_SIZE = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = b''
+        self._index = 0
+
+    def get(self):
+        with self._lock:
+            if self._index >= len(self._keys):
+                self._keys = os.urandom(4 * self._POOL_SIZE)
+                self._index = 0
+            index = self._index
+            self._index = index + 4
+        return self._keys[index:index + 4]
+
+
+_masking_keys = _MaskingKeyPool()
+
+
 def _build_frame(header, body, mask):
     if not mask:
         return header + body
 
-    masking_nonce = os.urandom(4)
+    masking_nonce = _masking_keys.get()
     masker = util.RepeatedXorMasker(masking_nonce)
     return header + masking_nonce + masker.mask(body)
 
@@ -407,6 +436,16 @@ class StreamOptions(object):
         self.mask_send = False
         self.unmask_receive = True
 
+        # Receive unmasked, unfragmented text and binary frames without
+        # building Frame objects when no incoming filters are set.
+        self.receive_fast_path = True
+
+        # util._RFC1979Inflater for the messages with RSV1 set, for clients
+        # which use permessage-deflate for receiving only, see
+        # _PerMessageDeflateFramer.setup_receive_options. Unlike the
+        # filters it keeps the receive fast path usable.
+        self.receive_inflater = None
+
 
 class Stream(StreamBase):
     """A class for parsing/building frames of the WebSocket protocol
@@ -433,6 +472,8 @@ class Stream(StreamBase):
         self._received_fragments = []
         # Holds the opcode of the first fragment.
         self._original_opcode = None
+        # True while receiving a message to inflate with receive_inflater.
+        self._inflate_message = False
 
         self._writer = FragmentedFrameBuilder(
             self._options.mask_send, self._options.outgoing_frame_filters,
@@ -440,17 +481,25 @@ class Stream(StreamBase):
 
         self._ping_queue = deque()
 
-    def _receive_frame(self):
+    def _receive_frame(self, header=None):
         """Receives a frame and return data in the frame as a tuple containing
         each header field and payload separately.
 
+        Args:
+            header: the first 2 octets of the frame if they have already
+                been received.
+
         Raises:
             ConnectionTerminatedException: when read returns empty
                 string.
             InvalidFrameException: when the frame contains invalid data.
         """
 
+        pending = [header] if header is not None else []
+
         def _receive_bytes(length):
+            if pending:
+                return pending.pop()
             return self.receive_bytes(length)
 
         return parse_frame(receive_bytes=_receive_bytes,
@@ -458,8 +507,9 @@ class Stream(StreamBase):
                            ws_version=self._request.ws_version,
                            unmask_receive=self._options.unmask_receive)
 
-    def _receive_frame_as_frame_object(self):
-        opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3 = self._receive_frame()
+    def _receive_frame_as_frame_object(self, header=None):
+        opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3 = self._receive_frame(
+            header)
 
         return Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
                      opcode=opcode, payload=unmasked_bytes)
@@ -571,13 +621,13 @@ class Stream(StreamBase):
 
             if frame.fin:
                 # End of fragmentation frame
-                self._received_fragments.append(frame.payload)
-                message = ''.join(self._received_fragments)
+                self._received_fragments.append(bytes(frame.payload))
+                message = b''.join(self._received_fragments)
                 self._received_fragments = []
                 return message
             else:
                 # Intermediate frame
-                self._received_fragments.append(frame.payload)
+                self._received_fragments.append(bytes(frame.payload))
                 return None
         else:
             if self._received_fragments:
@@ -603,7 +653,7 @@ class Stream(StreamBase):
                         'Control frames must not be fragmented')
 
                 self._original_opcode = frame.opcode
-                self._received_fragments.append(frame.payload)
+                self._received_fragments.append(bytes(frame.payload))
                 return None
 
     def _process_close_message(self, message):
@@ -754,7 +804,13 @@ class Stream(StreamBase):
             # mp_conn.read will block if no bytes are available.
             # Timeout is controlled by TimeOut directive of Apache.
 
-            frame = self._receive_frame_as_frame_object()
+            if self._use_receive_fast_path():
+                header, message = self._receive_simple_frame()
+                if header is None:
+                    return message
+                frame = self._receive_frame_as_frame_object(header)
+            else:
+                frame = self._receive_frame_as_frame_object()
 
             # Check the constraint on the payload size for control frames
             # before extension processes the frame.
@@ -768,6 +824,13 @@ class Stream(StreamBase):
             for frame_filter in self._options.incoming_frame_filters:
                 frame_filter.filter(frame)
 
+            if (self._options.receive_inflater is not None and
+                not common.is_control_opcode(frame.opcode)):
+                # RSV1 is only set on the first frame of a message
+                if frame.opcode != common.OPCODE_CONTINUATION:
+                    self._inflate_message = frame.rsv1 == 1
+                frame.rsv1 = 0
+
             if frame.rsv1 or frame.rsv2 or frame.rsv3:
                 raise UnsupportedFrameException(
                     'Unsupported flag is set (rsv = %d%d%d)' %
@@ -777,9 +840,19 @@ class Stream(StreamBase):
             if message is None:
                 continue
 
+            if self._inflate_message and not common.is_control_opcode(frame.opcode):
+                message = self._options.receive_inflater.filter(message)
+                self._inflate_message = False
+
             for message_filter in self._options.incoming_message_filters:
                 message = message_filter.filter(message)
 
+            # A memoryview from a buffered connection is only valid until
+            # the next read. Binary messages are returned as is.
+            if (isinstance(message, memoryview) and
+                self._original_opcode != common.OPCODE_BINARY):
+                message = message.tobytes()
+
             if self._original_opcode == common.OPCODE_TEXT:
                 # The WebSocket protocol section 4.4 specifies that invalid
                 # characters must be replaced with U+fffd REPLACEMENT
@@ -801,6 +874,59 @@ class Stream(StreamBase):
                 raise UnsupportedFrameException(
                     'Opcode %d is not supported' % self._original_opcode)
 
+    def _use_receive_fast_path(self):
+        return (self._options.receive_fast_path and
+                not self._options.unmask_receive and
+                not self._received_fragments and
+                not self._options.incoming_frame_filters and
+                not self._options.incoming_message_filters)
+
+    def _receive_simple_frame(self):
+        """Client receive fast path for the unmasked, unfragmented text and
+        binary frames servers send, without logging and Frame objects.
+
+        Returns:
+            (None, message) for such a frame, where message is as returned
+            by receive_message; otherwise (header, None) where header is a
+            copy of the first 2 octets, to be parsed by the general parser.
+        """
+
+        header = self.receive_bytes(2)
+        first_byte = header[0]
+        second_byte = header[1]
+        if type(first_byte) is not int:
+            first_byte = ord(first_byte)
+            second_byte = ord(second_byte)
+        opcode = first_byte & 0xf
+        inflater = self._options.receive_inflater
+        # FIN set, RSV bits (but RSV1 with a receive_inflater) and mask bit clear
+        flags = first_byte & 0xf0
+        if ((flags != 0x80 and (flags != 0xc0 or inflater is None)) or
+            (second_byte & 0x80) or
+            (opcode != common.OPCODE_BINARY and
+             opcode != common.OPCODE_TEXT)):
+            return bytes(header), None
+
+        payload_length = second_byte & 0x7f
+        if payload_length == 126:
+            payload_length = _UNPACK_LENGTH_16(self.receive_bytes(2))[0]
+        elif payload_length == 127:
+            payload_length = _UNPACK_LENGTH_64(self.receive_bytes(8))[0]
+            if payload_length > 0x7FFFFFFFFFFFFFFF:
+                raise InvalidFrameException(
+                    'Extended payload length >= 2^63')
+        message = self.receive_bytes(payload_length)
+        if flags == 0xc0:
+            message = inflater.filter(message)
+
+        self._original_opcode = opcode
+        if opcode == common.OPCODE_BINARY:
+            return None, message
+        try:
+            return None, bytes(message).decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise InvalidUTF8Exception(e)
+
     def _send_closing_handshake(self, code, reason):
         body = create_closing_handshake_body(code, reason)
         frame = create_close_frame(
@@ -826,6 +952,9 @@ class Stream(StreamBase):
             or reason is not an instance of both str and unicode.
         """
 
+        # The closing handshake must not wait behind held frames.
+        self.flush_writes()
+
         if self._request.server_terminated:
             self._logger.debug(
                 'Requested close_connection but server is already terminated')
@@ -586,6 +586,13 @@ class _PerMessageDeflateFramer(object):
 
         frame.rsv1 = 1
 
+    def setup_receive_options(self, stream_options):
+        """Inflates received messages only, for clients which send their
+        messages uncompressed; unlike setup_stream_options this adds no
+        filters."""
+
+        stream_options.receive_inflater = self._rfc1979_inflater
+
     def setup_stream_options(self, stream_options):
         """Creates filters and sets them to the StreamOptions."""
 
@@ -31,7 +31,6 @@
 """WebSocket utilities."""
 
 
-import array
 import errno
 
 # Import hash classes from a module available and recommended for each Python
@@ -197,8 +196,7 @@ class RepeatedXorMasker(object):
 
     def _mask_using_array(self, s):
         """Perform the mask via python."""
-        result = array.array('B')
-        result.fromstring(s)
+        result = bytearray(s)
 
         # Use temporary local variables to eliminate the cost to access
         # attributes
@@ -215,10 +213,29 @@ class RepeatedXorMasker(object):
 
         self._masking_key_index = masking_key_index
 
-        return result.tostring()
+        return bytes(result)
+
+    def _mask_using_int(self, s):
+        """Perform the mask as a single XOR of two big integers."""
+        size = len(s)
+        if not size:
+            return b''
+        masking_key = bytes(self._masking_key)
+        masking_key_size = len(masking_key)
+        masking_key_index = self._masking_key_index
+        key = masking_key[masking_key_index:] + masking_key[:masking_key_index]
+        key = (key * (size // masking_key_size + 1))[:size]
+
+        self._masking_key_index = (
+                (masking_key_index + size) % masking_key_size)
+
+        return (int.from_bytes(s, 'big') ^
+                int.from_bytes(key, 'big')).to_bytes(size, 'big')
 
     if 'fast_masking' in globals():
         mask = _mask_using_swig
+    elif hasattr(int, 'from_bytes'):
+        mask = _mask_using_int
     else:
         mask = _mask_using_array
 
@@ -272,7 +289,8 @@ class _Inflater(object):
         self._logger = get_class_logger(self)
         self._window_bits = window_bits
 
-        self._unconsumed = ''
+        # Any bytes-like object, e.g. a memoryview of the receive buffer.
+        self._unconsumed = b''
 
         self.reset()
 
@@ -280,19 +298,25 @@ class _Inflater(object):
         if not (size == -1 or size > 0):
             raise Exception('size must be -1 or positive')
 
-        data = ''
+        # Collect the output chunks and join them once; appending to a
+        # bytes object copies everything decompressed so far each time.
+        chunks = []
+        length = 0
 
         while True:
             if size == -1:
-                data += self._decompress.decompress(self._unconsumed)
+                chunk = self._decompress.decompress(self._unconsumed)
                 # See Python bug http://bugs.python.org/issue12050 to
                 # understand why the same code cannot be used for updating
                 # self._unconsumed for here and else block.
-                self._unconsumed = ''
+                self._unconsumed = b''
             else:
-                data += self._decompress.decompress(
-                    self._unconsumed, size - len(data))
+                chunk = self._decompress.decompress(
+                    self._unconsumed, size - length)
                 self._unconsumed = self._decompress.unconsumed_tail
+            if chunk:
+                chunks.append(chunk)
+                length += len(chunk)
             if self._decompress.unused_data:
                 # Encountered a last block (i.e. a block with BFINAL = 1) and
                 # found a new stream (unused_data). We cannot use the same
@@ -303,7 +327,7 @@ class _Inflater(object):
                 # empty.
                 self._unconsumed = self._decompress.unused_data
                 self.reset()
-                if size >= 0 and len(data) == size:
+                if size >= 0 and length == size:
                     # data is filled. Don't call decompress again.
                     break
                 else:
@@ -317,13 +341,17 @@ class _Inflater(object):
                 # don't have to "continue" here.
                 break
 
+        data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
         if data:
             self._logger.debug('Decompressed %r', data)
         return data
 
     def append(self, data):
         self._logger.debug('Appended %r', data)
-        self._unconsumed += data
+        if self._unconsumed:
+            self._unconsumed = bytes(self._unconsumed) + data
+        else:
+            self._unconsumed = data
 
     def reset(self):
         self._logger.debug('Reset')
@@ -352,7 +380,7 @@ class _RFC1979Deflater(object):
         if bfinal:
             result = self._deflater.compress_and_finish(bytes)
             # Add a padding block with BFINAL = 0 and BTYPE = 0.
-            result = result + chr(0)
+            result = result + b'\x00'
             self._deflater = None
             return result
 
@@ -368,6 +396,9 @@ class _RFC1979Deflater(object):
         return result
 
 
+_SYNC_FLUSH_TAIL = b'\x00\x00\xff\xff'
+
+
 class _RFC1979Inflater(object):
     """A decompressor class a la RFC1979.
 
@@ -380,9 +411,13 @@ class _RFC1979Inflater(object):
 
     def filter(self, bytes):
         # Restore stripped LEN and NLEN field of a non-compressed block added
-        # for Z_SYNC_FLUSH.
-        self._inflater.append(bytes + '\x00\x00\xff\xff')
-        return self._inflater.decompress(-1)
+        # for Z_SYNC_FLUSH. Inflating the message and the four octets
+        # separately avoids copying the message.
+        self._inflater.append(bytes)
+        data = self._inflater.decompress(-1)
+        self._inflater.append(_SYNC_FLUSH_TAIL)
+        tail = self._inflater.decompress(-1)
+        return data + tail if tail else data
 
 
 class DeflateSocket(object):
@@ -418,7 +453,7 @@ class DeflateSocket(object):
 
             read_data = self._socket.recv(DeflateSocket._RECV_SIZE)
             if not read_data:
-                return ''
+                return b''
             self._inflater.append(read_data)
 
     def sendall(self, bytes):
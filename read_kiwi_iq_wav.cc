@@ -124,11 +124,8 @@ DEFUN_DLD (read_kiwi_iq_wav, args, nargout, "[d,sample_rate]=read_kiwi_wav(\"<wa
         error("'WAVE' chunk expected");
         break;
       }
-      const int n = (int(cr.size())-sizeof(chunk_riff)-4)/2074;
-      cell_z.resize(n);
-      cell_last.resize(n);
-      cell_gpssec.resize(n);
-      cell_gpsnsec.resize(n);
+      // the number of blocks is counted below: the RIFF size includes
+      // chunks other than 'kiwi' and 'data', e.g. the 'kidx' index
     } else if (c.id() == "fmt ") {
       file.seekg(pos);
       file.read((char*)(&fmt), sizeof(fmt));
@@ -150,6 +147,7 @@ DEFUN_DLD (read_kiwi_iq_wav, args, nargout, "[d,sample_rate]=read_kiwi_wav(\"<wa
       }
       if (j != n)
         error("incomplete 'data' chunk");
+      cell_z.resize(data_counter+1);
       cell_z(data_counter++) = a;
     } else if (c.id() == "kiwi") {
       file.seekg(pos);
@@ -157,11 +155,15 @@ DEFUN_DLD (read_kiwi_iq_wav, args, nargout, "[d,sample_rate]=read_kiwi_wav(\"<wa
       file.read((char*)(&kiwi), sizeof(kiwi));
       if (!file)
         error("incomplete 'kiwi' chunk");
+      cell_last.resize(data_counter+1);
+      cell_gpssec.resize(data_counter+1);
+      cell_gpsnsec.resize(data_counter+1);
       cell_last(data_counter)    = kiwi.last();
       cell_gpssec(data_counter)  = kiwi.gpssec();
       cell_gpsnsec(data_counter) = kiwi.gpsnsec();
     } else {
-      octave_stdout << "skipping unknown chunk '" << c.id() << "'" << std::endl;
+      if (c.id() != "kidx") // block index written by kiwirecorder
+        octave_stdout << "skipping unknown chunk '" << c.id() << "'" << std::endl;
       file.seekg(file.tellg() + c.size());
     }
   }
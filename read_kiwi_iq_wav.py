@@ -1,21 +1,113 @@
 # -*- python -*-
 
-import collections
+import mmap
 import struct
 import numpy as np
-from chunk import Chunk
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
+
+# block index of kiwiwav.WavWriter: file offset of the 'kiwi' chunk, number
+# of samples before the block, and its GNSS timestamp
+KIWI_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('sample', '<u8'), ('gpssec', '<u4'), ('gpsnsec', '<u4'),
+                             ('last_gps_solution', 'u1'), ('pad', 'V3')])
+
+# a block: 'kiwi' chunk (8+10 bytes) and 'data' chunk header, then the samples
+_KIWI_CHUNK = struct.Struct('<4sIBBII4sI')
+_KIWI_ID, _DATA_ID = struct.unpack('<II', b'kiwidata')
 
 class KiwiIQWavError(Exception):
     pass
 
-class KiwiIQWavReader(collections.Iterator):
+def _read_header(f):
+    """Reads the RIFF and fmt chunk headers, returns the sample rate."""
+    riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF':
+        raise KiwiIQWavError('file does not start with RIFF id')
+    if wave != b'WAVE':
+        raise KiwiIQWavError('not a WAVE file')
+    name, size = struct.unpack('<4sI', f.read(8))
+    if name != b'fmt ':
+        raise KiwiIQWavError('fmt chunk is missing')
+    fmt = f.read(size + (size & 1))
+    wFormatTag, nchannels, samplerate, dwAvgBytesPerSec, wBlockAlign = struct.unpack('<HHLLH', fmt[:14])
+    if wFormatTag != 1 or nchannels != 2 or wBlockAlign != 4:
+        raise KiwiIQWavError('this is not a KiwiSDR IQ wav file')
+    return samplerate
+
+def read_index(f, filename):
+    """The block index of a kiwi .wav file, a KIWI_INDEX_DTYPE array: from
+    the 'kidx' chunk, else from FILE.idx (after a crash) and the chunk
+    headers of the blocks after it, else from the chunk headers."""
+    f.seek(0, 2)
+    size = f.tell()
+    itemsize = KIWI_INDEX_DTYPE.itemsize
+    if size >= 12 + 16:
+        f.seek(size - 8)
+        n, name = struct.unpack('<I4s', f.read(8))
+        start = size - 8 - n*itemsize
+        if name == b'kidx' and start >= 12 + 8:
+            f.seek(start - 8)
+            if struct.unpack('<4sI', f.read(8)) == (b'kidx', n*itemsize + 8):
+                return np.frombuffer(f.read(n*itemsize), dtype=KIWI_INDEX_DTYPE)
+    try:
+        with open(filename + '.idx', 'rb') as idx:
+            data = idx.read()
+        index = np.frombuffer(data[:len(data) - len(data) % itemsize], dtype=KIWI_INDEX_DTYPE)
+    except IOError:
+        return _scan_index(f, size, 12, 0)
+    if len(index) == 0 or not _valid_index(f, size, index):
+        return _scan_index(f, size, 12, 0)
+    # the blocks written after the last header update
+    return np.concatenate((index[:-1], _scan_index(f, size, int(index['offset'][-1]), int(index['sample'][-1]))))
+
+def _valid_index(f, size, index):
+    """Checks an index read from FILE.idx against the file, which may have
+    been overwritten by a recording that crashed before its first update."""
+    offsets = index['offset'].astype(np.int64)
+    if offsets[-1] + _KIWI_CHUNK.size > size:
+        return False
+    # consecutive blocks: 'kiwi' chunk, 'data' header and 4 bytes per sample
+    nbytes = _KIWI_CHUNK.size + 4*np.diff(index['sample'].astype(np.int64))
+    if np.any(np.diff(offsets) != nbytes):
+        return False
+    for offset in (offsets[0], offsets[-1]):
+        f.seek(offset)
+        if f.read(4) != b'kiwi':
+            return False
+    return True
+
+def _scan_index(f, size, offset, nsamples):
+    entries = []
+    kiwi = None
+    while offset + 8 <= size:
+        f.seek(offset)
+        name, chunk_size = struct.unpack('<4sI', f.read(8))
+        if name == b'kiwi':
+            kiwi = (offset,) + struct.unpack('<BBII', f.read(10))
+        elif name == b'data' and kiwi is not None:
+            entries.append((kiwi[0], nsamples, kiwi[3], kiwi[4], kiwi[1]))
+            nsamples += min(chunk_size, size - offset - 8) // 4
+            kiwi = None
+        offset += 8 + chunk_size + (chunk_size & 1)
+    index = np.zeros(len(entries), dtype=KIWI_INDEX_DTYPE)
+    for i, name in enumerate(('offset', 'sample', 'gpssec', 'gpsnsec', 'last_gps_solution')):
+        index[name] = [e[i] for e in entries]
+    return index
+
+class KiwiIQWavReader(Iterator):
     def __init__(self, f):
         super(KiwiIQWavReader, self).__init__()
         self._frame_counter = 0
         self._last_gpssec   = -1
+        self._filename = f
+        self._index = None
+        self._index_times = None
+        self._f = None
         try:
             self._f = open(f, 'rb')
-            self._initfp(self._f)
+            self._samplerate = _read_header(self._f)
         except:
             if self._f:
                 self._f.close()
@@ -25,43 +117,25 @@ class KiwiIQWavReader(collections.Iterator):
         if self._f:
             self._f.close()
 
-    def _initfp(self, file):
-        self._file = Chunk(file, bigendian = 0)
-        if self._file.getname() != b'RIFF':
-            raise KiwiIQWavError('file does not start with RIFF id')
-        if self._file.read(4) != b'WAVE':
-            raise KiwiIQWavError('not a WAVE file')
-
-        chunk = Chunk(self._file, bigendian = 0)
-        if chunk.getname() != b'fmt ':
-            raise KiwiIQWavError('fmt chunk is missing')
-
-        self._proc_chunk_fmt(chunk)
-        chunk.skip()
-
     ## for python3
     def __next__(self):
         return self.next()
 
     ## for python2
     def next(self):
-        try:
-            chunk = Chunk(self._file, bigendian = 0)
-            if chunk.getname() != b'kiwi':
-                raise KiwiIQWavError('missing KiwiSDR GNSS time stamp')
-
-            self._proc_chunk_kiwi(chunk)
-            chunk.skip()
-
-            chunk = Chunk(self._file, bigendian = 0)
-            if chunk.getname() != b'data':
-                raise KiwiIQWavError('missing WAVE data chunk')
-
-            tz = self._proc_chunk_data(chunk)
-            chunk.skip()
-            return tz
-        except EOFError:
+        header = self._f.read(_KIWI_CHUNK.size)
+        if header[:4] == b'kidx' or len(header) < _KIWI_CHUNK.size:
             raise StopIteration
+        name, size, self.last_gps_solution, dummy, gpssec, gpsnsec, data, nbytes = _KIWI_CHUNK.unpack(header)
+        if name != b'kiwi' or size != 10:
+            raise KiwiIQWavError('missing KiwiSDR GNSS time stamp')
+        if data != b'data':
+            raise KiwiIQWavError('missing WAVE data chunk')
+        self.gpssec = gpssec + 1e-9*gpsnsec
+        payload = self._f.read(nbytes + (nbytes & 1))
+        if len(payload) < nbytes:
+            raise StopIteration
+        return self._proc_chunk_data(payload[:nbytes])
 
     def process_iq_samples(self, t,z):
         ## print(len(t), len(z))
@@ -70,17 +144,35 @@ class KiwiIQWavReader(collections.Iterator):
     def get_samplerate(self):
         return self._samplerate
 
-    def _proc_chunk_fmt(self, chunk):
-        wFormatTag, nchannels, self._samplerate, dwAvgBytesPerSec, wBlockAlign = struct.unpack('<HHLLH', chunk.read(chunk.getsize()-2))
-        assert wFormatTag == 1 and nchannels == 2 and wBlockAlign == 4, 'this is not a KiwiSDR IQ wav file'
+    def get_index(self):
+        """The block index, see read_index()."""
+        if self._index is None:
+            pos = self._f.tell()
+            try:
+                self._index = read_index(self._f, self._filename)
+            finally:
+                self._f.seek(pos)
+            self._index_times = self._index['gpssec'] + 1e-9*self._index['gpsnsec']
+        return self._index
 
-    def _proc_chunk_kiwi(self, chunk):
-        self.last_gps_solution,dummy,gpssec,gpsnsec = struct.unpack('<BBII', chunk.read(10))
-        self.gpssec = gpssec + 1e-9*gpsnsec
+    def find_block(self, gpssec):
+        """Number of the block holding the GNSS time gpssec, by binary search."""
+        self.get_index()
+        return max(0, int(np.searchsorted(self._index_times, gpssec, side='right')) - 1)
 
-    def _proc_chunk_data(self, chunk):
+    def seek(self, gpssec):
+        """Continues with the block holding the GNSS time gpssec and returns
+        its number; as after opening the file, the first two blocks have no
+        sample times."""
+        i = self.find_block(gpssec)
+        self._f.seek(int(self._index['offset'][i]))
+        self._frame_counter = 0
+        self._last_gpssec   = -1
+        return i
+
+    def _proc_chunk_data(self, payload):
         t = None
-        z = np.frombuffer(chunk.read(chunk.getsize()), dtype=np.int16).astype(np.float32).view(np.complex64)/65535
+        z = np.frombuffer(payload, dtype=np.int16).astype(np.float32).view(np.complex64)/65535
         n = len(z)
         if self._last_gpssec >= 0:
             if self._frame_counter < 3:
@@ -100,15 +192,139 @@ class KiwiIQWavReader(collections.Iterator):
         self._frame_counter += (self._frame_counter < 3)
         return t,z
 
-def read_kiwi_iq_wav(filename):
-    t = []
-    z = []
-    for _t,_z in KiwiIQWavReader(filename):
-        if _t is None:
-            continue
-        t.append(_t)
-        z.append(_z)
-    return np.concatenate(t), np.concatenate(z)
+def _convert(samples, out, raw):
+    if raw:
+        np.copyto(out, samples)
+    else:
+        np.multiply(samples, np.float32(1/65535.0), out=out)   # as complex64/65535 does
+
+class KiwiIQWavFile(object):
+    """Memory-mapped kiwi .wav IQ file, read as a whole.
+
+    The chunk headers are read once, into the block index (see
+    read_index()); the samples are never copied block by block.  When all
+    blocks have the same size, as kiwirecorder writes them, blocks() is an
+    int16 view of the mapped file and read() converts it to complex64 in
+    one pass.  The views keep the mapping alive after close().
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.nominal_samplerate = _read_header(f)
+            self.index = read_index(f, filename)
+            f.seek(0, 2)
+            size = f.tell()
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = np.frombuffer(self._mm, dtype=np.uint8)
+        offsets = self.index['offset'].astype(np.intp)
+        if not ((self._u32(offsets) == _KIWI_ID).all() and (self._u32(offsets + 18) == _DATA_ID).all()):
+            raise KiwiIQWavError('%s: the block index does not match the file' % filename)
+        self._data_offsets = offsets + _KIWI_CHUNK.size
+        nbytes = self._u32(offsets + 22).astype(np.intp)
+        nbytes = np.minimum(nbytes, size - self._data_offsets)   # a block cut short by a crash
+        self.block_samples = nbytes // 4
+        self.nsamples = int(self.block_samples.sum())
+        # all blocks but a short last one the same size, at equal distances
+        sizes = self.block_samples[:-1] if len(nbytes) > 1 else self.block_samples
+        self._uniform = bool(len(sizes) == 0 or
+                             ((sizes == sizes[0]).all() and len(np.unique(np.diff(offsets))) <= 1))
+
+    def _u32(self, offsets):
+        """The little-endian uint32s at the (unaligned) offsets."""
+        b = [self._buf[offsets + k].astype(np.uint32) for k in range(4)]
+        return b[0] | (b[1] << 8) | (b[2] << 16) | (b[3] << 24)
+
+    def close(self):
+        self._buf = None
+        self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def blocks(self):
+        """int16 view of shape (blocks, samples, 2) of the mapped file; a
+        last block cut short by a crash is left out."""
+        if not self._uniform:
+            raise KiwiIQWavError('%s: blocks of different sizes' % self.filename)
+        n = len(self.index)
+        if n == 0:
+            return np.empty((0, 0, 2), dtype=np.int16)
+        m = int(self.block_samples[0])
+        if n > 1 and self.block_samples[-1] != m:
+            n -= 1
+        stride = int(self.index['offset'][1] - self.index['offset'][0]) if n > 1 else 4*m
+        return np.ndarray(shape=(n, m, 2), dtype='<i2', buffer=self._mm, offset=int(self._data_offsets[0]),
+                          strides=(stride, 4, 2))
+
+    def read(self, out=None, raw=False):
+        """All samples: complex64 scaled like KiwiIQWavReader, or with raw
+        the int16 I,Q pairs, shape (nsamples, 2); written into out if given."""
+        if out is None:
+            out = np.empty((self.nsamples, 2), dtype=np.int16) if raw else np.empty(self.nsamples, dtype=np.complex64)
+        pairs = out if raw else out.view(np.float32).reshape(-1, 2)
+        if self._uniform:
+            view = self.blocks()
+            n = view.shape[0] * view.shape[1]
+            _convert(view, pairs[:n].reshape(view.shape), raw)
+            blocks = range(view.shape[0], len(self.index))
+        else:
+            blocks = range(len(self.index))
+        sample = self.index['sample']
+        for i in blocks:
+            start = int(self._data_offsets[i])
+            m = int(self.block_samples[i])
+            block = np.frombuffer(self._mm, dtype='<i2', count=2*m, offset=start).reshape(m, 2)
+            _convert(block, pairs[int(sample[i]):int(sample[i])+m], raw)
+        return out
+
+    def get_samplerate(self):
+        """The sample rate measured by the GNSS timestamps of the blocks."""
+        index = self.index
+        t = index['gpssec'] + 1e-9*index['gpsnsec']
+        s = index['sample']
+        if len(t) < 2 or t[-1] <= t[0]:
+            return float(self.nominal_samplerate)
+        return float(s[-1] - s[0]) / (t[-1] - t[0])
+
+    def times(self, samplerate=None):
+        """The GNSS time of every sample: the time of its block plus its
+        offset in the block at samplerate (by default get_samplerate())."""
+        if samplerate is None:
+            samplerate = self.get_samplerate()
+        t0 = self.index['gpssec'] + 1e-9*self.index['gpsnsec'] - self.index['sample'] / float(samplerate)
+        return np.repeat(t0, self.block_samples) + np.arange(self.nsamples) / float(samplerate)
+
+    def block_times(self):
+        """The GNSS times of the samples from the third block on, as
+        KiwiIQWavReader gives them: the time of its block plus its offset in
+        the block at a sample rate measured from the timestamps of the
+        blocks so far, a running average."""
+        t = self.index['gpssec'] + 1e-9*self.index['gpsnsec']
+        n = self.block_samples
+        if len(t) < 3:
+            return np.empty(0, dtype=np.float64)
+        rates = np.empty(len(t))
+        rate = float(self.nominal_samplerate)
+        for i, r in enumerate((n[1:] / np.diff(t)).tolist(), 1):
+            rate = r if i < 3 else 0.9*rate + 0.1*r
+            rates[i] = rate
+        sample = self.index['sample'].astype(np.int64)
+        offsets = np.arange(sample[2], self.nsamples) - np.repeat(sample[2:], n[2:])
+        return np.repeat(t[2:], n[2:]) + offsets / np.repeat(rates[2:], n[2:])
+
+def read_kiwi_iq_wav(filename, uniform_rate=False):
+    """The GNSS times and complex64 samples of a kiwi .wav IQ file, without
+    its first two blocks, as KiwiIQWavReader gives no times for them.  The
+    times are those of KiwiIQWavReader (see KiwiIQWavFile.block_times()),
+    with uniform_rate those of KiwiIQWavFile.times()."""
+    with KiwiIQWavFile(filename) as f:
+        start = int(f.index['sample'][2]) if len(f.index) > 2 else f.nsamples
+        t = f.times()[start:] if uniform_rate else f.block_times()
+        return t, f.read()[start:]
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules under test live in the top directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
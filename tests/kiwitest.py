@@ -0,0 +1,77 @@
+"""Helpers for the tests: kiwirecorder options and a scripted websocket stream."""
+
+import struct
+import sys
+
+import kiwicodec
+import kiwirecorder
+import wsclient
+from mod_pywebsocket import common
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
+
+def recorder_options(*argv):
+    """(gopt, options) as kiwirecorder.main() passes them to run_threads()."""
+    parsed = []
+    run_threads, sys_argv = kiwirecorder.run_threads, sys.argv
+    kiwirecorder.run_threads = lambda gopt, options: parsed.append((gopt, options))
+    sys.argv = ['kiwirecorder.py'] + list(argv)
+    try:
+        kiwirecorder.main()
+    finally:
+        kiwirecorder.run_threads, sys.argv = run_threads, sys_argv
+    return parsed[0]
+
+class FakeStream(object):
+    """Stands in for the mod_pywebsocket stream: receive_message() returns
+    the given messages, then None (the server closed the connection)."""
+
+    def __init__(self, messages=()):
+        self.messages = list(messages)
+        self.sent = []
+
+    def receive_message(self):
+        return self.messages.pop(0) if self.messages else None
+
+    def send_message(self, message):
+        self.sent.append(message)
+
+    def hold_writes(self):
+        pass
+
+    def flush_writes(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+def snd_message(seq, data, smeter=0):
+    return b'SND ' + struct.pack('<I', seq) + struct.pack('>H', smeter) + data
+
+def iq_message(seq, samples, gpssec=0, gpsnsec=0, last_gps_solution=0, smeter=0):
+    """samples: int16 array of interleaved I,Q values."""
+    gps = struct.pack('<BBII', last_gps_solution, 0, gpssec, gpsnsec)
+    return snd_message(seq, gps + samples.astype('>i2').tobytes(), smeter=smeter)
+
+def wf_message(seq, data, x_bin_server=0, flags_x_zoom_server=0):
+    return b'W/F ' + kiwicodec._WF_HEADER.pack(x_bin_server, flags_x_zoom_server, seq) + data
+
+def client_stream(sock):
+    """A websocket client Stream on a connected socket, without handshake."""
+    request = wsclient.ClientRequest(sock, buffered=True)
+    request.ws_version = common.VERSION_HYBI13
+    options = StreamOptions()
+    options.mask_send = True
+    options.unmask_receive = False
+    return Stream(request, options)
+
+def ws_frame(message):
+    """An unmasked binary websocket frame, as the Kiwi sends them."""
+    n = len(message)
+    if n < 126:
+        header = struct.pack('!BB', 0x82, n)
+    elif n < 1 << 16:
+        header = struct.pack('!BBH', 0x82, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x82, 127, n)
+    return header + message
@@ -0,0 +1,156 @@
+import array
+
+import numpy as np
+import pytest
+
+import kiwiclient
+
+def _streams():
+    """Random ADPCM data, and data driving the decoder into both rails."""
+    rng = np.random.RandomState(0)
+    noise = rng.randint(0, 256, 4000).astype(np.uint8)
+    up = np.full(300, 0x77, dtype=np.uint8)     # largest positive steps
+    down = np.full(600, 0xFF, dtype=np.uint8)   # largest negative steps
+    return [noise.tobytes(), np.concatenate((up, noise[:500], down, noise[500:1000], up)).tobytes()]
+
+def _reference(data):
+    return np.array(kiwiclient.ImaAdpcmDecoder().decode(bytearray(data)), dtype=np.int16)
+
+def test_rails_are_reached():
+    ref = _reference(_streams()[1])
+    assert ref.max() == 32767 and ref.min() == -32768
+
+@pytest.mark.parametrize('data', _streams())
+def test_fast_decoder(data):
+    ref = _reference(data)
+    for convert in (bytes, bytearray, memoryview):
+        assert np.array_equal(kiwiclient.ImaAdpcmFastDecoder().decode(convert(data)), ref)
+    # the state carries over from frame to frame
+    decoder = kiwiclient.ImaAdpcmFastDecoder()
+    frames, pos = [], 0
+    for size in [1, 7, 512, 33, 1000, 2] * 10:
+        frames.append(decoder.decode(data[pos:pos+size]))
+        pos += size
+    frames.append(decoder.decode(data[pos:]))
+    assert np.array_equal(np.concatenate(frames), ref)
+
+@pytest.mark.parametrize('data', _streams())
+def test_decode_into(data):
+    ref = _reference(data)
+    out = np.zeros(len(ref) + 10, dtype=np.int16)
+    assert kiwiclient.ImaAdpcmFastDecoder().decode_into(data, out, 10) == len(out)
+    assert np.array_equal(out[10:], ref)
+    out = array.array('h', bytes(2*len(ref)))
+    decoder = kiwiclient.ImaAdpcmFastDecoder()
+    end = decoder.decode_into(memoryview(data)[:101], out)
+    end = decoder.decode_into(memoryview(data)[101:], memoryview(out), end)
+    assert end == len(ref)
+    assert np.array_equal(np.array(out, dtype=np.int16), ref)
+    with pytest.raises(ValueError):
+        kiwiclient.ImaAdpcmFastDecoder().decode_into(data, np.zeros(len(ref), dtype=np.int16), 1)
+
+def _wf_lines():
+    rng = np.random.RandomState(1)
+    lines = [rng.randint(0, 256, 512).astype(np.uint8).tobytes() for i in range(6)]
+    lines.append(b'\x77' * 200 + b'\xff' * 312)   # both rails
+    return lines
+
+def test_decode_waterfall_lines():
+    lines = _wf_lines()
+    batch = kiwiclient.decode_waterfall_lines(lines)
+    assert batch.shape == (len(lines), 2*512 - 10)
+    assert batch.dtype == np.int16
+    for line, row in zip(lines, batch):
+        assert np.array_equal(row, _reference(line)[:-10])   # the decompression tail is removed
+    untrimmed = kiwiclient.decode_waterfall_lines([memoryview(line) for line in lines], tail=0)
+    assert np.array_equal(untrimmed[-1], _reference(lines[-1]))
+    assert kiwiclient.decode_waterfall_lines([]).shape == (0, 0)
+    with pytest.raises(ValueError):
+        kiwiclient.decode_waterfall_lines([lines[0], lines[1][:-1]])
+
+@pytest.mark.parametrize('samples_db', [False, True])
+def test_waterfall_batch_matches_per_line(samples_db):
+    """KiwiSDRStream with _wf_batch_size > 1 passes the lines it would pass
+    one at a time, including the partial batch flushed at the end."""
+    from kiwitest import wf_message
+    import kiwicodec
+
+    class Stream(kiwiclient.KiwiSDRStream):
+        def __init__(self, batch_size):
+            super(Stream, self).__init__()
+            self._wf_batch_size = batch_size
+            self._wf_samples_db = samples_db
+            self.rows = []
+        def _process_waterfall_samples(self, seq, samples):
+            self.rows.append((seq, np.array(samples)))
+
+    lines = _wf_lines()
+    results = []
+    for batch_size in (1, 4):
+        stream = Stream(batch_size)
+        for seq, line in enumerate(lines):
+            tag, body = kiwicodec.split_message(wf_message(seq, line))
+            stream._process_wf(body)
+        stream.shutdown()
+        results.append(stream.rows)
+    assert [seq for seq, row in results[1]] == list(range(len(lines)))
+    for (seq0, row0), (seq1, row1) in zip(*results):
+        assert seq0 == seq1
+        assert np.array_equal(row0, row1)
+    offset = 255 if samples_db else 0
+    assert np.array_equal(results[1][-1][1], _reference(lines[-1])[:-10] - offset)
+
+def _reference_nibbles(data, start, end, index=0, prev=0):
+    """The reference decoder's state after the nibbles start..end-1 of data."""
+    decoder = kiwiclient.ImaAdpcmDecoder()
+    decoder.index, decoder.prev = index, prev
+    data = bytearray(data)
+    for n in range(start, end):
+        decoder._decode_sample(data[n >> 1] >> 4 if n & 1 else data[n >> 1] & 0x0F)
+    return decoder.prev, decoder.index
+
+@pytest.mark.parametrize('data', _streams())
+def test_advance(data):
+    data = data[:1500]
+    for start, end in [(0, 3000), (1, 3000), (0, 2999), (1, 2999), (7, 8), (1201, 2460), (5, 5)]:
+        decoder = kiwiclient.ImaAdpcmFastDecoder()
+        decoder.index, decoder.prev = 40, -1234
+        decoder.advance(data, start, end)
+        assert (decoder.prev, decoder.index) == _reference_nibbles(data, start, end, 40, -1234), (start, end)
+    decoder = kiwiclient.ImaAdpcmFastDecoder()
+    decoder.advance(memoryview(data))
+    assert (decoder.prev, decoder.index) == _reference_nibbles(data, 0, 2*len(data))
+
+def test_decode_adpcm_blocks():
+    data = np.frombuffer(_streams()[1], dtype=np.uint8)[:10*200].reshape(10, 200)
+    index = np.arange(0, 89, 9)
+    prev = np.linspace(-32768, 32767, 10).astype(np.int16)
+    for nsamples in (400, 399, 1):
+        out = kiwiclient.decode_adpcm_blocks(data, index, prev, nsamples)
+        assert out.shape == (10, nsamples)
+        for row, block, i, p in zip(out, data, index, prev):
+            decoder = kiwiclient.ImaAdpcmDecoder()
+            decoder.index, decoder.prev = int(i), int(p)
+            assert np.array_equal(row, np.array(decoder.decode(bytearray(block)), dtype=np.int16)[:nsamples])
+
+def test_adpcm_wav_round_trip(tmpdir):
+    """AdpcmWavWriter -> read_adpcm_wav gives the decoded stream, whatever
+    the frame sizes, and convert_adpcm_wav writes it as 16 bit PCM."""
+    import kiwiwav
+    filename = str(tmpdir.join('adpcm.wav'))
+    data = np.frombuffer(_streams()[1], dtype=np.uint8)
+    writer = kiwiwav.AdpcmWavWriter(filename, 12000)
+    pos = 0
+    for size in [513, 1, 100, 1020, 7] * 3:
+        writer.write(data[pos:pos+size], (0, 0) if pos == 0 else None)
+        pos += size
+    writer.close()
+    ref = _reference(data[:pos].tobytes())
+    samplerate, samples = kiwiwav.read_adpcm_wav(filename)
+    assert samplerate == 12000
+    assert writer.nsamples == len(ref)
+    assert np.array_equal(samples, ref)
+    pcm = str(tmpdir.join('pcm.wav'))
+    kiwiwav.convert_adpcm_wav(filename, pcm)
+    with open(pcm, 'rb') as fp:
+        assert np.array_equal(np.frombuffer(fp.read()[44:], dtype='<i2'), ref)
@@ -0,0 +1,47 @@
+import asyncio
+
+import kiwiasync
+import kiwiclient
+import kiwiworker
+
+from kiwitest import recorder_options
+
+class FakeRecorder(object):
+    """Connects at once and raises the given errors from run(), one per connection."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.connects = 0
+        self.closes = 0
+        self.connect_timing = {}
+
+    async def connect(self, host, port):
+        self.connects += 1
+        self.connect_timing = dict(first_sample=None)
+
+    async def open(self):
+        pass
+
+    async def run(self):
+        raise self.errors.pop(0)
+
+    async def close(self):
+        self.closes += 1
+
+    def shutdown(self):
+        pass
+
+    def close_sinks(self):
+        pass
+
+def test_run_worker_retries():
+    gopt, options = recorder_options('-s', 'localhost', '--quiet')
+    recorder = FakeRecorder([kiwiclient.KiwiStallError('stall'), kiwiasync.WebSocketError('bad frame'),
+                             EOFError('closed'), kiwiclient.KiwiTimeLimitError('tlimit')])
+    scheduler = kiwiworker.ConnectScheduler(min_interval=0, backoff_base=0.01)
+    async def run():
+        stop = asyncio.Event()
+        await kiwiasync.run_worker(recorder, options[0], stop, scheduler)
+        return stop.is_set()
+    assert asyncio.run(run())
+    assert recorder.connects == recorder.closes == 4
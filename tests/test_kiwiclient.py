@@ -0,0 +1,80 @@
+import struct
+
+import numpy as np
+import pytest
+
+import kiwiclient
+
+from kiwitest import FakeStream, iq_message, recorder_options
+
+def test_pipeline_error_before_close():
+    """A server closing the connection after too_busy reports KiwiTooBusyError
+    when the message was still in the decode thread."""
+    gopt, options = recorder_options('-s', 'localhost', '--pipeline-depth', '4', '--quiet')
+    stream = kiwiclient.KiwiSDRStream()
+    stream._options = options[0]
+    stream._stream_name = 'SND'
+    stream._pipeline_depth = 4
+    stream._stream = FakeStream([b'MSG too_busy=4'])
+    stream.run()
+    with pytest.raises(kiwiclient.KiwiTooBusyError):
+        stream.run()
+    assert stream._pipeline is None
+
+def test_decode_buffer_no_allocation():
+    """With a decode buffer, steady-state SND decoding does not allocate
+    per frame: no memory growth over 100k frames."""
+    tracemalloc = pytest.importorskip('tracemalloc')
+
+    class Stream(kiwiclient.KiwiSDRStream):
+        def __init__(self):
+            super(Stream, self).__init__()
+            self._set_decode_buffer(1 << 14)
+            self.count = 0
+        def _process_audio_samples(self, seq, samples, rssi):
+            self.count += len(samples)
+
+    # short frames: tracing the decoder loop is slow, and the per-frame
+    # allocations do not depend on the payload size
+    body = struct.pack('<IH', 1, 0x0100) + bytes(bytearray(range(8)))
+    stream = Stream()
+    for i in range(1000):
+        stream._process_aud(body)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(100000):
+            stream._process_aud(body)
+        growth = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert stream.count == 101000 * 16
+    # allows for the loop variable and the like, not for a per-frame leak
+    assert growth < 1024
+
+def test_iq_converted_once_for_sinks():
+    """With a sink, the IQ samples are converted to complex64 once and the
+    same array goes to the sink and _process_iq_samples."""
+    received = {}
+
+    class Sink(kiwiclient.KiwiSink):
+        def process_iq_samples(self, seq, samples, rssi, gps):
+            received['sink'] = samples
+
+    class Stream(kiwiclient.KiwiSDRStream):
+        def _process_iq_samples(self, seq, samples, rssi, gps):
+            received['stream'] = samples
+
+    stream = Stream()
+    stream._modulation = 'iq'
+    stream.add_sink(Sink())
+    samples = np.array([1, -2, 3, -4, 32767, -32768], dtype=np.int16)
+    stream._process_aud(iq_message(7, samples, gpssec=100)[4:])
+    assert np.array_equal(received['stream'], [1 - 2j, 3 - 4j, 32767 - 32768j])
+    assert np.shares_memory(received['sink'], received['stream'])
+    assert received['stream'].flags.writeable and not received['sink'].flags.writeable
+    assert stream._iq_converted is None
+    # without sinks
+    stream.close_sinks()
+    stream._process_aud(iq_message(8, samples)[4:])
+    assert np.array_equal(received['stream'], [1 - 2j, 3 - 4j, 32767 - 32768j])
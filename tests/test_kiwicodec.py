@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import kiwicodec
+
+from kiwitest import iq_message, snd_message, wf_message
+
+def test_split_message():
+    tag, body = kiwicodec.split_message(bytearray(b'MSG a=1 b'))
+    assert tag == 'MSG'
+    assert isinstance(body, memoryview)
+    assert body.tobytes() == b'a=1 b'
+
+def test_parse_snd_compressed():
+    adpcm = bytes(bytearray(range(256)))
+    tag, body = kiwicodec.split_message(snd_message(0x12345678, adpcm, smeter=0x0500))
+    frame = kiwicodec.parse_snd(body)
+    assert tag == 'SND'
+    assert frame.seq == 0x12345678
+    assert frame.smeter == 0x0500
+    assert frame.rssi == 0x500 // 10 - 127
+    assert frame.data.tobytes() == adpcm   # passed on undecoded
+
+def test_parse_snd_uncompressed():
+    samples = np.array([0, 1, -1, 32767, -32768], dtype=np.int16)
+    tag, body = kiwicodec.split_message(snd_message(7, samples.astype('>i2').tobytes(), smeter=0xF3E8))
+    frame = kiwicodec.parse_snd(body)
+    assert frame.seq == 7
+    assert frame.rssi == 1000 // 10 - 127   # the high bits are flags
+    assert np.array_equal(np.frombuffer(frame.data, dtype='>i2'), samples)
+
+def test_parse_iq():
+    samples = np.arange(-8, 8, dtype=np.int16)
+    tag, body = kiwicodec.split_message(iq_message(3, samples, gpssec=123456, gpsnsec=987654321,
+                                                   last_gps_solution=2, smeter=1270))
+    frame = kiwicodec.parse_iq(body)
+    assert frame.seq == 3
+    assert frame.rssi == 0
+    gps = frame.gps
+    assert (gps.last_gps_solution, gps.gpssec, gps.gpsnsec) == (2, 123456, 987654321)
+    # the former gps dict access
+    assert (gps['last_gps_solution'], gps['gpssec'], gps['gpsnsec']) == (2, 123456, 987654321)
+    with pytest.raises(KeyError):
+        gps['gpsmsec']
+    assert frame.samples.dtype == np.dtype('>i2')
+    assert np.array_equal(frame.samples, samples)
+
+def test_parse_iq_too_short():
+    with pytest.raises(kiwicodec.KiwiCodecError):
+        kiwicodec.parse_iq(b'\0' * (kiwicodec.IQ_HEADER_SIZE - 1))
+
+def test_parse_wf():
+    tag, body = kiwicodec.split_message(wf_message(42, b'\x01\x02\x03', x_bin_server=5, flags_x_zoom_server=0x10003))
+    frame = kiwicodec.parse_wf(body)
+    assert tag == 'W/F'
+    assert (frame.x_bin_server, frame.flags_x_zoom_server, frame.seq) == (5, 0x10003, 42)
+    assert frame.data.tobytes() == b'\x01\x02\x03'
+
+def test_wf_db():
+    db = kiwicodec.wf_db(bytes(bytearray([0, 100, 155, 200, 254, 255])))
+    assert db.dtype == np.int16
+    assert db.tolist() == [-255, -155, -100, -55, -1, 0]
+
+def test_parse_wf_db():
+    frame = kiwicodec.parse_wf(kiwicodec._WF_HEADER.pack(0, 0, 7) + bytes(bytearray([100, 200])))
+    assert frame.seq == 7
+    assert kiwicodec.wf_db(frame.data).tolist() == [-155, -55]
+
+def test_parse_msg():
+    tag, body = kiwicodec.split_message(b'MSG audio_rate=12000 badp=0 name=caf\xc3\xa9 x=\xff bare empty= a=b=c')
+    params = kiwicodec.parse_msg(body)
+    assert len(params) == 7
+    assert list(params) == [('audio_rate', '12000'), ('badp', '0'), ('name', u'caf\xe9'), ('x', u'\ufffd'),
+                            ('bare', None), ('empty', ''), ('a', 'b=c')]
+    # names and values are str, no longer bytes, for the _on_msg_* handlers
+    for name, value in params:
+        assert type(name) is str
+        assert value is None or type(value) is str
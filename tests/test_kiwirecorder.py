@@ -0,0 +1,101 @@
+import os
+import socket
+import time
+
+import numpy as np
+
+import pytest
+
+import kiwiclient
+import kiwirecorder
+
+from kiwitest import FakeStream, client_stream, recorder_options, snd_message, wf_message, ws_frame
+
+def test_waterfall_tlimit():
+    gopt, options = recorder_options('-s', 'localhost', '--wf', '--tlimit', '5', '--quiet')
+    recorder = kiwirecorder.KiwiWaterfallRecorder(options[0])
+    recorder._stream = FakeStream([wf_message(0, bytes(bytearray(1024)))] * 2)
+    recorder.run()
+    assert recorder._start_time is not None
+    recorder._start_time -= 10
+    with pytest.raises(kiwiclient.KiwiTimeLimitError):
+        recorder.run()
+
+def test_async_rejects_pipeline():
+    with pytest.raises(SystemExit):
+        recorder_options('-s', 'localhost', '--async', '--pipeline-depth', '8')
+
+def _connect(recorder):
+    """What connect() does, on a socketpair instead of a Kiwi; returns the
+    Kiwi's end."""
+    client, server = socket.socketpair()
+    recorder._socket = client
+    recorder._stream = client_stream(client)
+    recorder._stream_name = 'SND'
+    recorder._stall_frames = recorder._options.stall_frames
+    recorder._reset_stall_watchdog()
+    t = kiwiclient._monotonic()
+    recorder._start_connect_timing(t, t, t)
+    return server
+
+def test_stall_reconnect_gaps(tmp_path):
+    gopt, options = recorder_options('-s', 'localhost', '-d', str(tmp_path), '--fn', 'rec', '--quiet')
+    recorder = kiwirecorder.KiwiSoundRecorder(options[0])
+    recorder._sample_rate = 12000
+    frame = ws_frame(snd_message(1, bytes(bytearray(512))))   # 1024 samples, 85 ms
+    server = _connect(recorder)
+    server.sendall(frame)
+    recorder.run()
+    assert recorder.stall_timeout == 1.0   # 8 frame periods, at least 1 s
+    t0 = time.time()
+    with pytest.raises(kiwiclient.KiwiStallError):
+        recorder.run()
+    assert 0.9 < time.time() - t0 < 5
+    server.close()
+
+    # reconnected: the recording continues in the same file, with a gap
+    server = _connect(recorder)
+    server.sendall(frame * 2)
+    recorder.run()
+    recorder.run()
+    recorder.close_sinks()
+    server.close()
+    with open(str(tmp_path / 'rec.wav.gaps')) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 1
+    t_from, t_to, duration, size = lines[0].split()
+    assert float(duration) >= 1.0
+    assert int(size) == 44 + 2*1024
+    assert os.path.getsize(str(tmp_path / 'rec.wav')) == 44 + 3*2*1024
+
+class _Clock(object):
+    """Stands in for the time module of kiwirecorder."""
+
+    def __init__(self, now):
+        self.now = now
+        self.gmtime = time.gmtime
+        self.strftime = time.strftime
+
+    def time(self):
+        return self.now
+
+def test_rotation(tmp_path, monkeypatch):
+    """--dt-sec starts new files at multiples of dt seconds since 00:00 UTC."""
+    gopt, options = recorder_options('-s', 'localhost', '-f', '10000', '-m', 'usb', '-d', str(tmp_path),
+                                     '--dt-sec', '60', '--quiet')
+    t0 = 86400 * 20000 + 3650.5   # 01:00:50.5 UTC
+    clock = _Clock(t0)
+    monkeypatch.setattr(kiwirecorder, 'time', clock)
+    recorder = kiwirecorder.KiwiSoundRecorder(options[0])
+    recorder._sample_rate = 12000
+    samples = np.zeros(512, dtype=np.int16)
+    for t in (0, 1, 2, 9.4, 9.6, 20, 69.4, 69.6):
+        clock.now = t0 + t
+        recorder._write_samples(samples)
+    recorder.close_sinks()
+    starts = (t0, t0 + 9.6, t0 + 69.6)
+    names = [time.strftime('%Y%m%dT%H%M%SZ_10000000_usb.wav', time.gmtime(t)) for t in starts]
+    assert names[1].startswith('20241004T010100Z')
+    assert sorted(os.listdir(str(tmp_path))) == names
+    sizes = [os.path.getsize(str(tmp_path / name)) for name in names]
+    assert sizes == [44 + 4 * 1024, 44 + 3 * 1024, 44 + 1024]
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+kiwishm = pytest.importorskip('kiwishm')   # python 3.8+
+
+@pytest.fixture
+def ring():
+    writer = kiwishm.RingWriter(dtype=np.int16, nblocks=8, capacity=16)
+    reader = kiwishm.RingReader(writer.name)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+def _write(writer, blocks):
+    for block in blocks:
+        writer.write(block, np.full(4, block, dtype=np.int16), rssi=-block)
+
+def test_read(ring):
+    writer, reader = ring
+    assert reader.read(timeout=0.01) is None
+    _write(writer, range(3))
+    for block in range(3):
+        b = reader.read(timeout=0)
+        assert (b.block, b.seq, b.rssi) == (block, block, -block)
+        assert list(b.samples) == [block] * 4
+        assert b.valid()
+    assert reader.overruns == 0
+    assert reader.read(timeout=0.01) is None
+
+def test_iq_gps():
+    writer = kiwishm.RingWriter(dtype=np.complex64, nblocks=4, capacity=8)
+    reader = kiwishm.RingReader(writer.name)
+    try:
+        gps = dict(last_gps_solution=3, gpssec=123456, gpsnsec=789)
+        writer.write(7, np.arange(8, dtype=np.complex64) * 1j, gps=gps)
+        b = reader.read(timeout=0)
+        assert b.gps == gps
+        assert b.samples.dtype == np.complex64
+        assert b.samples[2] == 2j
+    finally:
+        reader.close()
+        writer.close()
+
+def test_overrun(ring):
+    writer, reader = ring
+    _write(writer, range(20))
+    # blocks 12..19 are in the ring, 12 is skipped as the next one overwritten
+    b = reader.read(timeout=0)
+    assert b.block == 13
+    assert reader.overruns == 13
+    _write(writer, range(20, 28))
+    assert not b.valid()
+
+def test_overwritten_blocks_are_skipped():
+    # slots the writer is just overwriting (block -1) are skipped by a
+    # loop, not a recursion, and with the original deadline
+    nblocks = 4000
+    writer = kiwishm.RingWriter(dtype=np.int16, nblocks=nblocks, capacity=1)
+    reader = kiwishm.RingReader(writer.name)
+    try:
+        for block in range(nblocks):
+            writer.write(block, np.zeros(1, dtype=np.int16))
+        reader._slots['block'][:-1] = -1
+        b = reader.read(timeout=0)
+        assert b.block == nblocks - 1
+        assert reader.overruns == nblocks - 1
+        assert reader.read(timeout=0.01) is None
+    finally:
+        reader.close()
+        writer.close()
+
+def test_closed(ring):
+    writer, reader = ring
+    writer._ctrl['closed'] = 1
+    assert reader.read() is None
@@ -0,0 +1,166 @@
+import os
+import struct
+import threading
+import time
+import wave
+
+import numpy as np
+
+import kiwiclient
+import kiwiwav
+
+def _reference(frames):
+    decoder = kiwiclient.ImaAdpcmDecoder()
+    return [np.array(decoder.decode(bytearray(frame)), dtype=np.int16) for frame in frames]
+
+def test_queued_adpcm_drop(tmpdir):
+    """Dropped ADPCM blocks queue nothing; the data after the gap decodes
+    as part of the stream."""
+    filename = str(tmpdir.join('adpcm.wav'))
+    frames = np.random.RandomState(1).randint(0, 256, (40, 512)).astype(np.uint8)
+    state = kiwiclient.ImaAdpcmFastDecoder()
+    thread = kiwiwav.WriterThread(nblocks=4, policy='drop')
+    wav = kiwiwav.QueuedWavWriter(thread, filename, 12000, 1, wav_class=kiwiwav.AdpcmWavWriter)
+    disk = threading.Event()
+    stalled = threading.Event()
+    def stall():
+        stalled.set()
+        disk.wait()
+    thread.call(stall)   # the disk stalls
+    stalled.wait()
+    for i, frame in enumerate(frames):
+        if i == 30:
+            disk.set()
+        while disk.is_set() and thread._free.qsize() < thread.nblocks:
+            time.sleep(0.01)   # the disk keeps up again
+        start = (state.prev, state.index)
+        state.advance(frame.data)
+        wav.write(frame, start)
+        if not disk.is_set():
+            assert thread._queue.qsize() <= thread.nblocks
+    wav.close()
+    thread.stop()
+    assert thread.dropped == 26
+
+    ref = _reference(frames)
+    samplerate, samples = kiwiwav.read_adpcm_wav(filename)
+    before = np.concatenate([ref[i] for i in range(4)])
+    after = np.concatenate([ref[i] for i in range(30, 40)])
+    samples_per_block = 2*(1024 - 4) + 1
+    gap_end = -(-len(before) // samples_per_block) * samples_per_block
+    assert samplerate == 12000
+    assert len(samples) == gap_end + len(after)
+    assert np.array_equal(samples[:len(before)], before)
+    assert np.array_equal(samples[gap_end:], after)
+    assert os.path.exists(filename + '.gaps')
+
+def _wav_sizes(filename):
+    """(RIFF size, data size) from the header."""
+    with open(filename, 'rb') as f:
+        header = f.read(44)
+    return struct.unpack('<I', header[4:8])[0], struct.unpack('<I', header[40:44])[0]
+
+def test_header_sizes(tmpdir):
+    filename = str(tmpdir.join('pcm.wav'))
+    samples = np.arange(1000, dtype=np.int16)
+    wav = kiwiwav.WavWriter(filename, 12000, 1, header_interval=3600)
+    wav.write(samples)
+    assert _wav_sizes(filename) == (36, 0)   # until the next update
+    wav.update_header()
+    assert _wav_sizes(filename) == (36 + 2000, 2000)
+    wav.write(samples)
+    wav.close()
+    assert os.path.getsize(filename) == 44 + 4000
+    assert _wav_sizes(filename) == (36 + 4000, 4000)
+    f = wave.open(filename)
+    assert (f.getframerate(), f.getnchannels(), f.getnframes()) == (12000, 1, 2000)
+    assert np.array_equal(np.frombuffer(f.readframes(2000), dtype='<i2'), np.tile(samples, 2))
+    f.close()
+
+def test_header_interval(tmpdir):
+    filename = str(tmpdir.join('pcm.wav'))
+    wav = kiwiwav.WavWriter(filename, 12000, 1, header_interval=0)
+    wav.write(np.zeros(100, dtype=np.int16))
+    assert _wav_sizes(filename) == (36 + 200, 200)
+    wav.close()
+
+def test_kiwi_wav_header_size(tmpdir):
+    filename = str(tmpdir.join('iq.wav'))
+    wav = kiwiwav.WavWriter(filename, 12000, 2, True)
+    gps = dict(last_gps_solution=0, gpssec=1, gpsnsec=0)
+    for i in range(3):
+        wav.write(np.zeros(1024, dtype=np.int16), gps)
+    wav.close()
+    size = os.path.getsize(filename)
+    assert _wav_sizes(filename)[0] == size - 8
+    assert not os.path.exists(filename + '.idx')
+
+def _stall(thread):
+    """Stalls the disk of a WriterThread until the returned event is set."""
+    disk = threading.Event()
+    stalled = threading.Event()
+    def stall():
+        stalled.set()
+        disk.wait()
+    thread.call(stall)
+    stalled.wait()
+    return disk
+
+def _wait_idle(thread):
+    while thread._free.qsize() < thread.nblocks:
+        time.sleep(0.01)
+
+def test_writer_drop(tmpdir):
+    filename = str(tmpdir.join('pcm.wav'))
+    blocks = [np.full(256, i, dtype=np.int16) for i in range(12)]
+    thread = kiwiwav.WriterThread(nblocks=4, block_size=1024, policy='drop')
+    wav = kiwiwav.QueuedWavWriter(thread, filename, 12000, 1)
+    disk = _stall(thread)
+    for block in blocks[:10]:
+        wav.write(block)
+    assert (thread.dropped, thread.high_water) == (6, 4)
+    assert thread._queue.qsize() == 4
+    disk.set()
+    _wait_idle(thread)
+    for block in blocks[10:]:
+        wav.write(block)
+    # a block larger than the pool's free buffers is dropped as well
+    disk = _stall(thread)
+    wav.write(blocks[0])
+    wav.write(np.zeros(4 * 512, dtype=np.int16))
+    assert thread.dropped == 7
+    disk.set()
+    wav.close()
+    thread.stop()
+    assert thread.errors == 0
+
+    f = wave.open(filename)
+    samples = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    f.close()
+    assert np.array_equal(samples, np.concatenate(blocks[:4] + blocks[10:] + blocks[:1]))
+    with open(filename + '.gaps') as fp:
+        gaps = [line.split() for line in fp]
+    # noted at the size where recording resumed; no block followed the last drop
+    assert [int(gap[3]) for gap in gaps] == [44 + 4 * 512]
+
+def test_writer_block(tmpdir):
+    filename = str(tmpdir.join('pcm.wav'))
+    blocks = [np.full(256, i, dtype=np.int16) for i in range(6)]
+    thread = kiwiwav.WriterThread(nblocks=2, block_size=1024, policy='block')
+    wav = kiwiwav.QueuedWavWriter(thread, filename, 12000, 1)
+    disk = _stall(thread)
+    receiver = threading.Thread(target=lambda: [wav.write(block) for block in blocks])
+    receiver.start()
+    receiver.join(0.2)
+    assert receiver.is_alive()   # waits for a free buffer
+    disk.set()
+    receiver.join()
+    wav.close()
+    thread.stop()
+    assert (thread.dropped, thread.written, thread.high_water) == (0, 6, 2)
+    assert thread.latency_max >= 0.2
+    f = wave.open(filename)
+    samples = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    f.close()
+    assert np.array_equal(samples, np.concatenate(blocks))
+    assert not os.path.exists(filename + '.gaps')
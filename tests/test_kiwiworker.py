@@ -0,0 +1,73 @@
+import socket
+import threading
+
+import pytest
+
+import kiwiclient
+import kiwiworker
+from kiwiworker import BACKOFF, RECONNECT, STOP
+
+from kiwitest import recorder_options
+
+@pytest.mark.parametrize('error, action, tdoa_action, status', [
+    (kiwiclient.KiwiStallError('stall'), RECONNECT, RECONNECT, 0),
+    (kiwiclient.KiwiTooBusyError('busy'), BACKOFF, STOP, 2),
+    (kiwiclient.KiwiTimeLimitError('tlimit'), STOP, STOP, 0),
+    (socket.error('reset'), BACKOFF, STOP, 1),
+    (EOFError('closed'), BACKOFF, STOP, 1),
+    (ValueError('bug'), STOP, STOP, 1),
+])
+def test_error_action(error, action, tdoa_action, status):
+    gopt, options = recorder_options('-s', 'localhost', '--quiet')
+    opt = options[0]
+    assert kiwiworker.error_action(error, opt) == action
+    opt.is_kiwi_tdoa = True
+    assert kiwiworker.error_action(error, opt) == tdoa_action
+    assert opt.status == status
+
+def test_error_action_connecting():
+    gopt, options = recorder_options('-s', 'localhost', '--quiet')
+    opt = options[0]
+    assert kiwiworker.error_action(ValueError('refused'), opt, connecting=True) == BACKOFF
+    assert kiwiworker.error_action(ValueError('bug'), opt, persistent=True) == BACKOFF
+
+class FakeRecorder(object):
+    """Connects at once and raises the given errors from run(), one per connection."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.connects = 0
+        self.aborts = 0
+        self.connect_timing = None
+
+    def connect(self, host, port):
+        self.connects += 1
+        self.connect_timing = dict(first_sample=None)
+
+    def open(self):
+        pass
+
+    def run(self):
+        raise self.errors.pop(0)
+
+    def abort(self):
+        self.aborts += 1
+
+    def shutdown(self):
+        pass
+
+    def close_sinks(self):
+        pass
+
+def test_worker_retries():
+    gopt, options = recorder_options('-s', 'localhost', '--quiet')
+    recorder = FakeRecorder([kiwiclient.KiwiStallError('stall'), socket.error('reset'),
+                             kiwiclient.KiwiTimeLimitError('tlimit')])
+    run_event = threading.Event()
+    run_event.set()
+    scheduler = kiwiworker.ConnectScheduler(min_interval=0, backoff_base=0.01)
+    worker = kiwiworker.KiwiWorker(args=(recorder, options[0], run_event), kwargs=dict(scheduler=scheduler))
+    worker.run()
+    assert recorder.connects == recorder.aborts == 3
+    assert not run_event.is_set()
+    assert scheduler.stats['localhost']['connects'][0] == 3
@@ -0,0 +1,33 @@
+import numpy as np
+
+import kiwiwav
+import read_kiwi_iq_wav
+
+def _record(filename, nblocks=50, samplerate=12001.0):
+    rng = np.random.RandomState(25)
+    writer = kiwiwav.WavWriter(filename, 12000, 2, True)
+    for i in range(nblocks):
+        # GNSS timestamps with some jitter, so that the rate estimates differ
+        ns = int((i*512/samplerate + rng.uniform(0, 2e-4)) * 1e9)
+        writer.write(rng.randint(-32768, 32767, 1024).astype(np.int16),
+                     dict(last_gps_solution=3, gpssec=1000 + ns // 10**9, gpsnsec=ns % 10**9))
+    writer.close()
+
+def test_read_kiwi_iq_wav(tmp_path):
+    filename = str(tmp_path / 'iq.wav')
+    _record(filename)
+    blocks = [(t, z) for t, z in read_kiwi_iq_wav.KiwiIQWavReader(filename) if t is not None]
+    t, z = read_kiwi_iq_wav.read_kiwi_iq_wav(filename)
+    assert np.array_equal(z, np.concatenate([z for t, z in blocks]))
+    # the per-block running average of KiwiIQWavReader by default
+    assert np.allclose(t, np.concatenate([t for t, z in blocks]), rtol=0, atol=1e-9)
+    t, z = read_kiwi_iq_wav.read_kiwi_iq_wav(filename, uniform_rate=True)
+    with read_kiwi_iq_wav.KiwiIQWavFile(filename) as f:
+        assert np.array_equal(t, f.times()[2*512:])
+        assert not np.allclose(t, f.block_times(), rtol=0, atol=1e-9)
+
+def test_short_file(tmp_path):
+    filename = str(tmp_path / 'iq.wav')
+    _record(filename, nblocks=2)
+    t, z = read_kiwi_iq_wav.read_kiwi_iq_wav(filename)
+    assert len(t) == len(z) == 0
@@ -0,0 +1,36 @@
+import socket
+import threading
+
+from kiwitest import client_stream
+
+def test_held_writes_are_per_thread():
+    """A decode thread holding its writes does not hold the pongs sent by
+    the receiving thread."""
+    client, server = socket.socketpair()
+    server.settimeout(5)
+    try:
+        stream = client_stream(client)
+        held = threading.Event()
+        flush = threading.Event()
+
+        def decode():
+            stream.hold_writes()
+            stream.send_message('SET keepalive')
+            held.set()
+            flush.wait(5)
+            stream.flush_writes()
+
+        decoder = threading.Thread(target=decode)
+        decoder.start()
+        held.wait(5)
+        server.sendall(b'\x89\x04ping' + b'\x81\x03MSG')
+        assert stream.receive_message() == 'MSG'
+        # the pong went out while the decode thread still holds its frame
+        assert bytearray(server.recv(2)) == bytearray([0x8A, 0x84])
+        server.recv(4 + 4)   # mask, payload
+        flush.set()
+        decoder.join()
+        assert bytearray(server.recv(1)) == bytearray([0x81])
+    finally:
+        client.close()
+        server.close()
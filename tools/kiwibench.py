@@ -0,0 +1,1143 @@
+#!/usr/bin/env python
+## -*- python -*-
+
+"""
+Microbenchmarks for the kiwiclient hot paths.
+
+Run from the top-level directory, e.g.
+
+    python tools/kiwibench.py            # run all benchmarks
+    python tools/kiwibench.py adpcm      # run selected benchmarks
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import kiwiclient
+
+def _rate(fcn, min_time):
+    """Calls fcn() repeatedly for at least min_time seconds, returns calls/sec."""
+    n = 0
+    t0 = time.time()
+    while True:
+        fcn()
+        n += 1
+        dt = time.time() - t0
+        if dt >= min_time:
+            return n / dt
+
+def _report(name, rate, unit='frames/s', ref=None):
+    if ref is None:
+        print('  %-32s %12.0f %s' % (name, rate, unit))
+    else:
+        print('  %-32s %12.0f %s  (x%.1f)' % (name, rate, unit, rate / ref))
+
+def bench_adpcm(opt):
+    """IMA ADPCM decoding of compressed SND frames"""
+    data = os.urandom(opt.frame_bytes)
+    ref = np.array(kiwiclient.ImaAdpcmDecoder().decode(data), dtype=np.int16)
+    assert (kiwiclient.ImaAdpcmFastDecoder().decode(data) == ref).all()
+    assert (kiwiclient.ImaAdpcmFastDecoder().decode(memoryview(data)) == ref).all()
+
+    old = kiwiclient.ImaAdpcmDecoder()
+    new = kiwiclient.ImaAdpcmFastDecoder()
+    print('%d byte frames' % len(data))
+    r0 = _rate(lambda: old.decode(data), opt.min_time)
+    _report('ImaAdpcmDecoder', r0)
+    _report('ImaAdpcmFastDecoder', _rate(lambda: new.decode(data), opt.min_time), ref=r0)
+
+def bench_wf(opt):
+    """batch decoding of compressed waterfall lines"""
+    lines = [os.urandom(opt.wf_bytes) for i in range(opt.wf_lines)]
+    batch = kiwiclient.decode_waterfall_lines(lines)
+    for line, row in zip(lines, batch):
+        ref = kiwiclient.ImaAdpcmDecoder().decode(line)
+        assert (row == ref[:len(ref)-10]).all()
+
+    def per_line(decoder):
+        for line in lines:
+            decoder.__init__()
+            samples = decoder.decode(line)
+            samples = samples[:len(samples)-10]
+
+    print('%d lines of %d bytes' % (len(lines), opt.wf_bytes))
+    r0 = len(lines) * _rate(lambda: per_line(kiwiclient.ImaAdpcmDecoder()), opt.min_time)
+    _report('ImaAdpcmDecoder', r0, 'lines/s')
+    _report('ImaAdpcmFastDecoder', len(lines) * _rate(lambda: per_line(kiwiclient.ImaAdpcmFastDecoder()), opt.min_time), 'lines/s', ref=r0)
+    _report('decode_waterfall_lines', len(lines) * _rate(lambda: kiwiclient.decode_waterfall_lines(lines), opt.min_time), 'lines/s', ref=r0)
+
+def bench_alloc(opt):
+    """memory growth of compressed SND decoding into a ring buffer (tracemalloc)"""
+    import struct
+    import tracemalloc
+
+    class _Sink(kiwiclient.KiwiSDRStream):
+        def __init__(self):
+            super(_Sink, self).__init__()
+            self._set_decode_buffer(1 << 14)
+            self.count = 0
+        def _process_audio_samples(self, seq, samples, rssi):
+            self.count += len(samples)
+
+    # tracing every int object of the decoder loop is slow: use short frames,
+    # the per-frame allocations do not depend on the payload size
+    body = struct.pack('<IH', 1, 0x0100) + os.urandom(64)
+    frames = range(opt.alloc_frames)
+    stream = _Sink()
+    for i in range(1000):
+        stream._process_aud(body)
+    tracemalloc.start()
+    t0 = time.time()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in frames:
+        stream._process_aud(body)
+    growth = tracemalloc.get_traced_memory()[0] - before
+    dt = time.time() - t0
+    tracemalloc.stop()
+    print('%d frames of %d bytes' % (opt.alloc_frames, len(body)))
+    _report('_process_aud (traced)', opt.alloc_frames / dt)
+    print('  %-32s %12d bytes' % ('memory growth', growth))   # see tests/test_kiwiclient.py
+
+def bench_wf_raw(opt):
+    """uncompressed waterfall lines (wf_comp=0)"""
+    import array
+    import struct
+
+    class _Stream(kiwiclient.KiwiSDRStream):
+        pass
+
+    body = bytearray(struct.pack('<III', 0, 0, 1) + os.urandom(1024))
+    def legacy():
+        samples = array.array('h')
+        for b in memoryview(body)[12:]:
+            samples.append(b)
+    stream = _Stream()
+    stream._compression = False
+    print('1024 bins')
+    r0 = _rate(legacy, opt.min_time)
+    _report('per-byte loop', r0, 'lines/s')
+    _report('uint8 view', _rate(lambda: stream._process_wf(body), opt.min_time), 'lines/s', ref=r0)
+    stream._wf_samples_db = True
+    _report('int16 dB', _rate(lambda: stream._process_wf(body), opt.min_time), 'lines/s', ref=r0)
+
+class _LegacyDispatch(object):
+    """The frame dispatch path as it was before the memoryview rework."""
+
+    def _process_ws_message(self, message):
+        tag = message[0:3].decode()
+        body = message[4:]
+        self._process_message(tag, body)
+
+    def _process_aud(self, body):
+        import struct
+        seq = struct.unpack('<I', memoryview(body[0:4]))[0]
+        smeter = struct.unpack('>H', memoryview(body[4:6]))[0]
+        data = body[6:]
+        rssi = (smeter & 0x0FFF) // 10 - 127
+        if self._modulation == 'iq':
+            gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], struct.unpack('<BBII', memoryview(data[0:10]))))
+            data = data[10:]
+            count = len(data) // 2
+            samples = np.ndarray(count, dtype='>h', buffer=data).astype(np.float32)
+            cs      = np.ndarray(count//2, dtype=np.complex64)
+            cs.real = samples[0:count:2]
+            cs.imag = samples[1:count:2]
+            self._process_iq_samples(seq, cs, rssi, gps)
+        else:
+            if self._compression:
+                samples = self._decoder.decode(data)
+            else:
+                count = len(data) // 2
+                samples = np.ndarray(count, dtype='>h', buffer=data).astype(np.int16)
+            self._process_audio_samples(seq, samples, rssi)
+
+    def _process_wf(self, body):
+        import struct
+        seq = struct.unpack('<I', memoryview(body[8:12]))[0]
+        data = body[12:]
+        self._decoder.__init__()
+        samples = self._decoder.decode(data)
+        samples = samples[:len(samples)-10]
+        self._process_waterfall_samples(seq, samples)
+
+def _dispatch_messages(frame_bytes):
+    """Synthetic SND, IQ and W/F websocket messages as returned by Stream.receive_message()."""
+    import struct
+    snd = bytearray(b'SND\x00' + struct.pack('<IH', 1, 0x0100) + os.urandom(frame_bytes))
+    iq = bytearray(b'SND\x00' + struct.pack('<IHBBII', 1, 0x0100, 0, 0, 1, 2) + os.urandom(2048))
+    wf = bytearray(b'W/F\x00' + struct.pack('<III', 0, 0, 1) + os.urandom(frame_bytes))
+    return [('SND', 'am', snd), ('IQ', 'iq', iq), ('W/F', None, wf)]
+
+def bench_dispatch(opt):
+    """frame dispatch: bytes allocated per frame and frames/s, before and after"""
+    import tracemalloc
+
+    class _Stream(kiwiclient.KiwiSDRStream):
+        def __init__(self, modulation):
+            super(_Stream, self).__init__()
+            self._modulation = modulation
+            self._isWF = modulation is None
+        def _set_keepalive(self):
+            pass
+
+    class _Legacy(_LegacyDispatch, _Stream):
+        pass
+
+    for name, modulation, message in _dispatch_messages(opt.frame_bytes):
+        print('%s, %d byte messages' % (name, len(message)))
+        r0 = None
+        for label, cls in (('before', _Legacy), ('after', _Stream)):
+            stream = cls(modulation)
+            stream._process_ws_message(message)
+            tracemalloc.start()
+            stream._process_ws_message(message)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rate = _rate(lambda: stream._process_ws_message(message), opt.min_time)
+            r0 = r0 or rate
+            _report(label, rate, ref=r0)
+            print('  %-32s %12d bytes/frame' % ('  peak allocation', peak))
+
+def bench_codec(opt):
+    """kiwicodec per-frame parse cost"""
+    import kiwicodec
+    messages = dict((name, message) for name, modulation, message in _dispatch_messages(opt.frame_bytes))
+    msg = bytearray(b'MSG audio_rate=12000 sample_rate=12001.135 version_maj=1 version_min=338 center_freq=15000000 bandwidth=30000000')
+    cases = [
+        ('split_message', kiwicodec.split_message, messages['SND']),
+        ('parse_snd', kiwicodec.parse_snd, kiwicodec.split_message(messages['SND'])[1]),
+        ('parse_iq', kiwicodec.parse_iq, kiwicodec.split_message(messages['IQ'])[1]),
+        ('parse_wf', kiwicodec.parse_wf, kiwicodec.split_message(messages['W/F'])[1]),
+        ('parse_msg (6 params)', kiwicodec.parse_msg, kiwicodec.split_message(msg)[1]),
+    ]
+    for name, fcn, body in cases:
+        rate = _rate(lambda: fcn(body), opt.min_time)
+        print('  %-32s %12.0f frames/s %8.2f us/frame' % (name, rate, 1e6 / rate))
+
+def bench_keepalive(opt):
+    """upstream keepalive frames and sendall calls per second of SND, per frame vs timer"""
+    snd = _dispatch_messages(opt.frame_bytes)[0][2]
+    frame_rate = 12000.0 / 512   # SND frames/s at 12 kHz, 512 samples/frame
+    clock = [0.0]
+
+    class _Stream(kiwiclient.KiwiSDRStream):
+        def __init__(self):
+            super(_Stream, self).__init__()
+            self._modulation = 'am'
+            self._isWF = False
+            self.sent = 0
+        def _send_message(self, msg):
+            self.sent += 1
+
+    monotonic = kiwiclient._monotonic
+    kiwiclient._monotonic = lambda: clock[0]
+    try:
+        stream = _Stream()
+        n = int(60 * frame_rate)
+        for i in range(n):
+            clock[0] = i / frame_rate
+            stream._process_ws_message(snd)
+    finally:
+        kiwiclient._monotonic = monotonic
+    duration = n / frame_rate
+    _report('per frame', n / duration, unit='sends/s')
+    _report('%.1fs timer' % stream._keepalive_interval, stream.sent / duration, unit='sends/s')
+    print('  %-32s %12.1f %%' % ('  upstream frames saved', 100.0 * stream._keepalive_skipped / n))
+
+class _CountingSocket(object):
+    """Socket wrapper counting the receive calls."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.calls = 0
+
+    def recv(self, n):
+        self.calls += 1
+        return self._sock.recv(n)
+
+    def recv_into(self, buf):
+        self.calls += 1
+        return self._sock.recv_into(buf)
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+
+    def getpeername(self):
+        return ('socketpair', 0)
+
+def _server_frames(opt):
+    """Unmasked server-to-client websocket frames carrying Kiwi messages."""
+    from mod_pywebsocket import common
+    from mod_pywebsocket._stream_hybi import create_binary_frame
+    frames = []
+    for name, modulation, message in _dispatch_messages(opt.frame_bytes):
+        frames.append(bytes(create_binary_frame(bytes(message), opcode=common.OPCODE_BINARY)))
+    frames.append(bytes(create_binary_frame(b'MSG audio_rate=12000 sample_rate=12001.135', opcode=common.OPCODE_BINARY)))
+    return frames
+
+def bench_recv(opt):
+    """websocket receive path: recv syscalls per frame, unbuffered vs recv_into read-ahead"""
+    import socket
+    import threading
+    import wsclient
+    from mod_pywebsocket import common
+    from mod_pywebsocket.stream import Stream, StreamOptions
+
+    frames = _server_frames(opt)
+    n = opt.recv_frames
+    stream_data = b''.join(frames[i % len(frames)] for i in range(n))
+    print('%d frames, %d bytes' % (n, len(stream_data)))
+    r0 = None
+    for label, buffered in (('ClientConnection', False), ('BufferedClientConnection', True)):
+        a, b = socket.socketpair()
+        writer = threading.Thread(target=b.sendall, args=(stream_data,))
+        writer.start()
+        sock = _CountingSocket(a)
+        request = wsclient.ClientRequest(sock, buffered=buffered)
+        request.ws_version = common.VERSION_HYBI13
+        options = StreamOptions()
+        options.mask_send = True
+        options.unmask_receive = False
+        stream = Stream(request, options)
+        t0 = time.time()
+        for i in range(n):
+            stream.receive_message()
+        rate = n / (time.time() - t0)
+        writer.join()
+        a.close()
+        b.close()
+        r0 = r0 or rate
+        _report(label, rate, ref=r0)
+        print('  %-32s %12.3f calls/frame' % ('  recv syscalls', sock.calls / float(n)))
+
+class _ReplaySocket(object):
+    """Socket serving the same byte stream over and over, without syscalls."""
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def recv_into(self, buf):
+        n = min(len(buf), len(self._data) - self._pos)
+        buf[:n] = self._data[self._pos:self._pos+n]
+        self._pos = (self._pos + n) % len(self._data)
+        return n
+
+    def recv(self, n):
+        buf = bytearray(n)
+        return bytes(buf[:self.recv_into(buf)])
+
+    def getpeername(self):
+        return ('replay', 0)
+
+def bench_parse(opt):
+    """websocket frame parser: general parse_frame vs client fast path"""
+    import wsclient
+    from mod_pywebsocket import common
+    from mod_pywebsocket.stream import Stream, StreamOptions
+
+    frames = _server_frames(opt)
+    stream_data = b''.join(frames)
+    messages = {}
+    r0 = None
+    for label, fast_path in (('parse_frame', False), ('fast path', True)):
+        request = wsclient.ClientRequest(_ReplaySocket(stream_data), buffered=True)
+        request.ws_version = common.VERSION_HYBI13
+        options = StreamOptions()
+        options.mask_send = True
+        options.unmask_receive = False
+        options.receive_fast_path = fast_path
+        stream = Stream(request, options)
+        messages[label] = [bytes(stream.receive_message()) for f in frames]
+        rate = _rate(stream.receive_message, opt.min_time)
+        r0 = r0 or rate
+        _report(label, rate, ref=r0)
+    assert messages['parse_frame'] == messages['fast path']
+
+def bench_setup(opt):
+    """connection setup commands: one write per command vs one write per dispatch cycle"""
+    import wsclient
+    from mod_pywebsocket import common
+    from mod_pywebsocket._stream_hybi import create_binary_frame
+    from mod_pywebsocket.stream import Stream, StreamOptions
+
+    class _Options(object):
+        tlimit = None
+
+    class _Socket(_ReplaySocket):
+        def __init__(self, data):
+            super(_Socket, self).__init__(data)
+            self.calls = 0
+            self.bytes = 0
+        def sendall(self, data):
+            self.calls += 1
+            self.bytes += len(data)
+
+    class _Stream(kiwiclient.KiwiSDRStream):
+        def __init__(self, sock):
+            super(_Stream, self).__init__()
+            self._options = _Options()
+            self._start_time = None
+            self._modulation = 'am'
+            self._isWF = False
+            self._socket = sock
+            self._stream_name = 'SND'
+            request = wsclient.ClientRequest(sock, buffered=True)
+            request.ws_version = common.VERSION_HYBI13
+            options = StreamOptions()
+            options.mask_send = True
+            options.unmask_receive = False
+            self._stream = Stream(request, options)
+        def _setup_rx_params(self):
+            # as in kiwirecorder
+            self.set_name('kiwirecorder.py')
+            self.set_mod('am', -5000, 5000, 10000)
+            self.set_agc(on=True)
+            self.set_inactivity_timeout(0)
+        def _on_sample_rate_change(self):
+            pass
+
+    msg = bytes(create_binary_frame(b'MSG audio_rate=12000 sample_rate=12001.135', opcode=common.OPCODE_BINARY))
+    r0 = None
+    for label, batched in (('one write per command', False), ('one write per cycle', True)):
+        sock = _Socket(msg)
+        stream = _Stream(sock)
+        if batched:
+            cycle = stream.run
+        else:
+            cycle = lambda: stream._process_ws_message(stream._stream.receive_message())
+        cycle()
+        calls = sock.calls
+        rate = _rate(cycle, opt.min_time)
+        r0 = r0 or rate
+        _report(label, rate, unit='setups/s', ref=r0)
+        print('  %-32s %12d calls/setup' % ('  sendall', calls))
+
+def _fake_kiwi_server(port_queue, frame_bytes, frame_rate, stall_after=0):
+    """Minimal KiwiSDR: websocket handshake, sample_rate MSG, then SND frames
+    of random compressed audio at frame_rate per connection.  With
+    stall_after>0 the first connection goes silent after that many frames."""
+    import asyncio
+    import base64
+    import struct
+    from mod_pywebsocket import common, util
+    from mod_pywebsocket._stream_hybi import create_binary_frame
+
+    msg = bytes(create_binary_frame(b'MSG audio_rate=12000 sample_rate=12001.135'))
+    payload = os.urandom(frame_bytes)
+
+    async def drain_client(reader):
+        while await reader.read(1 << 16):
+            pass
+
+    connections = [0]
+
+    async def handle(reader, writer):
+        connections[0] += 1
+        stall = stall_after if connections[0] == 1 else 0
+        try:
+            request = (await reader.readuntil(b'\r\n\r\n')).decode()
+            key = [l.split(':', 1)[1].strip() for l in request.split('\r\n')
+                   if l.lower().startswith('sec-websocket-key:')][0]
+            accept = base64.b64encode(util.sha1_hash((key + common.WEBSOCKET_ACCEPT_UUID).encode()).digest())
+            writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                         b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+            writer.write(msg)
+            asyncio.ensure_future(drain_client(reader))
+            loop = asyncio.get_event_loop()
+            t = loop.time()
+            seq = 0
+            while True:
+                if stall and seq >= stall:
+                    await asyncio.sleep(3600)
+                writer.write(bytes(create_binary_frame(b'SND\x00' + struct.pack('<IH', seq, 0x0100) + payload)))
+                seq += 1
+                t += 1.0 / frame_rate
+                await asyncio.sleep(max(0, t - loop.time()))
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024)
+        port_queue.put(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+class _LoadOptions(object):
+    server_host = '127.0.0.1'
+    password = ''
+    tlimit = None
+    socket_timeout = 10
+    is_kiwi_tdoa = False
+    status = 0
+
+def _load_client_class(base):
+    class _LoadClient(base):
+        def __init__(self, options):
+            super(_LoadClient, self).__init__()
+            self._options = options
+            self._isWF = False
+            self._start_time = None
+            self.frames = 0
+        def _setup_rx_params(self):
+            self.set_mod('am', -5000, 5000, 10000)
+            self.set_agc(on=True)
+        def _process_audio_samples(self, seq, samples, rssi):
+            self.frames += 1
+    return _LoadClient
+
+def _load_threads(opt, port, measure):
+    import threading
+    cls = _load_client_class(kiwiclient.KiwiSDRStream)
+    options = _LoadOptions()
+    options.server_port = port
+    clients = [cls(options) for i in range(opt.load_conns)]
+    def worker(client):
+        try:
+            client.connect(options.server_host, port)
+            client.open()
+            while True:
+                client.run()
+        except Exception:
+            pass
+    threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    return measure(clients, time.sleep)
+
+def _load_async(opt, port, measure):
+    import asyncio
+    import kiwiasync
+    cls = _load_client_class(kiwiasync.AsyncKiwiSDRStream)
+    options = _LoadOptions()
+    options.server_port = port
+    clients = [cls(options) for i in range(opt.load_conns)]
+
+    async def main():
+        stop = asyncio.Event()
+        tasks = [asyncio.ensure_future(kiwiasync.run_worker(c, options, stop)) for c in clients]
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(None, measure, clients, time.sleep)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return result
+    return asyncio.run(main())
+
+def bench_load(opt):
+    """many receivers against a local fake Kiwi: client CPU and connections per core, threads vs asyncio"""
+    import multiprocessing
+    frame_rate = 12000.0 / (2 * opt.frame_bytes)
+
+    def measure(clients, sleep):
+        # wait for all connections to be up, then count frames and CPU time
+        t_end = time.time() + 30
+        while sum(1 for c in clients if c.frames) < len(clients) and time.time() < t_end:
+            sleep(0.1)
+        frames0 = sum(c.frames for c in clients)
+        t0, cpu0 = time.time(), time.process_time()
+        sleep(opt.load_time)
+        dt, cpu = time.time() - t0, time.process_time() - cpu0
+        return sum(c.frames for c in clients) - frames0, dt, cpu
+
+    print('%d connections, %.1f SND frames/s each, %d bytes/frame' % (opt.load_conns, frame_rate, opt.frame_bytes))
+    for label, run in (('threads', _load_threads), ('asyncio', _load_async)):
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_fake_kiwi_server, args=(port_queue, opt.frame_bytes, frame_rate))
+        server.daemon = True
+        server.start()
+        try:
+            frames, dt, cpu = run(opt, port_queue.get(), measure)
+        finally:
+            server.terminate()
+            server.join()
+        print('  %-32s %12.0f frames/s  (%.0f%% of expected)' % (label, frames / dt, 100.0 * frames / dt / (frame_rate * opt.load_conns)))
+        print('  %-32s %12.1f %% of a core' % ('  client CPU', 100.0 * cpu / dt))
+        print('  %-32s %12.0f connections/core' % ('  capacity', opt.load_conns * dt / cpu))
+
+def _deflate_messages(wf_bins, wf_lines):
+    """Uncompressed (wf_comp=0) W/F lines of a synthetic spectrum and a
+    synthetic load_cfg MSG of a Kiwi with a long band list."""
+    import json
+    import struct
+    try:
+        from urllib.parse import quote
+    except ImportError:
+        from urllib import quote
+    rng = np.random.RandomState(1)
+    floor = 145 + np.convolve(rng.normal(0, 4, wf_bins), np.ones(32) / 32, 'same')
+    carriers = rng.randint(0, wf_bins, 24)
+    lines = []
+    for seq in range(wf_lines):
+        line = floor + rng.normal(0, 4, wf_bins)
+        line[carriers] += rng.uniform(10, 40, len(carriers))
+        lines.append(b'W/F\x00' + struct.pack('<III', 0, 0, seq) + np.clip(line, 0, 255).astype(np.uint8).tobytes())
+    bands = [dict(min=f, max=f + 25.0 * (i % 7 + 1), name='Band %d' % i, svc='BHUAWMI'[i % 7],
+                  itu=i % 4, sel='%.2fam' % f, chan=0)
+             for i, f in enumerate(np.arange(100.0, 30000.0, 75.0))]
+    cfg = dict(rx_name='KiwiSDR benchmark', rx_gps=quote('(48.000000, 11.000000)'), rx_grid='JN58',
+               rx_antenna='active loop', index_html_params=dict(HTML_HEAD_TITLE='KiwiSDR'), bands=bands,
+               passbands=dict((m, dict(lo=-2500, hi=2500)) for m in ('am', 'amn', 'usb', 'lsb', 'cw', 'cwn', 'nbfm', 'iq')))
+    load_cfg = b'MSG load_cfg=' + quote(json.dumps(cfg)).encode()
+    return lines, load_cfg
+
+def bench_deflate(opt):
+    """permessage-deflate: bytes on the wire vs client CPU, uncompressed W/F and load_cfg"""
+    import zlib
+    import wsclient
+    from mod_pywebsocket import common
+    from mod_pywebsocket._stream_hybi import create_binary_frame
+    from mod_pywebsocket.extensions import _PerMessageDeflateFramer
+    from mod_pywebsocket.stream import Stream, StreamOptions
+
+    def server_frames(messages, deflate):
+        # as a server with context takeover: DEFLATE, sync flush, strip 00 00 ff ff
+        compress = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        frames = []
+        for message in messages:
+            if deflate:
+                payload = compress.compress(message) + compress.flush(zlib.Z_SYNC_FLUSH)
+                frame = bytearray(create_binary_frame(payload[:-4], opcode=common.OPCODE_BINARY))
+                frame[0] |= 0x40   # RSV1
+                frames.append(bytes(frame))
+            else:
+                frames.append(bytes(create_binary_frame(message, opcode=common.OPCODE_BINARY)))
+        return frames
+
+    wf_lines, load_cfg = _deflate_messages(opt.wf_bins, opt.wf_lines)
+    adpcm_bytes = 12 + opt.wf_bins // 2 + 5   # wf_comp=1, for reference
+    for name, messages in (('W/F line, %d bins' % opt.wf_bins, wf_lines), ('load_cfg', [load_cfg])):
+        print('%s: %d bytes%s' % (name, len(messages[0]),
+                                  ', %d with wf_comp=1' % adpcm_bytes if name.startswith('W/F') else ''))
+        r0 = None
+        for label, deflate, setup in (('uncompressed', False, None),
+                                      ('deflate, receive_inflater', True, 'setup_receive_options'),
+                                      ('deflate, message filters', True, 'setup_stream_options')):
+            frames = server_frames(messages, deflate)
+            request = wsclient.ClientRequest(_ReplaySocket(b''.join(frames)), buffered=True)
+            request.ws_version = common.VERSION_HYBI13
+            options = StreamOptions()
+            options.mask_send = True
+            options.unmask_receive = False
+            if setup is not None:
+                getattr(_PerMessageDeflateFramer(None, False), setup)(options)
+            stream = Stream(request, options)
+            received = [bytes(stream.receive_message()) for f in frames]
+            assert received == messages
+            rate = _rate(stream.receive_message, opt.min_time)
+            r0 = r0 or rate
+            _report(label, rate, unit='msgs/s', ref=r0)
+            print('  %-32s %12.1f bytes/msg  %8.1f us/msg' % ('', sum(len(f) for f in frames) / float(len(frames)), 1e6 / rate))
+
+def bench_wav(opt):
+    """writing IQ .wav blocks: open/append/close and header rewrite per block vs kiwiwav.WavWriter"""
+    import shutil
+    import struct
+    import tempfile
+    import kiwiwav
+
+    samples = np.random.randint(-32768, 32767, 1024, dtype=np.int16)   # 512 I,Q pairs
+    gps = dict(last_gps_solution=0, gpssec=1, gpsnsec=2)
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'bench.wav')
+
+    def legacy():
+        # as KiwiSoundRecorder._write_samples did
+        with open(filename, 'ab') as fp:
+            fp.write(struct.pack('<4sIBBII', b'kiwi', 10, gps['last_gps_solution'], 0, gps['gpssec'], gps['gpsnsec']))
+            fp.write(struct.pack('<4sI', b'data', samples.nbytes))
+            samples.tofile(fp)
+        with open(filename, 'r+b') as fp:
+            fp.seek(0, os.SEEK_END)
+            filesize = fp.tell()
+            fp.seek(0, os.SEEK_SET)
+            kiwiwav.write_wav_header(fp, filesize, 12000, 2, True)
+
+    try:
+        with open(filename, 'wb') as fp:
+            kiwiwav.write_wav_header(fp, 100, 12000, 2, True)
+        r0 = _rate(legacy, opt.min_time)
+        _report('open/append/close per block', r0, unit='blocks/s', ref=r0)
+        writer = kiwiwav.WavWriter(filename, 12000, 2, True)
+        rate = _rate(lambda: writer.write(samples, gps), opt.min_time)
+        writer.close()
+        _report('WavWriter', rate, unit='blocks/s', ref=r0)
+        print('  %-32s %12.0f x real time (IQ at 12 kHz, 512 pairs/block)' % ('', rate * 512 / 12000.0))
+    finally:
+        shutil.rmtree(tmp)
+
+def _adpcm_encode(samples):
+    """IMA ADPCM encoding of int samples, for test data that does not clip."""
+    index = prev = 0
+    codes = []
+    for x in samples:
+        step = kiwiclient.stepSizeTable[index]
+        diff = int(x) - prev
+        code = 0
+        if diff < 0:
+            code = 8
+            diff = -diff
+        if diff >= step:
+            code |= 4
+            diff -= step
+        if diff >= step >> 1:
+            code |= 2
+            diff -= step >> 1
+        if diff >= step >> 2:
+            code |= 1
+        t = (index << 4) | code
+        prev = kiwiclient.clamp(prev + kiwiclient._adpcmDelta[t], -32768, 32767)
+        index = kiwiclient._adpcmNextIndex[t]
+        codes.append(code)
+    codes = np.array(codes, dtype=np.uint8)
+    return codes[0::2] | (codes[1::2] << 4)
+
+def bench_adpcmwav(opt):
+    """recording compressed audio: decode + 16 bit PCM WavWriter vs ADPCM passthrough AdpcmWavWriter"""
+    import shutil
+    import tempfile
+    import kiwiwav
+
+    nframes = 64
+    noise = np.random.normal(0, 2000, 2 * opt.frame_bytes * nframes)
+    frames = _adpcm_encode(noise).reshape(nframes, opt.frame_bytes)
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'bench.wav')
+    print('%d byte frames' % opt.frame_bytes)
+
+    def pcm():
+        for i, frame in enumerate(frames):
+            if i == 0:
+                decoder.__init__()   # the frames are one stream
+            writer.write(decoder.decode(frame.data))
+
+    def passthrough():
+        for i, frame in enumerate(frames):
+            writer.write(frame, (0, 0) if i == 0 else None)
+
+    try:
+        decoder = kiwiclient.ImaAdpcmFastDecoder()
+        writer = kiwiwav.WavWriter(filename, 12000, 1)
+        r0 = nframes * _rate(pcm, opt.min_time)
+        writer.close()
+        _report('decode + WavWriter', r0, ref=r0)
+        print('  %-32s %12d bytes/frame on disk' % ('', 4 * opt.frame_bytes))
+        writer = kiwiwav.AdpcmWavWriter(filename, 12000)
+        rate = nframes * _rate(passthrough, opt.min_time)
+        writer.close()
+        _report('AdpcmWavWriter', rate, ref=r0)
+        print('  %-32s %12d bytes/frame on disk' % ('', os.path.getsize(filename) * 2 * opt.frame_bytes // writer.nsamples))
+        t0 = time.time()
+        samples = kiwiwav.read_adpcm_wav(filename)[1]
+        dt = time.time() - t0
+        print('  %-32s %12.0f x real time (%d samples, 12 kHz)' % ('read_adpcm_wav', len(samples) / 12000.0 / dt, len(samples)))
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_wavseek(opt):
+    """finding a GNSS time in a kiwi .wav IQ file: iterating over the blocks vs the block index"""
+    import shutil
+    import tempfile
+    import kiwiwav
+    import read_kiwi_iq_wav
+
+    nblocks = 20000   # about 15 minutes of IQ at 12 kHz, 40 MB
+    samples = np.random.randint(-32768, 32767, 1024, dtype=np.int16)
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'bench.wav')
+    try:
+        writer = kiwiwav.WavWriter(filename, 12000, 2, True)
+        for i in range(nblocks):
+            ns = i * 512 * 10**9 // 12000
+            writer.write(samples, dict(last_gps_solution=0, gpssec=ns // 10**9, gpsnsec=ns % 10**9))
+        writer.close()
+        target = (nblocks - 10) * 512 / 12000.0
+
+        def scan():
+            reader = read_kiwi_iq_wav.KiwiIQWavReader(filename)
+            for t, z in reader:
+                if reader.gpssec >= target:
+                    return
+
+        def index():
+            read_kiwi_iq_wav.KiwiIQWavReader(filename).seek(target)
+
+        print('%d blocks, %.0f MB' % (nblocks, os.path.getsize(filename) / 1e6))
+        r0 = _rate(scan, opt.min_time)
+        _report('iterate to the time', r0, unit='seeks/s', ref=r0)
+        _report('KiwiIQWavReader.seek()', _rate(index, opt.min_time), unit='seeks/s', ref=r0)
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_wavread(opt):
+    """reading a whole kiwi .wav IQ file: KiwiIQWavReader blocks + concatenate vs memory-mapped KiwiIQWavFile"""
+    import shutil
+    import tempfile
+    import kiwiwav
+    import read_kiwi_iq_wav
+
+    nblocks = 20000
+    samples = np.random.randint(-32768, 32767, 1024, dtype=np.int16)
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'bench.wav')
+    try:
+        writer = kiwiwav.WavWriter(filename, 12000, 2, True)
+        for i in range(nblocks):
+            ns = i * 512 * 10**9 // 12000
+            writer.write(samples, dict(last_gps_solution=0, gpssec=ns // 10**9, gpsnsec=ns % 10**9))
+        writer.close()
+        mbytes = os.path.getsize(filename) / 1e6
+
+        def blocks():
+            np.concatenate([z for t, z in read_kiwi_iq_wav.KiwiIQWavReader(filename)])
+
+        with read_kiwi_iq_wav.KiwiIQWavFile(filename) as f:
+            out = np.empty(f.nsamples, dtype=np.complex64)
+            print('%d blocks, %.0f MB (in the page cache)' % (nblocks, mbytes))
+            r0 = mbytes * _rate(blocks, opt.min_time)
+            _report('KiwiIQWavReader + concatenate', r0, unit='MB/s', ref=r0)
+            _report('KiwiIQWavFile open', mbytes * _rate(lambda: read_kiwi_iq_wav.KiwiIQWavFile(filename).close(), opt.min_time),
+                    unit='MB/s', ref=r0)
+            _report('KiwiIQWavFile.read(out)', mbytes * _rate(lambda: f.read(out), opt.min_time), unit='MB/s', ref=r0)
+            _report('KiwiIQWavFile.read(raw=True)', mbytes * _rate(lambda: f.read(raw=True), opt.min_time), unit='MB/s', ref=r0)
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_writer(opt):
+    """receive thread blocked by file I/O: inline WavWriter vs WriterThread, with a disk stalling 200 ms every second"""
+    import shutil
+    import tempfile
+    import kiwiwav
+
+    class _StallingWavWriter(kiwiwav.WavWriter):
+        def update_header(self):
+            time.sleep(0.2)
+            super(_StallingWavWriter, self).update_header()
+
+    samples = np.random.randint(-32768, 32767, 1024, dtype=np.int16)
+    gps = dict(last_gps_solution=0, gpssec=1, gpsnsec=2)
+    rate = 500   # blocks/s, about 40 IQ receivers
+    tmp = tempfile.mkdtemp()
+    wav_writer = kiwiwav.WavWriter
+    kiwiwav.WavWriter = _StallingWavWriter
+    print('%d blocks/s for 3s' % rate)
+    try:
+        for label, nblocks, policy in (('inline', 0, None), ('WriterThread block', 256, 'block'),
+                                       ('WriterThread block, 32 buffers', 32, 'block'),
+                                       ('WriterThread drop, 32 buffers', 32, 'drop')):
+            filename = os.path.join(tmp, 'bench.wav')
+            thread = kiwiwav.WriterThread(nblocks, policy=policy) if nblocks else None
+            if thread is None:
+                wav = kiwiwav.WavWriter(filename, 12000, 2, True, header_interval=1.0)
+            else:
+                wav = kiwiwav.QueuedWavWriter(thread, filename, 12000, 2, True, header_interval=1.0)
+            t_next = time.time()
+            worst = total = 0
+            for i in range(3 * rate):
+                t0 = time.time()
+                wav.write(samples, gps)
+                dt = time.time() - t0
+                worst = max(worst, dt)
+                total += dt
+                t_next += 1.0 / rate
+                time.sleep(max(0, t_next - time.time()))
+            wav.close()
+            print('  %-32s %8.3f/%.1f ms per block in the receive thread (mean/max)' % (label, 1e3 * total / (3 * rate), 1e3 * worst))
+            if thread is not None:
+                thread.stop()
+                print('  %-32s %8d of %d buffers high-water, %d dropped, write latency max %.0f ms'
+                      % ('', thread.high_water, nblocks, thread.dropped, 1e3 * thread.latency_max))
+    finally:
+        kiwiwav.WavWriter = wav_writer
+        shutil.rmtree(tmp)
+
+def bench_stall(opt):
+    """silently stalled stream: socket timeout vs frame cadence watchdog"""
+    import multiprocessing
+    frame_rate = 12000.0 / (2 * opt.frame_bytes)
+
+    class _StallClient(_load_client_class(kiwiclient.KiwiSDRStream)):
+        def _process_audio_samples(self, seq, samples, rssi):
+            self.frames += 1
+            self.last_frame = time.time()
+        def _on_stream_gap(self, t_from, t_to):
+            self.gap = t_to - t_from
+
+    print('%.1f SND frames/s, the stream stalls after 2s' % frame_rate)
+    for label, stall_frames in (('socket timeout', 0), ('watchdog (8 frames)', 8)):
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_fake_kiwi_server,
+                                         args=(port_queue, opt.frame_bytes, frame_rate, int(2 * frame_rate)))
+        server.daemon = True
+        server.start()
+        options = _LoadOptions()
+        options.server_port = port_queue.get()
+        options.stall_frames = stall_frames
+        client = _StallClient(options)
+        client.gap = None
+        try:
+            client.connect(options.server_host, options.server_port)
+            client.open()
+            try:
+                while True:
+                    client.run()
+            except Exception as e:
+                detect = time.time() - client.last_frame
+                stalled = isinstance(e, kiwiclient.KiwiStallError)
+            if stalled:
+                # what KiwiWorker does: reconnect at once
+                client.connect(options.server_host, options.server_port)
+                client.open()
+                while client.gap is None:
+                    client.run()
+                client._socket.close()
+        finally:
+            server.terminate()
+            server.join()
+        print('  %-32s %12.3f s to detect' % (label, detect))
+        if stalled:
+            print('  %-32s %12.3f s from the last block to recording again' % ('', client.gap))
+        else:
+            print('  %-32s %12s then KiwiWorker gives up' % ('', ''))
+
+def bench_pipeline(opt):
+    """receive stage stalls behind a slow sink, inline vs ReceivePipeline"""
+    messages = dict((name, message) for name, modulation, message in _dispatch_messages(opt.frame_bytes))
+
+    class _Wire(object):
+        """Delivers a message every 1/rate s, records how late it was read."""
+        def __init__(self, message, rate):
+            self.message = message
+            self.rate = rate
+            self.n = 0
+            self.t0 = time.time()
+            self.worst = 0
+        def receive_message(self):
+            due = self.t0 + self.n / self.rate
+            self.n += 1
+            late = time.time() - due
+            if late < 0:
+                time.sleep(-late)
+            self.worst = max(self.worst, late)
+            return memoryview(self.message)
+        def hold_writes(self):
+            pass
+        def flush_writes(self):
+            pass
+
+    class _Options(object):
+        tlimit = None
+
+    class _Stream(kiwiclient.KiwiSDRStream):
+        def __init__(self, name, depth):
+            super(_Stream, self).__init__()
+            self._options = _Options()
+            self._start_time = None
+            self._modulation = 'am'
+            self._isWF = name == 'W/F'
+            self._stream = _Wire(messages[name], 100.0)
+            self._pipeline_depth = depth
+            self.frames = 0
+        def _set_keepalive(self):
+            pass
+        def _slow_sink(self):
+            # a 50 ms disk stall every 20 frames
+            self.frames += 1
+            if self.frames % 20 == 0:
+                time.sleep(0.05)
+        def _process_audio_samples(self, seq, samples, rssi):
+            self._slow_sink()
+        def _process_waterfall_samples(self, seq, samples):
+            self._slow_sink()
+
+    n = 200
+    print('100 frames/s arriving, sink stalls 50 ms every 20 frames')
+    for name in ('SND', 'W/F'):
+        for label, depth in (('inline', 0), ('pipeline depth 4', 4), ('pipeline depth 32', 32)):
+            stream = _Stream(name, depth)
+            for i in range(n):
+                stream.run()
+            if stream._pipeline is not None:
+                stream._pipeline.stop()
+                dropped = sum(stream._pipeline.dropped.values())
+            else:
+                dropped = 0
+            print('  %-32s %9.1f ms read late (worst), %d dropped'
+                  % ('%s %s' % (name, label), 1e3 * stream._stream.worst, dropped))
+
+def bench_sinks(opt):
+    """fan-out of decoded audio blocks to several sinks on one connection"""
+    snd = _dispatch_messages(opt.frame_bytes)[0][2]
+
+    class _Stream(kiwiclient.KiwiSDRStream):
+        def __init__(self):
+            super(_Stream, self).__init__()
+            self._modulation = 'am'
+            self._isWF = False
+        def _set_keepalive(self):
+            pass
+
+    class _Sink(kiwiclient.KiwiSink):
+        def process_audio_samples(self, seq, samples, rssi):
+            pass
+
+    r0 = None
+    for label, inline, threaded in (('no sinks', 0, 0), ('1 sink', 1, 0), ('4 sinks', 4, 0), ('4 sinks, 1 threaded', 3, 1)):
+        stream = _Stream()
+        for i in range(inline):
+            stream.add_sink(_Sink())
+        for i in range(threaded):
+            stream.add_sink(_Sink(), threaded=True, queue_depth=1024)
+        rate = _rate(lambda: stream._process_ws_message(snd), opt.min_time)
+        r0 = r0 or rate
+        _report(label, rate, ref=r0)
+        stream.close_sinks()
+
+def _shm_consumer(name, result):
+    import kiwishm
+    reader = kiwishm.RingReader(name)
+    result.put('ready')
+    n = 0
+    total = 0.0
+    while True:
+        block = reader.read(timeout=1)
+        if block is None:
+            break
+        total += float(block.samples[0].real)
+        n += 1
+        del block
+    result.put((n, reader.overruns))
+    reader.close()
+
+def _queue_consumer(q, result):
+    result.put('ready')
+    n = 0
+    total = 0.0
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        seq, samples, rssi, gps = item
+        total += float(samples[0].real)
+        n += 1
+    result.put((n, 0))
+
+def bench_shm(opt):
+    """IQ blocks to another process: multiprocessing.Queue vs shared-memory ring"""
+    import multiprocessing
+    import kiwicodec
+    import kiwishm
+    n = 20000
+    samples = (np.random.randn(1024) + 1j * np.random.randn(1024)).astype(np.complex64)
+    gps = kiwicodec.GpsTime(0, 0, 1, 2)
+    print('%d blocks of %d complex64 samples' % (n, len(samples)))
+    r0 = None
+    for label in ('multiprocessing.Queue', 'kiwishm ring'):
+        result = multiprocessing.Queue()
+        if label == 'kiwishm ring':
+            writer = kiwishm.RingWriter(dtype=np.complex64, nblocks=1024, capacity=len(samples))
+            consumer = multiprocessing.Process(target=_shm_consumer, args=(writer.name, result))
+            put = lambda i: writer.process_iq_samples(i, samples, -50, gps)
+        else:
+            q = multiprocessing.Queue(1024)
+            consumer = multiprocessing.Process(target=_queue_consumer, args=(q, result))
+            put = lambda i: q.put((i, samples, -50, gps))
+        consumer.start()
+        result.get()
+        t0 = time.time()
+        for i in range(n):
+            put(i)
+        dt = time.time() - t0
+        if label == 'kiwishm ring':
+            time.sleep(0.1)
+            writer.close()
+        else:
+            q.put(None)
+        received, overruns = result.get()
+        consumer.join()
+        rate = n / dt
+        r0 = r0 or rate
+        _report(label, rate, unit='blocks/s', ref=r0)
+        print('  %-32s %12d received, %d overruns' % ('', received, overruns))
+
+BENCHMARKS = [
+    ('adpcm', bench_adpcm),
+    ('wf', bench_wf),
+    ('wfraw', bench_wf_raw),
+    ('alloc', bench_alloc),
+    ('dispatch', bench_dispatch),
+    ('codec', bench_codec),
+    ('recv', bench_recv),
+    ('parse', bench_parse),
+    ('keepalive', bench_keepalive),
+    ('setup', bench_setup),
+    ('load', bench_load),
+    ('pipeline', bench_pipeline),
+    ('sinks', bench_sinks),
+    ('shm', bench_shm),
+    ('stall', bench_stall),
+    ('deflate', bench_deflate),
+    ('wav', bench_wav),
+    ('adpcmwav', bench_adpcmwav),
+    ('wavseek', bench_wavseek),
+    ('wavread', bench_wavread),
+    ('writer', bench_writer),
+]
+
+def main():
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-t', '--min-time',
+                      dest='min_time', type='float', default=1.0,
+                      help='Minimum run time per measurement, in seconds')
+    parser.add_option('--frame-bytes',
+                      dest='frame_bytes', type='int', default=512,
+                      help='Compressed SND payload size per frame')
+    parser.add_option('--alloc-frames',
+                      dest='alloc_frames', type='int', default=100000,
+                      help='Number of frames decoded by the alloc benchmark')
+    parser.add_option('--recv-frames',
+                      dest='recv_frames', type='int', default=20000,
+                      help='Number of frames received by the recv benchmark')
+    parser.add_option('--wf-bytes',
+                      dest='wf_bytes', type='int', default=517,
+                      help='Compressed W/F payload size per line')
+    parser.add_option('--wf-lines',
+                      dest='wf_lines', type='int', default=256,
+                      help='Number of W/F lines per batch')
+    parser.add_option('--wf-bins',
+                      dest='wf_bins', type='int', default=1024,
+                      help='Bins per uncompressed W/F line of the deflate benchmark')
+    parser.add_option('--load-conns',
+                      dest='load_conns', type='int', default=200,
+                      help='Number of connections opened by the load benchmark')
+    parser.add_option('--load-time',
+                      dest='load_time', type='float', default=10.0,
+                      help='Measurement time of the load benchmark, in seconds')
+    parser.add_option('-l', '--list',
+                      dest='list', default=False, action='store_true',
+                      help='List the available benchmarks')
+
+    (options, args) = parser.parse_args()
+
+    if options.list:
+        for name, fcn in BENCHMARKS:
+            print('%-12s %s' % (name, fcn.__doc__))
+        return
+
+    for name, fcn in BENCHMARKS:
+        if args and name not in args:
+            continue
+        print('== %s: %s' % (name, fcn.__doc__))
+        fcn(options)
+
+if __name__ == '__main__':
+    main()
+
+# EOF
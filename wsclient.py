@@ -258,6 +258,8 @@ class ClientHandshakeProcessor(ClientHandshakeBase):
         self._origin = origin
         self._deflate_frame = deflate_frame
         self._use_permessage_deflate = use_permessage_deflate
+        # _PerMessageDeflateFramer when the server accepted permessage-deflate
+        self.permessage_deflate_framer = None
 
         self._logger = util.get_class_logger(self)
 
@@ -386,6 +388,7 @@ class ClientHandshakeProcessor(ClientHandshakeBase):
                 framer = _get_permessage_deflate_framer(extension)
                 framer.set_compress_outgoing_enabled(True)
                 self._use_permessage_deflate = framer
+                self.permessage_deflate_framer = framer
                 continue
 
             raise ClientHandshakeError('Unexpected extension %r' % extension_name)
@@ -393,7 +396,9 @@ class ClientHandshakeProcessor(ClientHandshakeBase):
         if (self._deflate_frame and not deflate_frame_accepted):
             raise ClientHandshakeError('Requested %s, but the server rejected it' % common.DEFLATE_FRAME_EXTENSION)
         if (self._use_permessage_deflate and not permessage_deflate_accepted):
-            raise ClientHandshakeError('Requested %s, but the server rejected it' % common.PERMESSAGE_DEFLATE_EXTENSION)
+            # compression is optional: continue uncompressed
+            self._logger.info('Requested %s, but the server rejected it', common.PERMESSAGE_DEFLATE_EXTENSION)
+            self._use_permessage_deflate = False
 
         # TODO(tyoshino): Handle Sec-WebSocket-Protocol
         # TODO(tyoshino): Handle Cookie, etc.
@@ -419,15 +424,77 @@ class ClientConnection(object):
     remote_addr = property(get_remote_addr)
 
 
+class BufferedClientConnection(ClientConnection):
+    """A ClientConnection with a read-ahead buffer.
+
+    Data is received with large recv_into calls into a reusable buffer, and
+    frame headers and payloads are served from memory. read_exact returns
+    memoryviews into the buffer which are only valid until the next read.
+    """
+
+    def __init__(self, socket, buffer_size=1 << 18):
+        super(BufferedClientConnection, self).__init__(socket)
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.recv_calls = 0
+
+    def _fill(self, n):
+        """Makes sure at least n bytes are buffered. Returns False when the
+        connection was closed before.
+        """
+        if self._start + n > len(self._buffer):
+            available = self._end - self._start
+            if n > len(self._buffer):
+                # the old buffer stays alive as long as views into it exist
+                self._buffer = bytearray(max(n, 2 * len(self._buffer)))
+                view = memoryview(self._buffer)
+                view[:available] = self._view[self._start:self._end]
+                self._view = view
+            else:
+                self._view[:available] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = available
+        while self._end - self._start < n:
+            received = self._socket.recv_into(self._view[self._end:])
+            self.recv_calls += 1
+            if not received:
+                return False
+            self._end += received
+        return True
+
+    def read(self, n):
+        if self._start == self._end and not self._fill(1):
+            return b''
+        n = min(n, self._end - self._start)
+        data = self._view[self._start:self._start + n].tobytes()
+        self._start += n
+        return data
+
+    def read_exact(self, n):
+        """Returns a memoryview of exactly n bytes, or raises IOError when the
+        connection is closed before.
+        """
+        if self._end - self._start < n and not self._fill(n):
+            raise IOError('Connection closed before receiving requested length '
+                          '(requested %d bytes but received only %d bytes)' %
+                          (n, self._end - self._start))
+        data = self._view[self._start:self._start + n]
+        self._start += n
+        return data
+
+
 class ClientRequest(object):
     """A wrapper class just to make it able to pass a socket object to
     functions that expect a mp_request object.
     """
 
-    def __init__(self, socket):
+    def __init__(self, socket, buffered=False):
         self._logger = util.get_class_logger(self)
 
         self._socket = socket
-        self.connection = ClientConnection(socket)
-
-
+        if buffered:
+            self.connection = BufferedClientConnection(socket)
+        else:
+            self.connection = ClientConnection(socket)